@@ -0,0 +1,596 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from pyuvdata.uvdata.mir_meta_data import in_dtype, sp_dtype
+
+import contextlib
+from datetime import datetime, timezone
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+repo_path = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_path))
+
+from otf_map_functions import (otf_mapping_params, otf_mapping_params_grid,
+                               optimize_otf_params)
+from sensitivity_time_functions import (make_the_time_line, make_the_time_array,
+                                        mass_sensitivity_grid, mass_sensitivity_mc,
+                                        h2mass_to_dust_brightness, dust_to_h2mass)
+from detectability_maps import detectability_maps
+from extract_spatial_coverage import extract_spatial_coverage_streaming
+from otf_coverage_maps import otf_coverage_maps
+from otf_coverage_monitor import start_coverage_monitor, poll_coverage_monitor
+from otf_mosaic_regions import tile_otf_footprint, table_to_sma_lines
+from otf_sampling_simulator import simulate_otf_sampling
+from otf_schedule import schedule_otf_maps
+from otf_script_generator import render_scripts
+from otf_semester import otf_project, night_windows, pack_semester
+
+from synthetic_mir import write_synthetic_mir, synthetic_field_centers
+
+
+# Registered benchmarks: (suite, name, setup function, full sizes, quick sizes).
+# The setup function takes the size and a scratch directory and returns the
+# callable to time; setup is not included in the timing.
+_benchmarks = []
+
+
+def benchmark(suite, sizes, quick_sizes=None):
+    '''
+    Register a benchmark setup function.
+    '''
+
+    def wrapper(func):
+        _benchmarks.append((suite, func.__name__, func, sizes,
+                            sizes[:1] if quick_sizes is None else quick_sizes))
+        return func
+
+    return wrapper
+
+
+def time_call(func, repeat=3, max_time=60.):
+    '''
+    Time repeated calls of ``func``.
+
+    Stops early once ``max_time`` (s) has been spent, but always runs once.
+
+    Returns
+    -------
+    out_dict : dict
+        ``min``, ``median`` and ``mean`` time (s) and the number of ``repeat`` runs.
+    '''
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+        if sum(times) > max_time:
+            break
+
+    return dict(min=min(times), median=float(np.median(times)),
+                mean=float(np.mean(times)), repeat=len(times))
+
+
+# Planning
+
+def _otf_sweep_inputs(size):
+    nlength = int(np.sqrt(size))
+    row_length = np.linspace(300, 1200, nlength) * u.arcsec
+    t_dump = np.linspace(0.6, 3., size // nlength) * u.s
+    return row_length, t_dump
+
+
+@benchmark("planning", sizes=[100, 1000], quick_sizes=[100])
+def otf_params_scalar_sweep(size, scratch_path):
+    row_length, t_dump = _otf_sweep_inputs(size)
+
+    def run():
+        with warnings_ignored():
+            for this_length in row_length:
+                for this_dump in t_dump:
+                    otf_mapping_params(this_length, 600 * u.arcsec, 7 * u.hr,
+                                       t_dump=this_dump, verbose=False)
+
+    return run
+
+
+@benchmark("planning", sizes=[100, 1000, 10**5, 10**6], quick_sizes=[100, 10**4])
+def otf_params_grid_sweep(size, scratch_path):
+    row_length, t_dump = _otf_sweep_inputs(size)
+
+    def run():
+        with warnings_ignored():
+            otf_mapping_params_grid(row_length[:, None], 600 * u.arcsec, 7 * u.hr,
+                                    t_dump=t_dump[None, :], as_table=False)
+
+    return run
+
+
+@benchmark("planning", sizes=[1])
+def otf_params_optimize(size, scratch_path):
+
+    def run():
+        with warnings_ignored():
+            optimize_otf_params(1 * u.min, 7 * u.hr, 840 * u.arcsec, 600 * u.arcsec)
+
+    return run
+
+
+@benchmark("planning", sizes=[30, 120], quick_sizes=[30])
+def schedule_tracks(size, scratch_path):
+    # Four bricks of 18 maps, one brick per track
+    centers = synthetic_field_centers(72)
+    names = [f"map{ii}" for ii in range(72)]
+    bricks = [names[ii * 18:(ii + 1) * 18] for ii in range(4)]
+    track_maps = [bricks[tt % 4] for tt in range(size)]
+    # Tracks starting 4 hr before transit of the mosaic center
+    track_lst_start = np.full(size, 0.733 - 4.) * u.hourangle
+
+    def run():
+        schedule_otf_maps(names, centers, track_maps, 12, track_lst_start=track_lst_start)
+
+    return run
+
+
+@benchmark("planning", sizes=[30, 90, 180], quick_sizes=[30])
+def pack_semester_nights(size, scratch_path):
+    # Eight projects spread over the mosaic, sharing two calibrators
+    centers = synthetic_field_centers(8, spacing=2 * u.deg)
+    projects = [otf_project(f"proj{ii}", dict(t_otf_map_total=0.6 * u.hr, N_otf_maps=size // 2),
+                            centers[ii], ["0136+478", "0013+408"])
+                for ii in range(8)]
+    nights = night_windows("2025-09-01T04:00:00", size)
+
+    def run():
+        pack_semester(projects, nights)
+
+    return run
+
+
+# Sensitivity
+
+@benchmark("sensitivity", sizes=[1000], quick_sizes=[100])
+def time_scalar_loop(size, scratch_path):
+    rms = np.linspace(0.01, 1., size) * u.Jy * u.km / u.s
+
+    def run():
+        for this_rms in rms:
+            make_the_time_line(this_rms, 230)
+
+    return run
+
+
+@benchmark("sensitivity", sizes=[10**4, 10**6, 10**7], quick_sizes=[10**4])
+def time_array(size, scratch_path):
+    rms = np.linspace(0.01, 1., size) * u.Jy * u.km / u.s
+    bands = np.array([230, 345, 90])[np.arange(size) % 3]
+
+    def run():
+        make_the_time_array(rms, bands)
+
+    return run
+
+
+@benchmark("sensitivity", sizes=[100, 1000], quick_sizes=[100])
+def dust_scalar_sweep(size, scratch_path):
+    # Tdust x band loop of the scalar dust conversions, as in the notebooks
+    temps = np.linspace(5, 60, max(1, size // 4)) * u.K
+    freqs = [90, 230, 345, 690] * u.GHz
+
+    def run():
+        for tdust in temps:
+            for freq in freqs:
+                flux = h2mass_to_dust_brightness(1e5 * u.solMass, nu=freq, Tdust=tdust)
+                dust_to_h2mass(flux, nu=freq, Tdust=tdust)
+
+    return run
+
+
+@benchmark("sensitivity", sizes=[10**4, 10**6], quick_sizes=[10**4])
+def mass_grid(size, scratch_path):
+    # mh2 x beam_size x distance x Tdust x band (3)
+    nother = 10
+    nmass = max(1, size // (3 * nother**3))
+
+    def run():
+        with warnings_ignored():
+            mass_sensitivity_grid(np.logspace(3, 7, nmass) * u.solMass,
+                                  distance=np.linspace(0.5, 10, nother) * u.Mpc,
+                                  beam_size=np.linspace(1, 10, nother) * u.arcsec,
+                                  Tdust=np.linspace(10, 40, nother) * u.K,
+                                  band=[230, 345, "230_curr"],
+                                  int_time=10 * u.hr)
+
+    return run
+
+
+@benchmark("sensitivity", sizes=[10**4, 10**5, 10**6], quick_sizes=[10**4])
+def mass_mc(size, scratch_path):
+    def run():
+        mass_sensitivity_mc(1e5 * u.solMass, n_samples=size, band=[230, 345, "230_curr"],
+                            int_time=10 * u.hr, seed=0)
+
+    return run
+
+
+@benchmark("sensitivity", sizes=[10**6, 10**7], quick_sizes=[10**6])
+def detect_maps(size, scratch_path):
+    # Sigma_H2 image with ``size`` pixels
+    npix = int(np.sqrt(size))
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [10.68, 41.27]
+    wcs.wcs.cdelt = [-1 / 3600., 1 / 3600.]
+    wcs.wcs.crpix = [npix / 2., npix / 2.]
+
+    header = wcs.to_header()
+    header['BUNIT'] = 'solMass / pc2'
+
+    input_filename = scratch_path / f"sigma_h2_{size}.fits"
+    hdu = fits.PrimaryHDU(header=header)
+    hdu.data = np.random.default_rng(0).uniform(0.1, 100., (npix, npix)).astype(np.float32)
+    hdu.writeto(input_filename, overwrite=True)
+
+    def run():
+        with quiet():
+            detectability_maps(input_filename, scratch_path / f"detect_{size}.fits",
+                               int_time=10 * u.hr)
+
+    return run
+
+
+# Coverage
+
+@benchmark("coverage", sizes=[10**4, 10**5, 10**6, 10**7], quick_sizes=[10**4, 10**5])
+def extract_coverage(size, scratch_path):
+    mir_filename = write_synthetic_mir(scratch_path / f"synthetic_{size}.mir", size)
+    output_path = scratch_path / f"coverage_{size}"
+    output_path.mkdir(exist_ok=True)
+
+    def run():
+        with quiet():
+            extract_spatial_coverage_streaming(mir_filename, output_path=output_path,
+                                               chunk_size=10**6, verbose=False)
+
+    return run
+
+
+@benchmark("coverage", sizes=[10**4, 10**5, 10**6, 10**7], quick_sizes=[10**4, 10**5])
+def extract_coverage_npy(size, scratch_path):
+    mir_filename = write_synthetic_mir(scratch_path / f"synthetic_{size}.mir", size)
+    output_path = scratch_path / f"coverage_{size}"
+    output_path.mkdir(exist_ok=True)
+
+    def run():
+        with quiet():
+            extract_spatial_coverage_streaming(mir_filename, output_path=output_path,
+                                               chunk_size=10**6, verbose=False,
+                                               output_format="npy")
+
+    return run
+
+
+@benchmark("coverage", sizes=[10**5, 10**6, 10**7], quick_sizes=[10**5])
+def coverage_maps(size, scratch_path):
+    centers = synthetic_field_centers(20)
+    n_maps = max(1, size // 3000)
+    targets = centers[np.arange(n_maps) % len(centers)]
+
+    with quiet():
+        coords, _ = simulate_otf_sampling(targets, 840 * u.arcsec, 27.5 * u.arcsec, 22,
+                                          11.45 * u.arcsec / u.s, pos_angle=144 * u.deg)
+
+    ra = coords['ra'].quantity
+    dec = coords['dec'].quantity
+
+    def run():
+        otf_coverage_maps(ra, dec, pixel_scale=5 * u.arcsec)
+
+    return run
+
+
+@benchmark("coverage", sizes=[10, 100, 1000, 10**4], quick_sizes=[100])
+def monitor_poll(size, scratch_path):
+    # One poll of the live monitor picking up ``size`` new integrations
+    mir_filename = write_synthetic_mir(scratch_path / "synthetic_monitor.mir", 2 * 10**4)
+
+    otf_params = dict(row_length=840 * u.arcsec, row_offset=27.5 * u.arcsec, n_rows=22,
+                      scan_speed=11.45 * u.arcsec / u.s, pos_angle=144 * u.deg,
+                      t_dump=0.6 * u.s)
+    state = start_coverage_monitor(mir_filename, otf_params=otf_params,
+                                   target_coords=synthetic_field_centers(20))
+
+    in_size = (mir_filename / "in_read").stat().st_size
+    sp_size = (mir_filename / "sp_read").stat().st_size
+
+    def run():
+        state['in_offset'] = in_size - size * in_dtype.itemsize
+        state['sp_offset'] = sp_size - size * sp_dtype.itemsize
+        state['pending'] = state['pending'][:0]
+        state['call'] = None
+        state['prev_call'] = None
+        with quiet():
+            poll_coverage_monitor(state, final=True)
+
+    return run
+
+
+# Script generation
+
+def _mosaic_footprint(size):
+    '''
+    Rectangular footprint holding about ``size`` 840" x 600" maps.
+    '''
+
+    from regions import RectangleSkyRegion
+
+    side = np.sqrt(size * 840 * 600) * u.arcsec
+
+    return RectangleSkyRegion(SkyCoord("0h44m00s +41d30m00s"), width=1.4 * side,
+                              height=side / 1.4, angle=38 * u.deg)
+
+
+@benchmark("scripts", sizes=[100, 1000], quick_sizes=[100])
+def tile_mosaic(size, scratch_path):
+    footprint = _mosaic_footprint(size)
+
+    def run():
+        with warnings_ignored():
+            tile_otf_footprint(footprint, 7 * u.hr, 12,
+                               row_length=840 * u.arcsec, row_width=600 * u.arcsec)
+
+    return run
+
+
+@benchmark("scripts", sizes=[1000, 10**4], quick_sizes=[1000])
+def mosaic_target_lines(size, scratch_path):
+    centers = synthetic_field_centers(size, spacing=300 * u.arcsec)
+    table = Table()
+    table['label'] = [f"Map-{ii}" for ii in range(size)]
+    table['ra'] = centers.ra
+    table['dec'] = centers.dec
+    table['width'] = np.full(size, 840.) * u.arcsec
+    table['height'] = np.full(size, 600.) * u.arcsec
+    table['angle'] = np.full(size, 54.) * u.deg
+
+    def run():
+        table_to_sma_lines(table)
+
+    return run
+
+
+@benchmark("scripts", sizes=[100, 1000], quick_sizes=[100])
+def render_mosaic_scripts(size, scratch_path):
+    # Tracks of 12 maps each, as for the M31 bricks
+    names = [f"M31-Map-{ii} -r 0:44:00.00 -d 41:30:00.0 -e 2000 -v -296" for ii in range(12)]
+    config = {"output_path": str(scratch_path / "scripts"),
+              "template_path": str(repo_path / "m31_observing_scripts"),
+              "defaults": {"template": "m31_otf_sub_basetemplate.pl",
+                           "variables": {"posAngle0": 54}},
+              "scripts": [{"output": f"track_{ii}.pl", "targets": names}
+                          for ii in range(size)]}
+
+    def run():
+        render_scripts(config, n_workers=1)
+
+    return run
+
+
+@benchmark("scripts", sizes=[100, 1000], quick_sizes=[100])
+def simulate_mosaic_sampling(size, scratch_path):
+    # size = number of maps observed
+    centers = synthetic_field_centers(72)
+    targets = centers[np.arange(size) % len(centers)]
+
+    def run():
+        simulate_otf_sampling(targets, 840 * u.arcsec, 27.5 * u.arcsec, 22,
+                              11.45 * u.arcsec / u.s, pos_angle=144 * u.deg)
+
+    return run
+
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    Hide the progress printed or logged by the benchmarked functions.
+    '''
+
+    logging.disable(logging.WARNING)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+@contextlib.contextmanager
+def warnings_ignored():
+    import warnings
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
+
+
+def run_info():
+    '''
+    Environment of this run, for comparing results over time.
+    '''
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_path,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+
+    import astropy
+
+    return dict(date=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                commit=commit,
+                python=platform.python_version(),
+                numpy=np.__version__,
+                astropy=astropy.__version__,
+                platform=platform.platform(),
+                processor=platform.processor(),
+                cpu_count=os.cpu_count())
+
+
+def run_benchmarks(suites=None, names=None, quick=False, repeat=3, max_time=60.,
+                   scratch_path=None):
+    '''
+    Run the registered benchmarks.
+
+    Parameters
+    ----------
+    suites : list, optional
+        Only run these suites ("planning", "sensitivity", "coverage", "scripts").
+    names : list, optional
+        Only run benchmarks whose name contains one of these strings.
+    quick : bool
+        Use the small sizes only (a smoke test).
+    repeat : int
+        Timed runs per benchmark.
+    max_time : float
+        Stop repeating a benchmark after this many seconds.
+    scratch_path : str or Path, optional
+        Directory for the synthetic data and outputs. Defaults to a
+        temporary directory that is removed afterwards.
+
+    Returns
+    -------
+    results : list
+        One dict per benchmark and size.
+    '''
+
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=scratch_path) as tmp_path:
+
+        for suite, name, setup, sizes, quick_sizes in _benchmarks:
+            if suites is not None and suite not in suites:
+                continue
+            if names is not None and not any(this_name in name for this_name in names):
+                continue
+
+            for size in (quick_sizes if quick else sizes):
+                this_path = Path(tmp_path) / f"{name}_{size}"
+                this_path.mkdir()
+
+                func = setup(size, this_path)
+                timing = time_call(func, repeat=repeat, max_time=max_time)
+
+                results.append(dict(suite=suite, name=name, size=size, **timing))
+
+                print(f"{suite:12s} {name:28s} {size:>10d}  "
+                      f"{timing['min']:10.4f} s  (median {timing['median']:.4f} s, "
+                      f"{timing['repeat']} runs)")
+
+                # Synthetic datasets at 10^7 integrations are several GB
+                for filename in sorted(this_path.rglob("*"), reverse=True):
+                    if filename.is_file():
+                        filename.unlink()
+
+    return results
+
+
+def write_results(results, output_path):
+    '''
+    Write the results and run info to a JSON file named by the date and commit.
+    '''
+
+    info = run_info()
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    stamp = info['date'].replace(":", "").replace("-", "").split("+")[0]
+    filename = output_path / f"{stamp}_{info['commit']}.json"
+
+    with open(filename, "w") as f:
+        json.dump(dict(info=info, results=results), f, indent=1)
+
+    return filename
+
+
+def compare_results(results, reference_filename):
+    '''
+    Print the time ratio to an earlier results file.
+
+    Returns
+    -------
+    comparison : `~astropy.table.Table`
+        Minimum times of the benchmarks in both runs and their ratio (new / old).
+    '''
+
+    with open(reference_filename, "r") as f:
+        reference = json.load(f)
+
+    old_times = {(row['name'], row['size']): row['min'] for row in reference['results']}
+
+    rows = []
+    for row in results:
+        key = (row['name'], row['size'])
+        if key not in old_times:
+            continue
+        rows.append([row['name'], row['size'], old_times[key], row['min'],
+                     row['min'] / old_times[key]])
+
+    comparison = Table(rows=rows if rows else None,
+                       names=['name', 'size', 'old', 'new', 'ratio'],
+                       dtype=[str, int, float, float, float])
+    comparison['old'].unit = u.s
+    comparison['new'].unit = u.s
+    for name in ['old', 'new']:
+        comparison[name].format = '.4f'
+    comparison['ratio'].format = '.2f'
+
+    print(f"Compared to {reference['info']['commit']} ({reference['info']['date']}):")
+    comparison.pprint(max_lines=-1, max_width=-1)
+
+    return comparison
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the planning, sensitivity, coverage and script generation code.")
+    parser.add_argument("--suite", nargs='+', default=None,
+                        choices=["planning", "sensitivity", "coverage", "scripts"])
+    parser.add_argument("--name", nargs='+', default=None,
+                        help="Only run benchmarks with names containing these strings.")
+    parser.add_argument("--quick", action='store_true', help="Small sizes only.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-time", type=float, default=60.,
+                        help="Stop repeating a benchmark after this many seconds.")
+    parser.add_argument("--scratch-path", default=None,
+                        help="Directory for the synthetic data (needs ~6 GB for 10^7 integrations).")
+    parser.add_argument("--output-path", default=Path(__file__).parent / "results")
+    parser.add_argument("--compare", default=None,
+                        help="Earlier results file to compare to.")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(suites=args.suite, names=args.name, quick=args.quick,
+                             repeat=args.repeat, max_time=args.max_time,
+                             scratch_path=args.scratch_path)
+
+    filename = write_results(results, args.output_path)
+    print(f"Wrote {filename}")
+
+    if args.compare is not None:
+        compare_results(results, args.compare)
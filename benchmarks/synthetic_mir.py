@@ -0,0 +1,210 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from pyuvdata.uvdata.mir_meta_data import in_dtype, sp_dtype
+
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from otf_sampling_simulator import otf_dump_offsets
+
+
+def synthetic_field_centers(n_fields, center=SkyCoord("0h44m00s +41d30m00s"),
+                            spacing=600 * u.arcsec, pos_angle=54 * u.deg):
+    '''
+    Map centers on a rotated grid, like a mosaic of OTF bricks.
+
+    Parameters
+    ----------
+    n_fields : int
+        Number of maps.
+    center : `~astropy.coordinates.SkyCoord`
+        Center of the mosaic.
+    spacing : `~astropy.units.Quantity`
+        Distance between neighbouring maps.
+    pos_angle : `~astropy.units.Quantity`
+        Rotation of the grid.
+
+    Returns
+    -------
+    coords : `~astropy.coordinates.SkyCoord`
+        Map centers.
+    '''
+
+    ncol = int(np.ceil(np.sqrt(n_fields)))
+    idx = np.arange(n_fields)
+    col = idx % ncol - 0.5 * (ncol - 1)
+    row = idx // ncol - 0.5 * (ncol - 1)
+
+    pa = pos_angle.to_value(u.rad)
+    dx = (col * np.cos(pa) - row * np.sin(pa)) * spacing
+    dy = (col * np.sin(pa) + row * np.cos(pa)) * spacing
+
+    return center.spherical_offsets_by(dx, dy)
+
+
+def _synthetic_map_sequence(n_gain_int, t_gain_int, row_length, row_offset, n_rows,
+                            scan_speed, t_dump, pos_angle):
+    '''
+    Integrations for one target of observeTargetLoopOTFInterleaveMulti:
+    gain scan, even rows, gain scan, odd rows.
+    '''
+
+    pieces = []
+    t_start = 0.
+    for n_half, start_row in [(n_rows // 2, 0.), (n_rows - n_rows // 2, 0.5)]:
+        # Gain scan
+        pieces.append(dict(is_gain=np.ones(n_gain_int, dtype=bool),
+                           offx=np.zeros(n_gain_int), offy=np.zeros(n_gain_int),
+                           time=t_start + (np.arange(n_gain_int) + 0.5) * t_gain_int,
+                           rinteg=np.full(n_gain_int, t_gain_int)))
+        t_start += n_gain_int * t_gain_int
+
+        offx, offy, time, _ = otf_dump_offsets(row_length, 2 * row_offset, n_half, scan_speed,
+                                               t_dump=t_dump, pos_angle=pos_angle,
+                                               start_row=start_row)
+        pieces.append(dict(is_gain=np.zeros(offx.size, dtype=bool),
+                           offx=offx, offy=offy, time=t_start + time,
+                           rinteg=np.full(offx.size, t_dump.to_value(u.s))))
+        t_start += time.max() + 0.5 * t_dump.to_value(u.s)
+
+    sequence = {key: np.concatenate([piece[key] for piece in pieces]) for key in pieces[0]}
+
+    return sequence, t_start
+
+
+def write_synthetic_mir(mir_filename, n_int,
+                        n_fields=20,
+                        n_gain_int=4,
+                        sp_per_int=1,
+                        flag_fraction=0.02,
+                        row_length=840 * u.arcsec,
+                        row_offset=27.5 * u.arcsec,
+                        n_rows=22,
+                        scan_speed=11.45 * u.arcsec / u.s,
+                        t_dump=0.6 * u.s,
+                        pos_angle=144 * u.deg,
+                        chunk_size=1000000,
+                        delay=None,
+                        seed=0):
+    '''
+    Write the in_read and sp_read header files of a MIR-like OTF dataset.
+
+    Only the header records read by `extract_spatial_coverage.py` are
+    written, so no real data is needed to exercise the coverage code. The
+    integrations follow observeTargetLoopOTFInterleaveMulti: for each map,
+    cycling through the field centers, a gain scan of ``n_gain_int``
+    integrations (rinteg = 30 s), the even rows, another gain scan and the
+    odd rows, with the dump positions and times of `otf_dump_offsets`.
+    A random ``flag_fraction`` of the spectral records are flagged. The
+    files are written ``chunk_size`` integrations at a time so datasets
+    of 10^7 integrations do not need to fit in memory.
+
+    Parameters
+    ----------
+    mir_filename : str or Path
+        Output MIR dataset directory.
+    n_int : int
+        Number of integrations (in_read records).
+    n_fields : int
+        Number of OTF maps.
+    n_gain_int : int
+        Integrations per gain scan.
+    sp_per_int : int
+        Spectral records (sp_read) per integration.
+    flag_fraction : float
+        Fraction of flagged spectral records.
+    row_length, row_offset, n_rows, scan_speed, t_dump, pos_angle
+        OTF pattern of the full map. See `interleaved_dump_offsets`.
+    chunk_size : int
+        Integrations written at a time.
+    delay : float, optional
+        Seconds to wait after each chunk, to mimic a dataset being written
+        during a track (e.g. for `otf_coverage_monitor.py`).
+    seed : int
+        Random seed for the flags.
+
+    Returns
+    -------
+    mir_filename : Path
+        The dataset directory.
+    '''
+
+    mir_filename = Path(mir_filename)
+    mir_filename.mkdir(parents=True, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+
+    t_gain_int = 30.
+    sequence, period_time = _synthetic_map_sequence(n_gain_int, t_gain_int, row_length,
+                                                    row_offset, n_rows, scan_speed,
+                                                    t_dump, pos_angle)
+    period = sequence['offx'].size
+
+    centers = synthetic_field_centers(n_fields)
+    rar = centers.ra.to_value(u.rad)
+    decr = centers.dec.to_value(u.rad)
+    gain_center = SkyCoord("1h36m58.6s +47d51m29s")
+
+    with open(mir_filename / "in_read", "wb") as in_file, \
+            open(mir_filename / "sp_read", "wb") as sp_file:
+
+        for start in range(0, n_int, chunk_size):
+            idx = np.arange(start, min(start + chunk_size, n_int))
+
+            this_map, pos = np.divmod(idx, period)
+            is_gain = sequence['is_gain'][pos]
+
+            records = np.zeros(idx.size, dtype=in_dtype)
+            records['inhid'] = idx + 1
+            records['ints'] = idx + 1
+            records['rinteg'] = sequence['rinteg'][pos]
+            records['offx'] = sequence['offx'][pos]
+            records['offy'] = sequence['offy'][pos]
+            records['rar'] = np.where(is_gain, gain_center.ra.to_value(u.rad),
+                                      rar[this_map % n_fields])
+            records['decr'] = np.where(is_gain, gain_center.dec.to_value(u.rad),
+                                       decr[this_map % n_fields])
+            records['epoch'] = 2000.
+            records['mjd'] = 60000. + (this_map * period_time + sequence['time'][pos]) / 86400.
+            records.tofile(in_file)
+
+            spec = np.zeros(idx.size * sp_per_int, dtype=sp_dtype)
+            spec['inhid'] = np.repeat(idx + 1, sp_per_int)
+            spec['flags'] = rng.random(spec.size) < flag_fraction
+            spec.tofile(sp_file)
+
+            if delay is not None:
+                in_file.flush()
+                sp_file.flush()
+                time.sleep(delay)
+
+    return mir_filename
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write a synthetic MIR-like OTF dataset (in_read and sp_read only).")
+    parser.add_argument("mir_filename", help="Output MIR dataset directory.")
+    parser.add_argument("n_int", type=float, help="Number of integrations, e.g. 1e6.")
+    parser.add_argument("--n-fields", type=int, default=20)
+    parser.add_argument("--sp-per-int", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=1000000)
+    parser.add_argument("--delay", type=float, default=None,
+                        help="Seconds between chunks, to follow with otf_coverage_monitor.py.")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    write_synthetic_mir(args.mir_filename, int(args.n_int),
+                        n_fields=args.n_fields,
+                        sp_per_int=args.sp_per_int,
+                        chunk_size=args.chunk_size,
+                        delay=args.delay,
+                        seed=args.seed)
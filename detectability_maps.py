@@ -0,0 +1,421 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from otf_instrumentation import count, stage, get_logger, timed
+from sensitivity_time_functions import (h2mass_to_co_brightness, h2mass_to_dust_brightness,
+                                        get_Tpeak_gaussian, make_the_time_line,
+                                        make_the_time_continuum, time_to_rms,
+                                        wsma_1kms_rms, wsma_continuum_rms,
+                                        kappa_laws, band_co_lines, FWHM_TO_AREA,
+                                        gaussian_beam_sr, R21_l22, R32_l22)
+
+
+logger = get_logger("detectability_maps")
+
+
+# Every relation used here is linear in the H2 mass per beam, so each output
+# plane is a constant times the mass (brightness, S/N) or times 1 / mass^2
+# (required time). The constants are evaluated once with the scalar
+# relations and the images are then processed block by block.
+
+_FITS_BLOCK = 2880
+
+
+def detectability_factors(distance=0.78 * u.Mpc,
+                          beam_size=5 * u.arcsec,
+                          alpha_CO=4.35 * (u.solMass / u.pc**2) / (u.K * u.km / u.s),
+                          R21=R21_l22,
+                          R32=R32_l22,
+                          Tdust=20 * u.K,
+                          kappa_law='chiang18',
+                          gdr=100,
+                          bands=(230, 345),
+                          sigma=4.5 * u.km / u.s,
+                          snr=5.,
+                          int_time=None):
+    '''
+    Brightness, required time and S/N of each product for 1 Msun of H2 per beam.
+
+    Uses `h2mass_to_co_brightness`, `h2mass_to_dust_brightness` and the
+    `make_the_time_line` / `make_the_time_continuum` scalings.
+
+    Returns
+    -------
+    factors : dict
+        ``{extname: (factor, power, unit)}``. The value of a product for a
+        mass ``M`` (Msun) per beam is ``factor * M**power``.
+    '''
+
+    mh2 = 1 * u.solMass
+
+    co = h2mass_to_co_brightness(mh2, alpha_CO=alpha_CO, R21=R21, R32=R32,
+                                 distance=distance, beam_size=beam_size, to_jy=True)
+
+    factors = {}
+    for band in bands:
+        line_name = band_co_lines.get(band)
+        if line_name is not None and band in wsma_1kms_rms:
+            intint = co[line_name].to(u.Jy * u.km / u.s)
+            # The line rms is per 1 km/s channel, as in `mass_sensitivity_grid`
+            tpeak = get_Tpeak_gaussian(intint, sigma=sigma).to(u.Jy) * (u.km / u.s)
+
+            factors[f'{line_name}_INTINT'] = (intint.value, 1, intint.unit / u.beam)
+            time = make_the_time_line(tpeak / snr, band)
+            factors[f'{line_name}_TIME'] = (time.to_value(u.hr), -2, u.hr)
+            if int_time is not None:
+                rms = time_to_rms(int_time, band)
+                factors[f'{line_name}_SNR'] = ((tpeak / rms).to_value(u.one), 1, u.one)
+
+        if band in wsma_continuum_rms:
+            freq = float(str(band).split('_')[0]) * u.GHz
+            flux = h2mass_to_dust_brightness(mh2, nu=freq, gdr=gdr, Tdust=Tdust,
+                                             kappa_nu=kappa_laws[kappa_law],
+                                             distance=distance, beam_size=beam_size)
+
+            factors[f'CONT{band}_FLUX'] = (flux.to_value(u.Jy), 1, u.Jy / u.beam)
+            time = make_the_time_continuum(flux / snr, band)
+            factors[f'CONT{band}_TIME'] = (time.to_value(u.hr), -2, u.hr)
+            if int_time is not None:
+                rms = time_to_rms(int_time, band, rms_band_dict=wsma_continuum_rms)
+                factors[f'CONT{band}_SNR'] = ((flux / rms).to_value(u.one), 1, u.one)
+
+    return factors
+
+
+def input_mass_factor(input_type, input_unit,
+                      input_freq=None,
+                      distance=0.78 * u.Mpc,
+                      beam_size=5 * u.arcsec,
+                      Tdust=20 * u.K,
+                      kappa_law='chiang18',
+                      gdr=100):
+    '''
+    Factor from the input image values to the H2 mass per beam in Msun.
+
+    Parameters
+    ----------
+    input_type : {'sigma_h2', 'dust'}
+        H2 surface density, or dust continuum at ``input_freq``. The dust is
+        converted by inverting `h2mass_to_dust_brightness`, so the predicted
+        continuum at ``input_freq`` reproduces the input.
+    input_unit : `~astropy.units.Unit`
+        Unit of the image, e.g. Msun / pc2, MJy / sr or Jy / beam.
+    input_freq : `~astropy.units.Quantity`
+        Frequency of the dust image.
+    distance, beam_size, Tdust, kappa_law, gdr
+        See `detectability_factors`.
+    '''
+
+    if input_type == 'sigma_h2':
+        beam_area = FWHM_TO_AREA * (beam_size.to_value(u.rad) * distance)**2
+        return (1 * input_unit * beam_area).to_value(u.solMass)
+
+    if input_type == 'dust':
+        if input_freq is None:
+            raise ValueError("input_freq is needed for a dust image.")
+
+        flux_per_msun = h2mass_to_dust_brightness(1 * u.solMass, nu=input_freq, gdr=gdr,
+                                                  Tdust=Tdust, kappa_nu=kappa_laws[kappa_law],
+                                                  distance=distance, beam_size=beam_size)
+
+        if input_unit.is_equivalent(u.Jy / u.sr):
+            flux = (1 * input_unit * gaussian_beam_sr(beam_size)).to(u.Jy)
+        else:
+            # Jy / beam at the resolution beam_size
+            flux = (1 * input_unit * u.beam).to(u.Jy)
+
+        return (flux / flux_per_msun).to_value(u.one)
+
+    raise ValueError(f"input_type must be 'sigma_h2' or 'dust', not {input_type}.")
+
+
+def _image_hdu_header(wcs_header, shape, extname, unit):
+    '''
+    Header of a float32 image extension with ``shape`` and the input WCS.
+    '''
+
+    # Header from a 1-pixel placeholder; only the axis sizes change
+    header = fits.ImageHDU(data=np.zeros((1, 1), dtype='>f4')).header
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    header.extend(wcs_header, update=True)
+    header['EXTNAME'] = extname
+    header['BUNIT'] = unit.to_string()
+
+    return header
+
+
+def allocate_fits_images(filename, wcs_header, shape, extensions, meta=None):
+    '''
+    Write the headers of a multi-extension FITS file and reserve the image data.
+
+    The data are not written, so the file is created sparse and zero-filled
+    and can be filled block by block through `open_fits_image`.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Output file.
+    wcs_header : `~astropy.io.fits.Header`
+        Celestial WCS of the images.
+    shape : tuple
+        Image shape (ny, nx).
+    extensions : dict
+        ``{extname: unit}`` of the image extensions, in order.
+    meta : dict, optional
+        Keywords for the primary header.
+
+    Returns
+    -------
+    offsets : dict
+        Byte offset of the data of each extension.
+    '''
+
+    primary = fits.PrimaryHDU().header
+    primary['EXTEND'] = True
+    for key, value in (meta or {}).items():
+        primary[key] = value
+
+    nbytes = shape[0] * shape[1] * 4
+    padded = -(-nbytes // _FITS_BLOCK) * _FITS_BLOCK
+
+    offsets = {}
+    with open(filename, "wb") as f:
+        f.write(primary.tostring().encode('ascii'))
+        for extname, unit in extensions.items():
+            header = _image_hdu_header(wcs_header, shape, extname, unit)
+            f.write(header.tostring().encode('ascii'))
+            offsets[extname] = f.tell()
+            f.seek(padded, 1)
+        f.truncate()
+
+    return offsets
+
+
+def open_fits_image(filename, offset, shape):
+    '''
+    Memory map one image written by `allocate_fits_images` for writing.
+    '''
+
+    return np.memmap(filename, dtype='>f4', mode='r+', offset=offset, shape=tuple(shape))
+
+
+def _read_input_image(filename):
+    '''
+    Memory-mapped 2D image, WCS header and unit of a FITS file.
+    '''
+
+    hdulist = fits.open(filename, memmap=True)
+    hdu = next(hdu for hdu in hdulist if hdu.data is not None)
+
+    data = hdu.data
+    # Drop degenerate spectral / Stokes axes
+    if data.ndim > 2:
+        data = data[(0,) * (data.ndim - 2)]
+
+    wcs_header = WCS(hdu.header).celestial.to_header()
+    unit = u.Unit(hdu.header['BUNIT'], parse_strict='silent') if 'BUNIT' in hdu.header else None
+
+    return hdulist, data, wcs_header, unit
+
+
+def _detectability_block(input_filename, output_filename, offsets, shape, row_start, row_end,
+                         mass_factor, factors):
+    '''
+    Fill rows ``row_start:row_end`` of every output image.
+    '''
+
+    hdulist, data, _, _ = _read_input_image(input_filename)
+
+    with stage("detect.read"):
+        mass = np.asarray(data[row_start:row_end], dtype=np.float64) * mass_factor
+    hdulist.close()
+
+    with stage("detect.compute"):
+        bad = ~(mass > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_mass_sq = 1. / mass**2
+        inv_mass_sq[bad] = np.nan
+
+        for extname, (factor, power, _) in factors.items():
+            out = open_fits_image(output_filename, offsets[extname], shape)
+            if power == 1:
+                out[row_start:row_end] = factor * mass
+            else:
+                out[row_start:row_end] = factor * inv_mass_sq
+            out.flush()
+            del out
+
+    count("detect.pixels", mass.size)
+    count("detect.bad_pixels", int(bad.sum()))
+
+    return row_end - row_start
+
+
+@timed('detect.maps')
+def detectability_maps(input_filename, output_filename,
+                       input_type='sigma_h2',
+                       input_unit=None,
+                       input_freq=None,
+                       distance=0.78 * u.Mpc,
+                       beam_size=5 * u.arcsec,
+                       alpha_CO=4.35 * (u.solMass / u.pc**2) / (u.K * u.km / u.s),
+                       R21=R21_l22,
+                       R32=R32_l22,
+                       Tdust=20 * u.K,
+                       kappa_law='chiang18',
+                       gdr=100,
+                       bands=(230, 345),
+                       sigma=4.5 * u.km / u.s,
+                       snr=5.,
+                       int_time=None,
+                       chunk_rows=None,
+                       n_workers=1):
+    '''
+    Per-pixel brightness, required time and S/N maps from a Sigma_H2 or dust image.
+
+    Each pixel is treated as the mass within one beam of ``beam_size``. The
+    input is memory mapped and processed in blocks of rows, and the results
+    are written straight into a preallocated multi-extension FITS file, so
+    memory use is set by ``chunk_rows`` and not by the image size.
+
+    Parameters
+    ----------
+    input_filename : str or Path
+        FITS image. Degenerate extra axes are dropped.
+    output_filename : str or Path
+        Output FITS file, with one image extension per product:
+        ``CO21_INTINT`` (Jy km/s / beam), ``CO21_TIME`` (hr), ``CO21_SNR``
+        and ``CONT230_FLUX`` (Jy / beam), ``CONT230_TIME``, ``CONT230_SNR``,
+        and the same for 345 GHz (CO32). The S/N maps need ``int_time``.
+        Pixels without positive emission have NaN times.
+    input_type : {'sigma_h2', 'dust'}
+        See `input_mass_factor`.
+    input_unit : `~astropy.units.Unit`, optional
+        Unit of the image. Defaults to BUNIT, or Msun / pc2 for Sigma_H2.
+    input_freq : `~astropy.units.Quantity`, optional
+        Frequency of a dust image.
+    distance, beam_size, alpha_CO, R21, R32, Tdust, kappa_law, gdr, sigma, snr
+        See `mass_sensitivity_grid`.
+    bands : tuple
+        Bands for the CO line (``band_co_lines``) and continuum products.
+    int_time : `~astropy.units.Quantity`, optional
+        Integration time for the S/N maps.
+    chunk_rows : int, optional
+        Rows per block. Defaults to blocks of about 4 million pixels.
+    n_workers : int
+        Number of processes. Each writes its own rows of the output.
+
+    Returns
+    -------
+    output_filename : Path
+        The output FITS file.
+    '''
+
+    output_filename = Path(output_filename)
+
+    hdulist, data, wcs_header, header_unit = _read_input_image(input_filename)
+    shape = data.shape
+    hdulist.close()
+
+    if input_unit is None:
+        input_unit = header_unit
+    if input_unit is None:
+        if input_type != 'sigma_h2':
+            raise ValueError("The input has no BUNIT. Give input_unit.")
+        input_unit = u.solMass / u.pc**2
+
+    mass_factor = input_mass_factor(input_type, input_unit, input_freq=input_freq,
+                                    distance=distance, beam_size=beam_size, Tdust=Tdust,
+                                    kappa_law=kappa_law, gdr=gdr)
+
+    factors = detectability_factors(distance=distance, beam_size=beam_size, alpha_CO=alpha_CO,
+                                    R21=R21, R32=R32, Tdust=Tdust, kappa_law=kappa_law,
+                                    gdr=gdr, bands=bands, sigma=sigma, snr=snr,
+                                    int_time=int_time)
+
+    meta = dict(INTYPE=input_type,
+                DIST=(distance.to_value(u.Mpc), 'Mpc'),
+                BEAMSIZE=(beam_size.to_value(u.arcsec), 'arcsec'),
+                TDUST=(Tdust.to_value(u.K), 'K'),
+                KAPPA=kappa_law,
+                GDR=gdr,
+                SNR=snr)
+    if int_time is not None:
+        meta['INTTIME'] = (int_time.to_value(u.hr), 'hr')
+
+    offsets = allocate_fits_images(output_filename, wcs_header, shape,
+                                   {extname: unit for extname, (_, _, unit) in factors.items()},
+                                   meta=meta)
+
+    if chunk_rows is None:
+        chunk_rows = max(1, 4 * 1024**2 // shape[1])
+
+    blocks = [(start, min(start + chunk_rows, shape[0])) for start in range(0, shape[0], chunk_rows)]
+
+    logger.info(f"Writing {len(factors)} maps of {shape[0]} x {shape[1]} pixels "
+                f"in {len(blocks)} blocks to {output_filename}")
+
+    args = (input_filename, output_filename, offsets, shape)
+
+    if n_workers == 1 or len(blocks) < 2:
+        for start, end in blocks:
+            _detectability_block(*args, start, end, mass_factor, factors)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_detectability_block, *args, start, end,
+                                       mass_factor, factors)
+                       for start, end in blocks]
+            for future in futures:
+                # Raise any errors from the workers here.
+                future.result()
+
+    return output_filename
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(description="Per-pixel required time and S/N maps for CO "
+                                                 "and dust continuum from a Sigma_H2 or dust image.")
+    parser.add_argument("input_filename", help="FITS image of Sigma_H2 or dust emission.")
+    parser.add_argument("output_filename", help="Output multi-extension FITS file.")
+    parser.add_argument("--input-type", choices=['sigma_h2', 'dust'], default='sigma_h2')
+    parser.add_argument("--input-unit", default=None,
+                        help="Unit of the image if there is no BUNIT, e.g. 'MJy/sr'.")
+    parser.add_argument("--input-freq", type=float, default=None,
+                        help="Frequency of the dust image in GHz.")
+    parser.add_argument("--distance", type=float, default=0.78, help="Mpc")
+    parser.add_argument("--beam-size", type=float, default=5., help="arcsec")
+    parser.add_argument("--Tdust", type=float, default=20., help="K")
+    parser.add_argument("--kappa-law", choices=list(kappa_laws), default='chiang18')
+    parser.add_argument("--int-time", type=float, default=None,
+                        help="Integration time in hr for the S/N maps.")
+    parser.add_argument("--snr", type=float, default=5.)
+    parser.add_argument("--chunk-rows", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    detectability_maps(args.input_filename, args.output_filename,
+                       input_type=args.input_type,
+                       input_unit=None if args.input_unit is None else u.Unit(args.input_unit),
+                       input_freq=None if args.input_freq is None else args.input_freq * u.GHz,
+                       distance=args.distance * u.Mpc,
+                       beam_size=args.beam_size * u.arcsec,
+                       Tdust=args.Tdust * u.K,
+                       kappa_law=args.kappa_law,
+                       int_time=None if args.int_time is None else args.int_time * u.hr,
+                       snr=args.snr,
+                       chunk_rows=args.chunk_rows,
+                       n_workers=args.workers)
@@ -1,76 +1,883 @@
 
 import numpy as np
 
-from pyuvdata.uvdata.mir_meta_data import MirInData
+from pyuvdata.uvdata.mir_meta_data import MirInData, in_dtype, sp_dtype, we_dtype
 from pyuvdata.uvdata.mir_parser import MirParser
 
 from astropy.coordinates import SkyCoord
-from astropy.table import Table, Column, vstack
+from astropy.io import fits
+from astropy.table import Table, Column
 import astropy.units as u
 
 
-import sys
+import argparse
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-mir_filename = Path(sys.argv[1])
+from otf_coords_io import (open_otf_coords_npy, close_otf_coords_npy, write_otf_coords_npy,
+                           read_otf_coords, otf_coords_columns)
+from otf_instrumentation import (count, stage, get_logger, is_enabled, enable, reset,
+                                 snapshot, merge_snapshot, timing_report,
+                                 write_timing_report)
 
-print(f"Reading {mir_filename}")
 
-mir_data = MirParser(mir_filename)
+logger = get_logger("extract_spatial_coverage")
 
-print("Selecting data")
-mir_data.select([("rinteg","lt", 2), ("flags", "eq", 0)])
-offx, offy, rar, decr = mir_data.in_data[["offx","offy","rar","decr"]]
 
-# otf_mask = out._data['rinteg'] < 2.
+_OFFSET_COLUMNS = ("offx", "offy", "rar", "decr")
 
-# source_ids = np.unique(out._data['isource'][otf_mask])
-# print(f"Sources: {source_ids}")
 
-# target_mask = out._data['isource'] == source_ids[0]
+def read_otf_offsets(mir_filename, extra_columns=()):
+    '''
+    Read the OTF offsets and field centers for all unflagged OTF integrations.
 
-# offx_target = out._data['offx'][target_mask]
-# offy_target = out._data['offy'][target_mask]
+    Loads the full MIR dataset with `MirParser`. See
+    `iter_otf_offsets_chunked` for a streaming version.
 
-# Group by common rar values, then split and calculate with the offsets.
-unique_rar, unique_indices_rar = np.unique(rar, return_index=True)
-unique_decr, unique_indices_decr = np.unique(decr, return_index=True)
+    Parameters
+    ----------
+    mir_filename : str or Path
+        MIR dataset directory.
+    extra_columns : tuple
+        Other in_read columns to return, e.g. ``("mjd", "rinteg")``.
 
-# Sort indices to maintain order
-sorted_indices_rar = np.sort(unique_indices_rar)
-sorted_indices_decr = np.sort(unique_indices_decr)
+    Returns
+    -------
+    offx, offy, rar, decr : `~numpy.ndarray`
+        Offsets (arcsec) and field centers (rad) per integration, followed
+        by any ``extra_columns``.
+    '''
 
-# Use sorted indices to get the unique values in the original order
-unique_rar_ordered = rar[sorted_indices_rar]
-unique_decr_ordered = decr[sorted_indices_decr]
+    logger.info(f"Reading {mir_filename}")
 
-coord_target = SkyCoord(unique_rar_ordered * u.rad,
-                        unique_decr_ordered * u.rad)
+    with stage("extract.read"):
+        mir_data = MirParser(mir_filename)
 
-coords_target_otf_tabs = []
-for this_rar, this_decr, this_coord in zip(unique_rar_ordered, unique_decr_ordered, coord_target):
+    logger.info("Selecting data")
+    with stage("extract.select"):
+        mir_data.select([("rinteg","lt", 2), ("flags", "eq", 0)])
+        columns = mir_data.in_data[list(_OFFSET_COLUMNS + tuple(extra_columns))]
 
-    print(f"Processing {this_coord.to_string('hmsdms')}")
+    count("extract.integrations", len(columns[0]))
 
-    # Identify the offsets for this source.
-    this_mask = (rar == this_rar) & (decr == this_decr)
-    print(f"Found {np.sum(this_mask)} offsets")
+    return tuple(columns)
 
-    this_offx = offx[this_mask]
-    this_offy = offy[this_mask]
 
-    coords_target_otf = this_coord.spherical_offsets_by(this_offx * u.arcsec, this_offy * u.arcsec)
+def group_field_centers(rar, decr):
+    '''
+    Group integrations by their (rar, decr) field center in a single pass.
 
+    Parameters
+    ----------
+    rar, decr : `~numpy.ndarray`
+        Field centers in radians per integration.
 
-    coords_target_otf_tabs.append(Table([Column(coords_target_otf.ra, name='ra'),
-                                        Column(coords_target_otf.dec, name='dec')]))
+    Returns
+    -------
+    centers : `~numpy.ndarray`
+        Unique (rar, decr) pairs with shape (N_fields, 2), in the order they
+        were first observed.
+    field_id : `~numpy.ndarray`
+        Index into ``centers`` for each integration.
+    '''
 
-# Combine into a single table
+    rar = np.asarray(rar, dtype=np.float64)
+    decr = np.asarray(decr, dtype=np.float64)
 
-vstack(coords_target_otf_tabs).write(f"{mir_filename.name}_target_otf_coords.fits", overwrite=True)
+    # Integrations come in runs on the same field. Only the run starts are
+    # needed to find the unique centers.
+    new_run = np.ones(rar.shape, dtype=bool)
+    new_run[1:] = (rar[1:] != rar[:-1]) | (decr[1:] != decr[:-1])
+    run_start = np.flatnonzero(new_run)
+    run_length = np.diff(np.append(run_start, rar.size))
 
+    pairs = np.stack([rar[run_start], decr[run_start]], axis=-1)
 
-# Save the unique rar and decr values. These should be the inputs for the observe cmd
-field_centers = Table([Column(coord_target.ra, name='ra'),
-                       Column(coord_target.dec, name='dec')])
-field_centers.write(f"{mir_filename.name}_field_centers.fits", overwrite=True)
+    unique_pairs, first_index, field_id = np.unique(pairs, axis=0,
+                                                    return_index=True,
+                                                    return_inverse=True)
+
+    # Renumber the fields in the order they were first observed
+    order = np.argsort(first_index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    return unique_pairs[order], np.repeat(rank[field_id.ravel()], run_length)
+
+
+def apply_spherical_offsets(lon0, lat0, dlon, dlat):
+    '''
+    Closed form of `~astropy.coordinates.SkyCoord.spherical_offsets_by`.
+
+    Rotates the offsets from the frame centered on (lon0, lat0) to the sky.
+    Avoids building the offset frames, which dominates the cost for millions
+    of integrations.
+
+    Parameters
+    ----------
+    lon0, lat0 : `~numpy.ndarray`
+        Centers in radians.
+    dlon, dlat : `~numpy.ndarray`
+        Offsets in radians.
+
+    Returns
+    -------
+    lon, lat : `~numpy.ndarray`
+        Offset positions in radians, with lon in [0, 2 pi).
+    '''
+
+    cos_dlat = np.cos(dlat)
+    x = cos_dlat * np.cos(dlon)
+    y = cos_dlat * np.sin(dlon)
+    z = np.sin(dlat)
+
+    # Rotate by lat0 towards the pole, then by lon0
+    cos_lat0 = np.cos(lat0)
+    sin_lat0 = np.sin(lat0)
+    x, z = x * cos_lat0 - z * sin_lat0, x * sin_lat0 + z * cos_lat0
+
+    cos_lon0 = np.cos(lon0)
+    sin_lon0 = np.sin(lon0)
+    x, y = x * cos_lon0 - y * sin_lon0, x * sin_lon0 + y * cos_lon0
+
+    lon = np.mod(np.arctan2(y, x), 2 * np.pi)
+    lat = np.arctan2(z, np.hypot(x, y))
+
+    return lon, lat
+
+
+def otf_coords_table(lon, lat, field_id):
+    '''
+    Table of the integration positions (in radians) and field IDs.
+    '''
+
+    return Table([Column(np.rad2deg(lon), name='ra', unit=u.deg),
+                  Column(np.rad2deg(lat), name='dec', unit=u.deg),
+                  Column(field_id, name='field_id')])
+
+
+def project_otf_offsets(offx, offy, rar, decr, verbose=True):
+    '''
+    Apply the OTF offsets to each field center.
+
+    The integrations are grouped by field center once, and the offsets are
+    applied to all integrations in one vectorized operation
+    (`apply_spherical_offsets`).
+
+    Parameters
+    ----------
+    offx, offy : `~numpy.ndarray`
+        Offsets in arcsec.
+    rar, decr : `~numpy.ndarray`
+        Field centers in radians.
+    verbose : bool
+        Log the number of offsets per field (INFO level).
+
+    Returns
+    -------
+    coords_table : `~astropy.table.Table`
+        RA, Dec and field ID of every integration, in the input order.
+    coord_target : `~astropy.coordinates.SkyCoord`
+        Unique field centers, indexed by the field ID.
+    '''
+
+    lon, lat, field_id, centers = project_otf_offsets_arrays(offx, offy, rar, decr)
+
+    coord_target = SkyCoord(centers[:, 0] * u.rad,
+                            centers[:, 1] * u.rad)
+
+    # Skip formatting the per-field lines when they would not be shown
+    if verbose and logger.isEnabledFor(logging.INFO):
+        counts = np.bincount(field_id, minlength=len(centers))
+        for this_coord, this_count in zip(coord_target, counts):
+            logger.info(f"Found {this_count} offsets for {this_coord.to_string('hmsdms')}")
+
+    with stage("extract.project"):
+        coords_table = otf_coords_table(lon, lat, field_id)
+
+    return coords_table, coord_target
+
+
+def project_otf_offsets_arrays(offx, offy, rar, decr):
+    '''
+    Array version of `project_otf_offsets`, without building a table.
+
+    Returns
+    -------
+    lon, lat : `~numpy.ndarray`
+        RA and Dec of every integration in radians.
+    field_id : `~numpy.ndarray`
+        Index into ``centers`` for each integration.
+    centers : `~numpy.ndarray`
+        Unique (rar, decr) field centers with shape (N_fields, 2).
+    '''
+
+    with stage("extract.group"):
+        centers, field_id = group_field_centers(rar, decr)
+
+    with stage("extract.project"):
+        lon, lat = apply_spherical_offsets(centers[field_id, 0], centers[field_id, 1],
+                                           np.deg2rad(np.asarray(offx, dtype=np.float64) / 3600.),
+                                           np.deg2rad(np.asarray(offy, dtype=np.float64) / 3600.))
+
+    return lon, lat, field_id, centers
+
+
+def write_field_centers(coord_target, filename):
+    '''
+    Save the unique rar and decr values. These should be the inputs for the observe cmd.
+    '''
+
+    field_centers = Table([Column(coord_target.ra, name='ra'),
+                           Column(coord_target.dec, name='dec')])
+    field_centers.write(filename, overwrite=True)
+
+
+def extract_spatial_coverage(mir_filename, output_path=Path("."), output_format="fits"):
+    '''
+    Write the positions of all OTF integrations and the field centers to FITS tables.
+
+    Parameters
+    ----------
+    mir_filename : str or Path
+        MIR dataset directory.
+    output_path : Path
+        Directory for the output tables.
+    output_format : {"fits", "npy"}
+        Write the positions as a FITS table or in the columnar format (see
+        `read_otf_coords`), which also has the time stamp and integration
+        time of each integration.
+    '''
+
+    mir_filename = Path(mir_filename)
+    output_path = Path(output_path)
+
+    output_filename = coverage_output_filename(mir_filename, output_path, output_format)
+
+    if output_format == "npy":
+        offx, offy, rar, decr, mjd, rinteg = read_otf_offsets(mir_filename,
+                                                              extra_columns=("mjd", "rinteg"))
+
+        lon, lat, field_id, centers = project_otf_offsets_arrays(offx, offy, rar, decr)
+        coord_target = SkyCoord(centers[:, 0] * u.rad, centers[:, 1] * u.rad)
+
+        with stage("extract.write"):
+            write_otf_coords_npy(output_filename,
+                                 dict(ra=lon, dec=lat, field_id=field_id, mjd=mjd, rinteg=rinteg),
+                                 meta=dict(source=str(mir_filename)))
+
+    elif output_format == "fits":
+        offx, offy, rar, decr = read_otf_offsets(mir_filename)
+
+        coords_table, coord_target = project_otf_offsets(offx, offy, rar, decr)
+
+        with stage("extract.write"):
+            coords_table.write(output_filename, overwrite=True)
+
+    else:
+        raise ValueError(f"Unknown output_format {output_format}. Use 'fits' or 'npy'.")
+
+    count("extract.fields", len(coord_target))
+
+    with stage("extract.write"):
+        write_field_centers(coord_target, output_path / f"{mir_filename.name}_field_centers.fits")
+
+
+# Streaming mode. Only the integration (in_read) and spectral (sp_read) header
+# records are read, as memory maps, one chunk at a time.
+
+def _memmap_mir_table(mir_filename, filetype, dtype):
+    '''
+    Memory map one of the fixed-record MIR header files.
+    '''
+
+    filename = Path(mir_filename) / filetype
+
+    if filename.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(filename, dtype=dtype, mode='r')
+
+
+def unflagged_inhids(mir_filename, chunk_size=1000000):
+    '''
+    Find the integrations with at least one unflagged spectral record.
+
+    Matches the ``("flags", "eq", 0)`` selection in `read_otf_offsets`:
+    MirParser applies it to both sp_read and the weather table we_read,
+    where a scan is kept if any of its per-antenna flags is 0. Integrations
+    whose scan (``ints``) has no such we_read record are dropped. Datasets
+    without a we_read file use the sp_read flags only.
+
+    Parameters
+    ----------
+    mir_filename : str or Path
+        MIR dataset directory.
+    chunk_size : int
+        Number of sp_read records to read at a time.
+
+    Returns
+    -------
+    good_inhid : `~numpy.ndarray`
+        Boolean array indexed by inhid.
+    '''
+
+    sp_data = _memmap_mir_table(mir_filename, "sp_read", sp_dtype)
+
+    good_inhid = np.zeros(0, dtype=bool)
+
+    # Reading the flags is the selection step of the streaming mode
+    with stage("extract.select"):
+        for start in range(0, len(sp_data), chunk_size):
+            chunk = sp_data[start:start + chunk_size]
+
+            inhid = np.asarray(chunk['inhid'])[np.asarray(chunk['flags']) == 0]
+            if inhid.size == 0:
+                continue
+
+            max_inhid = inhid.max()
+            if max_inhid >= good_inhid.size:
+                good_inhid = np.concatenate([good_inhid,
+                                             np.zeros(max_inhid + 1 - good_inhid.size, dtype=bool)])
+
+            good_inhid[inhid] = True
+
+        if (Path(mir_filename) / "we_read").exists():
+            we_data = _memmap_mir_table(mir_filename, "we_read", we_dtype)
+            good_ints = np.asarray(we_data['ints'])[np.any(np.asarray(we_data['flags']) == 0,
+                                                           axis=-1)]
+
+            in_data = _memmap_mir_table(mir_filename, "in_read", in_dtype)
+            for start in range(0, len(in_data), chunk_size):
+                chunk = in_data[start:start + chunk_size]
+
+                inhid = np.asarray(chunk['inhid'])
+                bad = ~np.isin(np.asarray(chunk['ints']), good_ints) & (inhid < good_inhid.size)
+                good_inhid[inhid[bad]] = False
+
+    return good_inhid
+
+
+def _select_otf_records(chunk, good_inhid):
+    '''
+    Mask for OTF integrations (rinteg < 2) that are not fully flagged.
+    '''
+
+    inhid = np.asarray(chunk['inhid'])
+
+    in_range = inhid < good_inhid.size
+    mask = np.asarray(chunk['rinteg']) < 2
+    mask[in_range] &= good_inhid[inhid[in_range]]
+    mask[~in_range] = False
+
+    return mask
+
+
+def iter_otf_offsets_chunked(mir_filename, chunk_size=100000, good_inhid=None,
+                             extra_columns=()):
+    '''
+    Iterate over the OTF offsets and field centers in chunks.
+
+    Only the offx, offy, rar and decr columns (and any ``extra_columns``) of
+    the selected in_read records are copied into memory, one chunk at a time.
+
+    Parameters
+    ----------
+    mir_filename : str or Path
+        MIR dataset directory.
+    chunk_size : int
+        Number of in_read records per chunk.
+    good_inhid : `~numpy.ndarray`, optional
+        Output of `unflagged_inhids`. Computed if not given.
+    extra_columns : tuple
+        Other in_read columns to return, e.g. ``("mjd", "rinteg")``.
+
+    Yields
+    ------
+    offx, offy, rar, decr : `~numpy.ndarray`
+        Offsets (arcsec) and field centers (rad) for the chunk, followed by
+        any ``extra_columns``.
+    '''
+
+    if good_inhid is None:
+        good_inhid = unflagged_inhids(mir_filename)
+
+    in_data = _memmap_mir_table(mir_filename, "in_read", in_dtype)
+
+    for start in range(0, len(in_data), chunk_size):
+        chunk = in_data[start:start + chunk_size]
+
+        with stage("extract.select"):
+            mask = _select_otf_records(chunk, good_inhid)
+        if not mask.any():
+            continue
+
+        with stage("extract.read"):
+            columns = tuple(np.asarray(chunk[name][mask])
+                            for name in _OFFSET_COLUMNS + tuple(extra_columns))
+
+        yield columns
+
+
+def _count_otf_records(mir_filename, good_inhid, chunk_size=100000):
+    '''
+    Count the selected in_read records without reading the other columns.
+    '''
+
+    in_data = _memmap_mir_table(mir_filename, "in_read", in_dtype)
+
+    nrows = 0
+    for start in range(0, len(in_data), chunk_size):
+        nrows += np.count_nonzero(_select_otf_records(in_data[start:start + chunk_size],
+                                                      good_inhid))
+
+    return nrows
+
+
+def _open_fits_table_stream(filename, columns, nrows):
+    '''
+    Open a FITS binary table of known length for writing row chunks.
+
+    The table is written to a temporary ``.partial`` file next to
+    ``filename`` and only moved into place by `_close_fits_table_stream`
+    once every row is written.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Output file. Overwritten if it exists.
+    columns : list of `~astropy.io.fits.Column`
+        Column definitions. Data are written as big-endian records.
+    nrows : int
+        Total number of rows that will be written.
+
+    Returns
+    -------
+    fileobj : file
+        Open file, positioned at the start of the table data.
+    row_dtype : `~numpy.dtype`
+        Big-endian record dtype to write.
+    '''
+
+    header = fits.BinTableHDU.from_columns(columns, nrows=0).header
+    header['NAXIS2'] = nrows
+
+    row_dtype = np.dtype([(col.name, col.dtype.newbyteorder('>'))
+                          for col in fits.ColDefs(columns)])
+
+    fileobj = open(_partial_filename(filename), 'wb')
+    fileobj.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+    fileobj.write(header.tostring().encode('ascii'))
+
+    return fileobj, row_dtype
+
+
+def _partial_filename(filename):
+    filename = Path(filename)
+    return filename.with_name(filename.name + ".partial")
+
+
+def _close_fits_table_stream(fileobj, row_dtype, nrows, filename, complete=True):
+    '''
+    Pad the table data to a full FITS block, close the file and move it to
+    ``filename``.
+
+    An incomplete table is deleted instead, so a failed run never leaves an
+    output that `_needs_update` would take as up to date.
+    '''
+
+    if complete:
+        nbytes = nrows * row_dtype.itemsize
+        fileobj.write(b'\0' * ((-nbytes) % 2880))
+    fileobj.close()
+
+    if complete:
+        os.replace(_partial_filename(filename), filename)
+    else:
+        _partial_filename(filename).unlink()
+
+
+def extract_spatial_coverage_streaming(mir_filename, output_path=Path("."),
+                                       chunk_size=100000, verbose=True,
+                                       output_format="fits"):
+    '''
+    Streaming version of `extract_spatial_coverage` with bounded memory.
+
+    The header records are memory mapped and processed ``chunk_size``
+    integrations at a time, and each chunk is written straight into the
+    preallocated output (FITS table or columnar files) in the order observed.
+
+    Parameters
+    ----------
+    mir_filename : str or Path
+        MIR dataset directory.
+    output_path : Path
+        Directory for the output tables.
+    chunk_size : int
+        Number of in_read records per chunk.
+    verbose : bool
+        Log progress per chunk (INFO level).
+    output_format : {"fits", "npy"}
+        See `extract_spatial_coverage`.
+    '''
+
+    mir_filename = Path(mir_filename)
+    output_path = Path(output_path)
+
+    if output_format not in ["fits", "npy"]:
+        raise ValueError(f"Unknown output_format {output_format}. Use 'fits' or 'npy'.")
+
+    output_filename = coverage_output_filename(mir_filename, output_path, output_format)
+
+    logger.info(f"Reading {mir_filename} in chunks of {chunk_size}")
+
+    good_inhid = unflagged_inhids(mir_filename)
+
+    with stage("extract.select"):
+        nrows = _count_otf_records(mir_filename, good_inhid, chunk_size=chunk_size)
+    logger.info(f"Found {nrows} OTF integrations")
+    count("extract.integrations", nrows)
+
+    if output_format == "npy":
+        extra_columns = ("mjd", "rinteg")
+        buffers = open_otf_coords_npy(output_filename, nrows)
+    else:
+        extra_columns = ()
+        columns = [fits.Column(name='ra', format='D', unit='deg'),
+                   fits.Column(name='dec', format='D', unit='deg'),
+                   fits.Column(name='field_id', format='J')]
+
+        fileobj, row_dtype = _open_fits_table_stream(output_filename, columns, nrows)
+
+    # Field centers in the order first observed, mapped to their global field ID.
+    # There are few, so keep them all.
+    field_centers = {}
+
+    start = 0
+
+    try:
+        for ii, chunk in enumerate(iter_otf_offsets_chunked(mir_filename,
+                                                            chunk_size=chunk_size,
+                                                            good_inhid=good_inhid,
+                                                            extra_columns=extra_columns)):
+            offx, offy, rar, decr = chunk[:4]
+
+            if verbose:
+                logger.info(f"Processing chunk {ii} with {len(offx)} integrations")
+            count("extract.chunks")
+
+            lon, lat, field_id, chunk_centers = project_otf_offsets_arrays(offx, offy, rar, decr)
+
+            # Map the field IDs within this chunk onto the global field IDs.
+            chunk_to_global = np.array([field_centers.setdefault((this_rar, this_decr), len(field_centers))
+                                        for this_rar, this_decr in chunk_centers])
+
+            end = start + len(lon)
+
+            with stage("extract.write"):
+                if output_format == "npy":
+                    buffers['ra'][start:end] = lon
+                    buffers['dec'][start:end] = lat
+                    buffers['field_id'][start:end] = chunk_to_global[field_id]
+                    buffers['mjd'][start:end] = chunk[4]
+                    buffers['rinteg'][start:end] = chunk[5]
+                else:
+                    rows = np.empty(len(lon), dtype=row_dtype)
+                    rows['ra'] = np.rad2deg(lon)
+                    rows['dec'] = np.rad2deg(lat)
+                    rows['field_id'] = chunk_to_global[field_id]
+                    fileobj.write(rows.tobytes())
+
+            start = end
+
+    finally:
+        if output_format == "npy":
+            # Only mark the output complete if every row was written
+            if start == nrows:
+                close_otf_coords_npy(output_filename, buffers,
+                                     meta=dict(source=str(mir_filename)))
+        else:
+            _close_fits_table_stream(fileobj, row_dtype, nrows, output_filename,
+                                     complete=start == nrows)
+
+    centers = np.array(list(field_centers.keys())).reshape(-1, 2)
+    coord_target = SkyCoord(centers[:, 0] * u.rad, centers[:, 1] * u.rad)
+
+    count("extract.fields", len(coord_target))
+
+    with stage("extract.write"):
+        write_field_centers(coord_target, output_path / f"{mir_filename.name}_field_centers.fits")
+
+
+def coverage_output_filename(mir_filename, output_path=Path("."), output_format="fits"):
+    '''
+    Name of the coordinate table written for a MIR dataset. For the columnar
+    ("npy") format this is a directory.
+    '''
+
+    name = f"{Path(mir_filename).name}_target_otf_coords"
+
+    return Path(output_path) / (name if output_format == "npy" else f"{name}.fits")
+
+
+def _expand_mir_filenames(mir_filenames):
+    '''
+    Expand a glob pattern or list of patterns/paths into MIR dataset paths.
+    '''
+
+    if isinstance(mir_filenames, (str, Path)):
+        mir_filenames = [mir_filenames]
+
+    out = []
+    for name in mir_filenames:
+        matches = sorted(glob.glob(str(name)))
+        out.extend(Path(match) for match in matches if Path(match).is_dir())
+
+    return out
+
+
+def _needs_update(mir_filename, output_filename):
+    '''
+    True if the output is missing or older than any file in the MIR dataset.
+    '''
+
+    if output_filename.is_dir():
+        # Columnar output; meta.json is written last
+        output_filename = output_filename / "meta.json"
+
+    if not output_filename.exists():
+        return True
+
+    input_mtime = max((this_file.stat().st_mtime for this_file in Path(mir_filename).iterdir()),
+                      default=-np.inf)
+
+    return output_filename.stat().st_mtime < input_mtime
+
+
+def _extract_one(mir_filename, output_path, stream, chunk_size, instrument=False,
+                 output_format="fits"):
+    '''
+    Process one track. Module level so it can be sent to a worker process.
+
+    With ``instrument``, the worker's timers are returned to be merged into
+    the parent process.
+    '''
+
+    if instrument:
+        enable(True)
+        reset()
+
+    if stream:
+        extract_spatial_coverage_streaming(mir_filename, output_path=output_path,
+                                           chunk_size=chunk_size, verbose=False,
+                                           output_format=output_format)
+    else:
+        extract_spatial_coverage(mir_filename, output_path=output_path,
+                                 output_format=output_format)
+
+    return (coverage_output_filename(mir_filename, output_path, output_format),
+            snapshot() if instrument else None)
+
+
+def merge_otf_coords(filenames, track_names, output_filename, output_format="fits"):
+    '''
+    Concatenate per-track coverage tables into one, with a ``track`` column.
+
+    The rows are copied track by track into a preallocated output instead of
+    stacking tables in memory.
+
+    Parameters
+    ----------
+    filenames : list
+        Per-track coverage tables, all in ``output_format``.
+    track_names : list
+        Name of each track.
+    output_filename : str or Path
+        Merged table (FITS file or columnar directory).
+    output_format : {"fits", "npy"}
+        Format of the inputs and output. For "npy", ``track`` is an index
+        into the ``tracks`` list in meta.json.
+
+    Returns
+    -------
+    merged : `~astropy.table.Table`
+        The merged table, memory mapped.
+    '''
+
+    tables = [read_otf_coords(filename, memmap=True) for filename in filenames]
+    nrows = sum(len(tab) for tab in tables)
+
+    if output_format == "npy":
+        colnames = [name for name in tables[0].colnames if name in otf_coords_columns]
+        columns = {name: otf_coords_columns[name] for name in colnames}
+        columns['track'] = ('<i2', '')
+
+        buffers = open_otf_coords_npy(output_filename, nrows, columns=columns)
+
+        start = 0
+        for ii, tab in enumerate(tables):
+            end = start + len(tab)
+            for name in colnames:
+                buffers[name][start:end] = tab[name]
+            buffers['track'][start:end] = ii
+            start = end
+
+        close_otf_coords_npy(output_filename, buffers, columns=columns,
+                             meta=dict(tracks=[str(name) for name in track_names]))
+
+    else:
+        name_length = max(1, max(len(str(name)) for name in track_names))
+        columns = [fits.Column(name='ra', format='D', unit='deg'),
+                   fits.Column(name='dec', format='D', unit='deg'),
+                   fits.Column(name='field_id', format='J'),
+                   fits.Column(name='track', format=f'{name_length}A')]
+
+        fileobj, row_dtype = _open_fits_table_stream(output_filename, columns, nrows)
+
+        nwritten = 0
+        try:
+            for tab, track_name in zip(tables, track_names):
+                rows = np.empty(len(tab), dtype=row_dtype)
+                rows['ra'] = u.Quantity(tab['ra']).to_value(u.deg)
+                rows['dec'] = u.Quantity(tab['dec']).to_value(u.deg)
+                rows['field_id'] = tab['field_id']
+                rows['track'] = str(track_name)
+                fileobj.write(rows.tobytes())
+                nwritten += len(tab)
+        finally:
+            _close_fits_table_stream(fileobj, row_dtype, nrows, output_filename,
+                                     complete=nwritten == nrows)
+
+    return read_otf_coords(output_filename)
+
+
+def extract_spatial_coverage_batch(mir_filenames, output_path=Path("."),
+                                   n_workers=None,
+                                   merged_filename="merged_target_otf_coords.fits",
+                                   stream=False, chunk_size=100000,
+                                   overwrite=False, output_format="fits"):
+    '''
+    Extract the coverage for many MIR datasets in parallel.
+
+    Tracks whose output table is newer than every file in the MIR dataset are
+    skipped unless ``overwrite=True``. All per-track tables are then merged
+    into one catalogue with a ``track`` column (see `merge_otf_coords`).
+
+    Parameters
+    ----------
+    mir_filenames : str, Path or list
+        MIR dataset directories or glob patterns.
+    output_path : Path
+        Directory for the per-track and merged tables.
+    n_workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    merged_filename : str or None
+        Name of the merged catalogue in ``output_path``. Set to None to skip
+        the merge. The .fits extension is dropped for the columnar format.
+    stream : bool
+        Use `extract_spatial_coverage_streaming` for each track.
+    chunk_size : int
+        Chunk size for the streaming mode.
+    overwrite : bool
+        Reprocess all tracks, even if their outputs are up to date.
+    output_format : {"fits", "npy"}
+        Format of the per-track and merged tables. See
+        `extract_spatial_coverage`.
+
+    Returns
+    -------
+    merged : `~astropy.table.Table` or None
+        Merged coverage catalogue.
+    '''
+
+    output_path = Path(output_path)
+
+    mir_filenames = _expand_mir_filenames(mir_filenames)
+    if len(mir_filenames) == 0:
+        raise ValueError("No MIR datasets found.")
+
+    to_process = [mir_filename for mir_filename in mir_filenames
+                  if overwrite or _needs_update(mir_filename,
+                                                coverage_output_filename(mir_filename, output_path,
+                                                                         output_format))]
+
+    logger.info(f"Processing {len(to_process)} of {len(mir_filenames)} tracks")
+    count("extract.tracks_skipped", len(mir_filenames) - len(to_process))
+
+    if len(to_process) > 0:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(_extract_one, mir_filename, output_path,
+                                       stream, chunk_size, is_enabled(),
+                                       output_format): mir_filename
+                       for mir_filename in to_process}
+
+            for future in futures:
+                # Raise any errors from the workers here.
+                _, worker_stats = future.result()
+                if worker_stats is not None:
+                    merge_snapshot(worker_stats)
+
+    if merged_filename is None:
+        return None
+
+    if output_format == "npy" and merged_filename.endswith(".fits"):
+        merged_filename = merged_filename[:-len(".fits")]
+
+    with stage("extract.merge"):
+        merged = merge_otf_coords([coverage_output_filename(mir_filename, output_path, output_format)
+                                   for mir_filename in mir_filenames],
+                                  [mir_filename.name for mir_filename in mir_filenames],
+                                  output_path / merged_filename,
+                                  output_format=output_format)
+
+    return merged
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Extract the OTF pointing positions from MIR datasets.")
+    parser.add_argument("mir_filenames", nargs="+",
+                        help="MIR dataset(s) or glob pattern(s). More than one runs in batch mode.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read only the header records in chunks with bounded memory.")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes in batch mode.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Reprocess tracks with up-to-date outputs in batch mode.")
+    parser.add_argument("--timing-report", default=None,
+                        help="Write the per-stage timings to this file (.json or .ecsv).")
+    parser.add_argument("--quiet", action="store_true", help="Only log warnings.")
+    parser.add_argument("--format", default="fits", choices=["fits", "npy"],
+                        help="Output format. npy writes memory-mappable columns in radians "
+                             "with the time stamp and integration time.")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        format="%(message)s")
+
+    if args.timing_report is not None:
+        enable(True)
+        reset()
+
+    mir_filenames = _expand_mir_filenames(args.mir_filenames)
+    if len(mir_filenames) == 0:
+        raise ValueError(f"No MIR datasets found matching {' '.join(args.mir_filenames)}.")
+
+    if len(mir_filenames) > 1:
+        extract_spatial_coverage_batch(mir_filenames, n_workers=args.workers,
+                                       stream=args.stream, chunk_size=args.chunk_size,
+                                       overwrite=args.overwrite, output_format=args.format)
+    elif args.stream:
+        extract_spatial_coverage_streaming(mir_filenames[0], chunk_size=args.chunk_size,
+                                           output_format=args.format)
+    else:
+        extract_spatial_coverage(mir_filenames[0], output_format=args.format)
+
+    if args.timing_report is not None:
+        timing_report().pprint(max_lines=-1, max_width=-1)
+        write_timing_report(args.timing_report)
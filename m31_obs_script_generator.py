@@ -8,6 +8,13 @@ from pathlib import Path
 import numpy as np
 import itertools
 
+from otf_schedule import (assign_tracks_to_bricks, schedule_otf_maps,
+                          regions_to_map_coords)
+from otf_track_simulator import parse_obs_script, otf_scan_time, gain_scan_time
+from otf_script_generator import load_template, render_template
+from otf_mosaic_regions import (regions_to_table, table_to_sma_lines,
+                                otf_position_angles, check_otf_position_angles)
+
 # M31 velocity
 v_M31 = -296
 
@@ -23,6 +30,19 @@ if not this_config in maps_per_track:
 
 nmaps0 = maps_per_track[this_config]
 
+# Map order within each track:
+# 'cycle': cycle through the brick's maps with a different start in each track
+# 'optimize': schedule_otf_maps (balances repeats, minimizes slew and airmass).
+#             Needs the LST start of every track in track_lst_start.
+schedule_method = 'cycle'
+
+# LST (hr) at the start of each track, for tracks in brick order (A, B, C, D).
+# Required for schedule_method = 'optimize'.
+track_lst_start = None
+
+# Total number of tracks across all bricks
+ntracks_total = 30
+
 # Load M31 OTF regions
 
 # data_path = Path("/Users/ekoch/storage/M31/SMA/m31_25A_sma_otf_co21_techdev")
@@ -42,96 +62,84 @@ output_scripts_path = data_path / "m31_observing_scripts"
 # 2. The order and total number of maps to loop through
 
 
-def region_to_sma_line(this_region, region_prefix='M31', v_M31=v_M31):
-    '''
-    Convert a region to a line in the perl script
-
-    e.g., "M82 -r 09:55:59.7  -d +69:40:55 -e 2000 -v 270";
-
-    Parameters
-    ----------
-    this_region : regions.Region
-    '''
-
-    ra = this_region.center.ra.to_string(u.hour, sep=':')
-    dec = this_region.center.dec.to_string(u.deg, sep=':')
-
-    return f'"{region_prefix}-{this_region.meta['label']} -r {ra} -d {dec} -e 2000 -v {v_M31}"'
-
-
-def return_otf_positionangle(this_region):
-    '''
-    Converts the position angle from a region to the OTF convention.
-
-    Parameters
-    ----------
-    this_region : regions.RectangleSkyRegion
-        Region to get PA for.
-
-    Returns
-    -------
-    otf_pa : astropy.units.Quantity
-    '''
-
+region_prefix = 'M31'
 
-    pa = this_region.angle.to(u.deg)
+region_dict = {"A": {}, "B": {}, "C": {}, "D": {}}
 
-    # If width>height, shift PA by -90 deg
-    if this_region.width > this_region.height:
-        pa = pa - 90 * u.deg
+# Centers, sizes and angles of all maps as arrays
+region_table = regions_to_table(all_regions)
 
-    # If <0 deg, add 180
-    if pa < 0 * u.deg:
-        pa = pa + 180 * u.deg
+map_names, target_lines = table_to_sma_lines(region_table, region_prefix=region_prefix,
+                                             velocity=v_M31)
+target_line_dict = dict(zip(map_names, target_lines))
 
-    # If >180 deg, subtract 180. No distinction by 180 deg flips
-    if pa > 180 * u.deg:
-        pa = pa - 180 * u.deg
+for full_name, this_region in zip(map_names, all_regions):
 
+    this_brick = full_name.split("Brick-")[1][0]
 
-    # To match the OTF convention, take the complement by 180 deg
-    if pa.value == 0:
-        otf_pa = 0 * u.deg
-    else:
-        otf_pa = 180 * u.deg - pa
+    region_dict[this_brick][full_name] = this_region
 
-    return otf_pa
+# Ensure we have the right number of maps per brick
+assert len(region_dict["A"]) == 5
+assert len(region_dict["D"]) == 5
 
+assert len(region_dict["B"]) == 6
+assert len(region_dict["C"]) == 6
 
-region_prefix = 'M31'
 
-region_dict = {"A": {}, "B": {}, "C": {}, "D": {}}
+# Generate the OTF PA for each map. These must all be the same.
+all_otf_pas = otf_position_angles(region_table['angle'], region_table['width'],
+                                  region_table['height'])
+otf_pa0 = check_otf_position_angles(all_otf_pas, labels=map_names)
+print(f"OTF PAs are all the same at: {otf_pa0}")
 
-all_otf_pas = []
+# A and D have 5 maps and 7 total tracks
+# B and C have 6 maps and 8 total tracks
+ntracks_per_brick = assign_tracks_to_bricks({brick: len(region_dict[brick]) for brick in region_dict},
+                                            ntracks_total, nmaps0)
 
-for this_region in all_regions:
+if schedule_method == 'optimize':
 
-    this_brick = this_region.meta['label'].split("Brick-")[1][0]
+    # Time per map from the OTF loop parameters in the template, with one
+    # gain scan per map.
+    template_params = parse_obs_script(template_path)
 
-    full_name = f"{region_prefix}-{this_region.meta['label']}"
+    time_per_map = (otf_scan_time(float(template_params['rowLength0']),
+                                  float(template_params['nRows0']),
+                                  float(template_params['scanSpeedOTF0']))
+                    + gain_scan_time(float(template_params['ncal0']),
+                                     float(template_params['inttime_gain'])))
 
-    region_dict[this_brick][full_name] = this_region
+    map_names, map_coords = regions_to_map_coords(region_dict)
 
-    # Generate the OTF PA for each map
-    otf_pa = return_otf_positionangle(this_region)
-    all_otf_pas.append(otf_pa.value)
+    track_bricks = [brick for brick in region_dict for _ in range(ntracks_per_brick[brick])]
 
-all_otf_pas = np.array(all_otf_pas) * u.deg
+    if track_lst_start is None:
+        raise ValueError("schedule_method = 'optimize' needs track_lst_start: the LST at the "
+                         "start of each track.")
+    if len(track_lst_start) != len(track_bricks):
+        raise ValueError(f"track_lst_start has {len(track_lst_start)} entries but there are "
+                         f"{len(track_bricks)} tracks.")
 
-# Ensure we have the right number of maps per brick
-assert len(region_dict["A"]) == 5
-assert len(region_dict["D"]) == 5
+    schedule, schedule_summary = schedule_otf_maps(map_names, map_coords,
+                                                   [list(region_dict[brick]) for brick in track_bricks],
+                                                   nmaps0,
+                                                   track_lst_start=np.asarray(track_lst_start) * u.hourangle,
+                                                   time_per_map=time_per_map,
+                                                   min_elevation=float(template_params['MINEL_TARG']) * u.deg)
 
-assert len(region_dict["B"]) == 6
-assert len(region_dict["C"]) == 6
+    print(schedule_summary)
+    print(f"Repeats per map: {schedule_summary.meta['repeats']}")
 
+    brick_schedules = {brick: [] for brick in region_dict}
+    for brick, this_schedule in zip(track_bricks, schedule):
+        brick_schedules[brick].append(this_schedule)
 
-# Sanity check: all OTF PAs should be the same
-assert np.allclose(all_otf_pas, all_otf_pas[0])
-print(f"OTF PAs are all the same at: {all_otf_pas[0]}")
+elif schedule_method != 'cycle':
+    raise ValueError("Unknown schedule_method: " + schedule_method)
 
-# A and D have 5 maps and 7 total tracks
-# B and C have 6 maps and 8 total tracks
+# Parsed once and cached for all tracks
+template = load_template(template_path)
 
 for this_brick in ["A", "B", "C", "D"]:
 
@@ -139,12 +147,7 @@ for this_brick in ["A", "B", "C", "D"]:
 
     nmaps = len(region_dict[this_brick])
 
-    if len(region_dict[this_brick]) == 5:
-        ntracks = 7
-    elif len(region_dict[this_brick]) == 6:
-        ntracks = 8
-    else:
-        raise ValueError(f"Unexpected number of maps: {nmaps} for brick {this_brick}")
+    ntracks = ntracks_per_brick[this_brick]
 
     print(f"Brick: {this_brick}")
     print(f"Number of maps: {nmaps}")
@@ -157,32 +160,27 @@ for this_brick in ["A", "B", "C", "D"]:
     for ii in range(1, ntracks+1):
         print(f"Generating script for track {ii}")
 
-        # Generate map order, cycling between starting points in each track:
-        cycled_maps = list(itertools.islice(itertools.cycle(np.roll(map_list, ii-1)), nmaps0))
+        if schedule_method == 'optimize':
+            cycled_maps = brick_schedules[this_brick][ii - 1]
+        else:
+            # Generate map order, cycling between starting points in each track:
+            cycled_maps = list(itertools.islice(itertools.cycle(np.roll(map_list, ii-1)), nmaps0))
 
         # Generate target strings:
         target_string = []
         for this_map in cycled_maps:
-            target_string.append(region_to_sma_line(region_dict[this_brick][this_map],
-                                                    region_prefix=region_prefix))
+            target_string.append(target_line_dict[this_map])
 
         # Sanity check:
         assert len(target_string) == nmaps0
 
-        target_string = ",\n".join(target_string)
-
         output_name = f"{this_config}_Brick_{this_brick}_track_{ii}.pl"
         output_path = output_scripts_path / output_name
         if output_path.exists():
             output_path.unlink()
 
-        template_path = output_scripts_path / "m31_otf_sub_basetemplate.pl"
-
-        with open(template_path, "r") as f:
-            template = f.read()
-
         # Replace the placeholder with your target string
-        new_content = template.replace("{science_targets}", target_string)
+        new_content = render_template(template, targets=target_string)
 
         with open(output_path, "w") as f:
             # Defaults to empty line for first character. Slice this out.
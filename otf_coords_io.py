@@ -0,0 +1,156 @@
+
+import numpy as np
+from astropy.table import Table, Column
+
+import json
+from pathlib import Path
+
+
+# Columnar output. Each column is a separate .npy file in a directory, so
+# downstream tools can memory map only the columns they need:
+#   <track>_target_otf_coords/ra.npy, dec.npy   positions (rad)
+#                             field_id.npy      index into the field centers
+#                             mjd.npy           integration time stamp (MJD)
+#                             rinteg.npy        integration time (s)
+#                             meta.json         row count, units and source.
+#                                               Written last, so its presence
+#                                               marks a complete output.
+
+otf_coords_columns = {'ra': ('<f8', 'rad'),
+                       'dec': ('<f8', 'rad'),
+                       'field_id': ('<i4', ''),
+                       'mjd': ('<f8', 'd'),
+                       'rinteg': ('<f4', 's')}
+
+
+def open_otf_coords_npy(dirname, nrows, columns=None):
+    '''
+    Preallocate the column files of a columnar coverage table.
+
+    Parameters
+    ----------
+    dirname : str or Path
+        Output directory.
+    nrows : int
+        Number of rows.
+    columns : dict, optional
+        Column name -> (dtype, unit). Defaults to ra, dec, field_id, mjd
+        and rinteg.
+
+    Returns
+    -------
+    buffers : dict
+        Writable memory maps for each column. Finish with
+        `close_otf_coords_npy`.
+    '''
+
+    if columns is None:
+        columns = otf_coords_columns
+
+    dirname = Path(dirname)
+    dirname.mkdir(parents=True, exist_ok=True)
+
+    # Remove the marker of a complete output while the columns are rewritten
+    (dirname / "meta.json").unlink(missing_ok=True)
+
+    return {name: np.lib.format.open_memmap(dirname / f"{name}.npy", mode='w+',
+                                            dtype=dtype, shape=(int(nrows),))
+            for name, (dtype, unit) in columns.items()}
+
+
+def close_otf_coords_npy(dirname, buffers, columns=None, meta=None):
+    '''
+    Flush the column files and write the meta.json of a columnar table.
+    '''
+
+    if columns is None:
+        columns = otf_coords_columns
+
+    for buffer in buffers.values():
+        buffer.flush()
+
+    nrows = len(next(iter(buffers.values()))) if buffers else 0
+
+    out_meta = dict(nrows=nrows,
+                    columns=list(buffers),
+                    units={name: columns[name][1] for name in buffers})
+    if meta is not None:
+        out_meta.update(meta)
+
+    with open(Path(dirname) / "meta.json", "w") as f:
+        json.dump(out_meta, f, indent=1)
+
+
+def write_otf_coords_npy(dirname, data, meta=None):
+    '''
+    Write a columnar coverage table from complete arrays.
+
+    Parameters
+    ----------
+    dirname : str or Path
+        Output directory.
+    data : dict
+        Column arrays. Keys must be in the default columns (see
+        `open_otf_coords_npy`).
+    meta : dict, optional
+        Extra entries for meta.json.
+    '''
+
+    columns = {name: otf_coords_columns[name] for name in data}
+    nrows = len(next(iter(data.values())))
+
+    buffers = open_otf_coords_npy(dirname, nrows, columns=columns)
+    for name, values in data.items():
+        buffers[name][:] = values
+
+    close_otf_coords_npy(dirname, buffers, columns=columns, meta=meta)
+
+
+def read_otf_coords(filename, columns=None, memmap=True):
+    '''
+    Read a coverage table in either output format.
+
+    Columnar tables are memory mapped, so only the pages of the columns
+    actually used are read from disk.
+
+    Parameters
+    ----------
+    filename : str or Path
+        ``*_target_otf_coords.fits`` file or ``*_target_otf_coords``
+        columnar directory.
+    columns : list, optional
+        Columns to read. Defaults to all.
+    memmap : bool
+        Memory map the data instead of reading it into memory.
+
+    Returns
+    -------
+    coords : `~astropy.table.Table`
+        The coverage table. The positions are in radians for the columnar
+        format and in degrees for FITS; use the column units.
+    '''
+
+    filename = Path(filename)
+
+    if not filename.is_dir():
+        coords = Table.read(filename, memmap=memmap)
+        return coords if columns is None else coords[columns]
+
+    meta_filename = filename / "meta.json"
+    if not meta_filename.exists():
+        raise FileNotFoundError(f"{meta_filename} not found. The output may be incomplete.")
+
+    with open(meta_filename, "r") as f:
+        meta = json.load(f)
+
+    if columns is None:
+        columns = meta['columns']
+
+    coords = Table(meta={key: value for key, value in meta.items()
+                         if key not in ['columns', 'units']})
+    for name in columns:
+        values = np.load(filename / f"{name}.npy", mmap_mode='r' if memmap else None)
+        unit = meta['units'].get(name) or None
+        coords.add_column(Column(values, name=name, unit=unit, copy=False), copy=False)
+
+    return coords
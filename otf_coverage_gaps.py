@@ -0,0 +1,443 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.convolution import convolve_fft
+from astropy.coordinates import SkyCoord
+from astropy.table import QTable
+
+from extract_spatial_coverage import apply_spherical_offsets
+from otf_coverage_maps import primary_beam_weight_kernel
+from otf_instrumentation import timed
+from otf_map_functions import sma_pb_fwhm
+from otf_mosaic_regions import box_axis_vectors
+
+
+def _unit_vectors(lon, lat):
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def _tangent_offsets(xyz, lon0, lat0):
+    '''
+    Gnomonic (tangent-plane) east and north offsets (rad) about (lon0, lat0).
+
+    Only needs dot products with the unit vectors, so no trigonometry per
+    dump. Matches the spherical offsets to < 0.01 arcsec on map scales.
+    '''
+
+    sin_lon0, cos_lon0 = np.sin(lon0), np.cos(lon0)
+    sin_lat0, cos_lat0 = np.sin(lat0), np.cos(lat0)
+
+    center = np.array([cos_lat0 * cos_lon0, cos_lat0 * sin_lon0, sin_lat0])
+    east = np.array([-sin_lon0, cos_lon0, 0.])
+    north = np.array([-sin_lat0 * cos_lon0, -sin_lat0 * sin_lon0, cos_lat0])
+
+    depth = center @ xyz
+
+    return (east @ xyz) / depth, (north @ xyz) / depth
+
+
+def build_dump_index(ra, dec, cell_size=0.1 * u.deg, t_dump=0.6 * u.s):
+    '''
+    Grid hash of dump positions for fast spatial queries.
+
+    The dumps are projected about the mean position, binned into square
+    cells and sorted by cell once. A query then only touches the dumps in the
+    cells that overlap the search box.
+
+    Parameters
+    ----------
+    ra, dec : `~astropy.units.Quantity`
+        Dump positions, e.g. from `extract_spatial_coverage.py` tables.
+    cell_size : `~astropy.units.Quantity`
+        Cell size. About half the size of one map works well.
+    t_dump : `~astropy.units.Quantity`
+        Time per dump. Scalar or one value per dump.
+
+    Returns
+    -------
+    index : dict
+        Sorted dump unit vectors, times (s) and the cell boundaries.
+    '''
+
+    lon = np.asarray(ra.to_value(u.rad), dtype=np.float64)
+    lat = np.asarray(dec.to_value(u.rad), dtype=np.float64)
+
+    # Center from the mean unit vector
+    lon0 = np.arctan2(np.sin(lon).mean(), np.cos(lon).mean())
+    lat0 = np.median(lat)
+
+    xyz = _unit_vectors(lon, lat)
+
+    dx, dy = _tangent_offsets(xyz, lon0, lat0)
+
+    cell = cell_size.to_value(u.rad)
+    ix = np.floor(dx / cell).astype(np.int64)
+    iy = np.floor(dy / cell).astype(np.int64)
+
+    ix0 = ix.min()
+    iy0 = iy.min()
+    nx = ix.max() - ix0 + 1
+
+    cell_id = (iy - iy0) * nx + (ix - ix0)
+
+    order = np.argsort(cell_id, kind='stable')
+
+    t_dump_s = np.broadcast_to(t_dump.to_value(u.s), lon.shape)
+
+    return dict(xyz=xyz[:, order], time=t_dump_s[order],
+                cell_id=cell_id[order],
+                lon0=lon0, lat0=lat0, cell=cell,
+                ix0=ix0, iy0=iy0, nx=nx, ny=iy.max() - iy0 + 1)
+
+
+def query_dump_index(index, center, radius):
+    '''
+    Indices into the sorted index arrays for dumps within a box about a position.
+
+    Parameters
+    ----------
+    index : dict
+        From `build_dump_index`.
+    center : `~astropy.coordinates.SkyCoord`
+        Search center.
+    radius : `~astropy.units.Quantity`
+        Half-width of the search box.
+
+    Returns
+    -------
+    idx : `~numpy.ndarray`
+        Dumps in the cells overlapping the box. May include dumps slightly
+        outside of it.
+    '''
+
+    cx, cy = _tangent_offsets(_unit_vectors(center.ra.to_value(u.rad), center.dec.to_value(u.rad)),
+                              index['lon0'], index['lat0'])
+    radius = radius.to_value(u.rad)
+
+    ix = np.arange(np.floor((cx - radius) / index['cell']),
+                   np.floor((cx + radius) / index['cell']) + 1).astype(np.int64) - index['ix0']
+    iy = np.arange(np.floor((cy - radius) / index['cell']),
+                   np.floor((cy + radius) / index['cell']) + 1).astype(np.int64) - index['iy0']
+
+    ix = ix[(ix >= 0) & (ix < index['nx'])]
+    iy = iy[(iy >= 0) & (iy < index['ny'])]
+
+    if ix.size == 0 or iy.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Each row of cells is a contiguous range of cell IDs
+    first = iy * index['nx'] + ix.min()
+    last = iy * index['nx'] + ix.max()
+
+    starts = np.searchsorted(index['cell_id'], first, side='left')
+    ends = np.searchsorted(index['cell_id'], last, side='right')
+
+    return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+
+def map_frame_eff_time(index, center, width, height, angle,
+                       theta_pb, pixel_scale):
+    '''
+    Effective time on a grid aligned with one map.
+
+    Parameters
+    ----------
+    index : dict
+        From `build_dump_index`.
+    center : `~astropy.coordinates.SkyCoord`
+        Map center.
+    width, height, angle : `~astropy.units.Quantity`
+        Map box (`regions` convention). The rows run along the width.
+    theta_pb : `~astropy.units.Quantity`
+        Primary beam FWHM.
+    pixel_scale : `~astropy.units.Quantity`
+        Grid cell size.
+
+    Returns
+    -------
+    eff_time : `~numpy.ndarray`
+        Beam-weighted time (s) with shape (N_v, N_u), covering the box.
+    u_grid, v_grid : `~numpy.ndarray`
+        Cell centers (deg) along and across the rows.
+    '''
+
+    pix = pixel_scale.to_value(u.deg)
+    half_u = 0.5 * width.to_value(u.deg)
+    half_v = 0.5 * height.to_value(u.deg)
+
+    kernel = primary_beam_weight_kernel(theta_pb, pixel_scale)
+    pad = (kernel.shape[0] // 2) * pix
+
+    # Dumps that can contribute to the box through the beam
+    radius = np.hypot(half_u, half_v) * u.deg + pad * u.deg
+    idx = query_dump_index(index, center, radius)
+
+    dlon, dlat = _tangent_offsets(index['xyz'][:, idx],
+                                  center.ra.to_value(u.rad), center.dec.to_value(u.rad))
+    east = np.rad2deg(dlon)
+    north = np.rad2deg(dlat)
+
+    width_dir, height_dir = box_axis_vectors(angle)
+    du = east * width_dir[0] + north * width_dir[1]
+    dv = east * height_dir[0] + north * height_dir[1]
+
+    nu = 2 * int(np.ceil((half_u + pad) / pix)) + 1
+    nv = 2 * int(np.ceil((half_v + pad) / pix)) + 1
+
+    iu = np.round(du / pix).astype(np.int64) + nu // 2
+    iv = np.round(dv / pix).astype(np.int64) + nv // 2
+
+    inside = (iu >= 0) & (iu < nu) & (iv >= 0) & (iv < nv)
+
+    time = np.bincount(iv[inside] * nu + iu[inside], weights=index['time'][idx][inside],
+                       minlength=nu * nv).reshape(nv, nu)
+
+    eff_time = convolve_fft(time, kernel, normalize_kernel=False,
+                            boundary='fill', fill_value=0.)
+    eff_time[eff_time < 1e-6 * max(eff_time.max(), 1e-30)] = 0.
+
+    u_grid = (np.arange(nu) - nu // 2) * pix
+    v_grid = (np.arange(nv) - nv // 2) * pix
+
+    # Trim to the box
+    keep_u = np.abs(u_grid) <= half_u
+    keep_v = np.abs(v_grid) <= half_v
+
+    return eff_time[np.ix_(keep_v, keep_u)], u_grid[keep_u], v_grid[keep_v]
+
+
+def _deficit_boxes(deficit, u_grid, v_grid, merge_gap, min_length, min_height):
+    '''
+    Group rows with a deficit into contiguous bands and bound each band.
+    '''
+
+    rows_with_gap = deficit.any(axis=1)
+
+    if not rows_with_gap.any():
+        return []
+
+    pix = v_grid[1] - v_grid[0] if v_grid.size > 1 else 1.
+
+    # Split into bands where rows without a deficit span more than merge_gap
+    gap_rows = np.flatnonzero(rows_with_gap)
+    breaks = np.flatnonzero(np.diff(v_grid[gap_rows]) > merge_gap + pix)
+    bands = np.split(gap_rows, breaks + 1)
+
+    boxes = []
+    for band in bands:
+        cols = np.flatnonzero(deficit[band].any(axis=0))
+
+        u_min, u_max = u_grid[cols].min(), u_grid[cols].max()
+        v_min, v_max = v_grid[band].min(), v_grid[band].max()
+
+        length = max(u_max - u_min + pix, min_length)
+        height = max(v_max - v_min + pix, min_height)
+
+        boxes.append((0.5 * (u_min + u_max), 0.5 * (v_min + v_max), length, height,
+                      deficit[band].sum()))
+
+    return boxes
+
+
+@timed('coverage.gaps')
+def find_coverage_gaps(coords, maps,
+                       predicted_coords=None,
+                       t_dump=0.6 * u.s,
+                       target_eff_time=None,
+                       depth_fraction=0.8,
+                       theta_pb=None,
+                       freq=230 * u.GHz,
+                       pixel_scale=None,
+                       merge_gap=None,
+                       edge_margin=None,
+                       index_cell_size=None):
+    '''
+    Find the parts of each intended map below the target depth and the OTF
+    maps needed to fill them.
+
+    The dumps are indexed once with `build_dump_index`. For each map, only
+    nearby dumps are gridded on the map's own (row, column) frame and weighted
+    by the squared primary beam, as in `otf_coverage_maps`. The target depth
+    per cell is ``depth_fraction`` times the predicted effective time (if
+    ``predicted_coords`` are given, e.g. from `otf_sampling_simulator.py`),
+    else ``target_eff_time``, else ``depth_fraction`` times the median over
+    the map. Without a prediction the beam-weighted time always falls off
+    at the row ends and the outer rows, so cells within ``edge_margin`` of
+    the map edges are left out of the median and the deficit test. Rows with
+    cells below the target are merged into bands, and each band becomes one
+    re-observation map with the same position angle.
+
+    Parameters
+    ----------
+    coords : `~astropy.table.Table` or list
+        Observed dumps (``ra``, ``dec``) from `extract_spatial_coverage.py`.
+        A list of tables is combined.
+    maps : `~astropy.table.QTable`
+        Intended maps from `otf_mosaic_regions.read_crtf_rotboxes`.
+    predicted_coords : `~astropy.table.Table` or list, optional
+        Predicted dumps for the same plan.
+    t_dump : `~astropy.units.Quantity`
+        Time per dump.
+    target_eff_time : `~astropy.units.Quantity`, optional
+        Target effective time per cell.
+    depth_fraction : float
+        Fraction of the predicted (or median) depth below which a cell is a gap.
+    theta_pb : `~astropy.units.Quantity`, optional
+        Primary beam FWHM. Defaults to `sma_pb_fwhm` at ``freq``.
+    freq : `~astropy.units.Quantity`
+        Frequency for the primary beam size.
+    pixel_scale : `~astropy.units.Quantity`, optional
+        Cell size. Defaults to 1/5 of the primary beam.
+    merge_gap : `~astropy.units.Quantity`, optional
+        Bands of deficient rows closer than this are merged. Defaults to the
+        primary beam.
+    edge_margin : `~astropy.units.Quantity`, optional
+        Edge band excluded from the test when ``predicted_coords`` are not
+        given. Defaults to the primary beam.
+    index_cell_size : `~astropy.units.Quantity`, optional
+        Cell size of the dump index. Defaults to half the smallest map side.
+
+    Returns
+    -------
+    gaps : `~astropy.table.QTable`
+        Re-observation maps with the `read_crtf_rotboxes` columns (write with
+        `otf_mosaic_regions.write_crtf_rotboxes`), plus the ``parent`` map
+        and the number of deficient cells.
+    report : `~astropy.table.QTable`
+        Per map: median and minimum effective time, target and the fraction
+        of the map below the target.
+    '''
+
+    if theta_pb is None:
+        theta_pb = sma_pb_fwhm(freq)
+    if pixel_scale is None:
+        pixel_scale = theta_pb / 5.
+    if merge_gap is None:
+        merge_gap = theta_pb
+    if edge_margin is None:
+        edge_margin = theta_pb
+    if index_cell_size is None:
+        index_cell_size = 0.5 * min(maps['width'].min(), maps['height'].min())
+
+    def _combine(tables):
+        if isinstance(tables, (list, tuple)):
+            ra = np.concatenate([u.Quantity(tab['ra']).to_value(u.deg) for tab in tables])
+            dec = np.concatenate([u.Quantity(tab['dec']).to_value(u.deg) for tab in tables])
+            return ra * u.deg, dec * u.deg
+        return u.Quantity(tables['ra']).to(u.deg), u.Quantity(tables['dec']).to(u.deg)
+
+    index = build_dump_index(*_combine(coords), cell_size=index_cell_size, t_dump=t_dump)
+
+    predicted_index = None
+    if predicted_coords is not None:
+        predicted_index = build_dump_index(*_combine(predicted_coords),
+                                           cell_size=index_cell_size, t_dump=t_dump)
+
+    min_length = 2 * theta_pb.to_value(u.deg)
+    min_height = theta_pb.to_value(u.deg)
+
+    gap_rows = []
+    report_rows = []
+
+    for this_map in maps:
+
+        center = SkyCoord(this_map['ra'], this_map['dec'])
+        box = (center, this_map['width'], this_map['height'], this_map['angle'])
+
+        eff_time, u_grid, v_grid = map_frame_eff_time(index, *box, theta_pb, pixel_scale)
+
+        if predicted_index is not None:
+            target, _, _ = map_frame_eff_time(predicted_index, *box, theta_pb, pixel_scale)
+            target = depth_fraction * target
+            tested = np.ones(eff_time.shape, dtype=bool)
+        else:
+            # The edges are shallower even in a complete map
+            margin = edge_margin.to_value(u.deg)
+            half_u = max(0.5 * this_map['width'].to_value(u.deg) - margin, np.abs(u_grid).min())
+            half_v = max(0.5 * this_map['height'].to_value(u.deg) - margin, np.abs(v_grid).min())
+            tested = (np.abs(v_grid)[:, None] <= half_v) & (np.abs(u_grid)[None, :] <= half_u)
+
+            if target_eff_time is not None:
+                target = np.full(eff_time.shape, target_eff_time.to_value(u.s))
+            else:
+                target = np.full(eff_time.shape, depth_fraction * np.median(eff_time[tested]))
+
+        deficit = tested & (eff_time < target)
+
+        report_rows.append([this_map['label'], np.median(eff_time[tested]), eff_time[tested].min(),
+                            np.median(target), deficit.sum() / tested.sum()])
+
+        boxes = _deficit_boxes(deficit, u_grid, v_grid, merge_gap.to_value(u.deg),
+                               min_length, min_height)
+
+        width_dir, height_dir = box_axis_vectors(this_map['angle'])
+
+        for ii, (u_cen, v_cen, length, height, ncells) in enumerate(boxes):
+            east = u_cen * width_dir[0] + v_cen * height_dir[0]
+            north = u_cen * width_dir[1] + v_cen * height_dir[1]
+
+            lon, lat = apply_spherical_offsets(center.ra.to_value(u.rad), center.dec.to_value(u.rad),
+                                               np.deg2rad(east), np.deg2rad(north))
+
+            gap_rows.append([f"{this_map['label']}-reobs-{ii + 1}",
+                             np.rad2deg(lon), np.rad2deg(lat),
+                             length * 3600., height * 3600.,
+                             this_map['angle'].to_value(u.deg),
+                             this_map['label'], int(ncells)])
+
+    gap_names = ['label', 'ra', 'dec', 'width', 'height', 'angle', 'parent', 'ncells']
+    if len(gap_rows) > 0:
+        gaps = QTable(rows=gap_rows, names=gap_names)
+    else:
+        gaps = QTable(names=gap_names, dtype=[str, float, float, float, float, float, str, int])
+
+    for name, unit in zip(['ra', 'dec', 'width', 'height', 'angle'],
+                          [u.deg, u.deg, u.arcsec, u.arcsec, u.deg]):
+        gaps[name] = gaps[name] * unit
+
+    report = QTable(rows=report_rows, names=['label', 'median_eff_time', 'min_eff_time',
+                                             'target_eff_time', 'frac_below_target'])
+    for name in ['median_eff_time', 'min_eff_time', 'target_eff_time']:
+        report[name] = report[name] * u.s
+
+    return gaps, report
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from otf_coords_io import read_otf_coords
+    from otf_mosaic_regions import read_crtf_rotboxes, write_crtf_rotboxes
+
+    parser = argparse.ArgumentParser(description="Find coverage gaps and write re-observation maps.")
+    parser.add_argument("regions", help="CRTF file with the intended maps.")
+    parser.add_argument("coords_filenames", nargs='+',
+                        help="*_target_otf_coords.fits tables or columnar directories "
+                             "from extract_spatial_coverage.py")
+    parser.add_argument("--predicted", nargs='*', default=None,
+                        help="Predicted *_target_otf_coords.fits tables.")
+    parser.add_argument("--depth-fraction", type=float, default=0.8)
+    parser.add_argument("--t-dump", type=float, default=0.6, help="Time per dump in s.")
+    parser.add_argument("--output", default="reobservation_maps.crtf")
+
+    args = parser.parse_args()
+
+    maps = read_crtf_rotboxes(args.regions)
+    coords = [read_otf_coords(filename, columns=['ra', 'dec']) for filename in args.coords_filenames]
+    predicted = None
+    if args.predicted:
+        predicted = [read_otf_coords(filename, columns=['ra', 'dec']) for filename in args.predicted]
+
+    gaps, report = find_coverage_gaps(coords, maps, predicted_coords=predicted,
+                                      t_dump=args.t_dump * u.s,
+                                      depth_fraction=args.depth_fraction)
+
+    report.pprint(max_lines=-1)
+
+    if len(gaps) > 0:
+        write_crtf_rotboxes(gaps, args.output)
+        print(f"Wrote {len(gaps)} re-observation maps to {args.output}")
+    else:
+        print("No coverage gaps found.")
@@ -0,0 +1,273 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.convolution import convolve_fft
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from otf_map_functions import sma_pb_fwhm
+from sensitivity_time_functions import time_to_rms
+
+
+def make_coverage_wcs(ra, dec, pixel_scale, padding=None):
+    '''
+    Make a TAN WCS and image shape that covers a set of pointings.
+
+    Parameters
+    ----------
+    ra, dec : `~astropy.units.Quantity`
+        Pointing positions.
+    pixel_scale : `~astropy.units.Quantity`
+        Pixel size in angular units.
+    padding : `~astropy.units.Quantity`, optional
+        Extra margin around the pointings. Defaults to 1.5 times the pixel
+        scale; use ~1 primary beam to include the full beam response.
+
+    Returns
+    -------
+    wcs : `~astropy.wcs.WCS`
+        Celestial WCS.
+    shape : tuple
+        Image shape (ny, nx).
+    '''
+
+    if padding is None:
+        padding = 1.5 * pixel_scale
+
+    coords = SkyCoord(ra, dec)
+
+    # Center from the mean unit vector, so maps across RA=0 are not centered
+    # on the far side of the sky
+    center = SkyCoord(coords.cartesian.mean(), frame=coords.frame,
+                      representation_type='cartesian')
+    center = SkyCoord(center.spherical.lon, center.spherical.lat, frame=coords.frame)
+
+    dx, dy = center.spherical_offsets_to(coords)
+
+    cdelt = pixel_scale.to_value(u.deg)
+    pad = padding.to_value(u.deg)
+
+    # Symmetric extent about the center
+    half_x = np.max(np.abs(dx.to_value(u.deg))) + pad
+    half_y = np.max(np.abs(dy.to_value(u.deg))) + pad
+
+    nx = 2 * int(np.ceil(half_x / cdelt)) + 1
+    ny = 2 * int(np.ceil(half_y / cdelt)) + 1
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [center.ra.deg, center.dec.deg]
+    wcs.wcs.crpix = [(nx + 1) / 2., (ny + 1) / 2.]
+    wcs.wcs.cdelt = [-cdelt, cdelt]
+    wcs.wcs.cunit = ['deg', 'deg']
+
+    return wcs, (ny, nx)
+
+
+def grid_otf_pointings(ra, dec, wcs, shape, t_dump=0.6 * u.s):
+    '''
+    Accumulate hit counts and integration time per pixel.
+
+    Uses a single `~numpy.bincount` over the flattened pixel indices, so the
+    cost is linear in the number of dumps.
+
+    Parameters
+    ----------
+    ra, dec : `~astropy.units.Quantity`
+        Pointing positions.
+    wcs : `~astropy.wcs.WCS`
+        Celestial WCS of the output image.
+    shape : tuple
+        Image shape (ny, nx).
+    t_dump : `~astropy.units.Quantity`
+        Integration time per dump. Scalar or one value per dump.
+
+    Returns
+    -------
+    hits : `~numpy.ndarray`
+        Number of dumps per pixel.
+    time : `~astropy.units.Quantity`
+        Integration time per pixel.
+    '''
+
+    xpix, ypix = wcs.wcs_world2pix(ra.to_value(u.deg), dec.to_value(u.deg), 0)
+
+    xpix = np.round(xpix).astype(int)
+    ypix = np.round(ypix).astype(int)
+
+    inside = (xpix >= 0) & (xpix < shape[1]) & (ypix >= 0) & (ypix < shape[0])
+    flat_index = ypix[inside] * shape[1] + xpix[inside]
+
+    npix = shape[0] * shape[1]
+
+    hits = np.bincount(flat_index, minlength=npix).reshape(shape)
+
+    t_dump_s = np.broadcast_to(t_dump.to_value(u.s), xpix.shape)[inside]
+    time = np.bincount(flat_index, weights=t_dump_s, minlength=npix).reshape(shape) * u.s
+
+    return hits, time
+
+
+def primary_beam_weight_kernel(theta_pb, pixel_scale, nfwhm=3.):
+    '''
+    Squared Gaussian primary beam response sampled on the image pixels.
+
+    The squared beam is the per-dump weight of a linear mosaic, so convolving
+    the time map with this kernel gives the effective integration time.
+
+    Parameters
+    ----------
+    theta_pb : `~astropy.units.Quantity`
+        Primary beam FWHM.
+    pixel_scale : `~astropy.units.Quantity`
+        Pixel size in angular units.
+    nfwhm : float
+        Half-width of the kernel in units of the FWHM.
+
+    Returns
+    -------
+    kernel : `~numpy.ndarray`
+        Kernel with a peak of 1.
+    '''
+
+    fwhm_pix = (theta_pb / pixel_scale).to_value(u.one)
+
+    half_size = int(np.ceil(nfwhm * fwhm_pix))
+    yy, xx = np.mgrid[-half_size:half_size + 1, -half_size:half_size + 1]
+
+    sigma_pix = fwhm_pix / np.sqrt(8 * np.log(2))
+
+    beam = np.exp(-(xx**2 + yy**2) / (2 * sigma_pix**2))
+
+    return beam**2
+
+
+def otf_coverage_maps(ra, dec,
+                      t_dump=0.6 * u.s,
+                      band=230,
+                      freq=230 * u.GHz,
+                      theta_pb=None,
+                      pixel_scale=None,
+                      wcs=None,
+                      shape=None,
+                      rms_band_dict=None):
+    '''
+    Grid OTF pointings into hit-count, effective time and predicted rms maps.
+
+    The dumps are binned onto the image with `grid_otf_pointings` and the
+    time map is FFT-convolved with the squared primary beam from
+    `sma_pb_fwhm`. The predicted rms follows the `time_to_rms` scaling.
+
+    Parameters
+    ----------
+    ra, dec : `~astropy.units.Quantity`
+        Pointing positions, e.g. from the `extract_spatial_coverage.py` tables.
+    t_dump : `~astropy.units.Quantity`
+        Integration time per dump. Scalar or one value per dump.
+    band : int or str
+        Band key for `time_to_rms`.
+    freq : `~astropy.units.Quantity`
+        Frequency for the primary beam size. Used if theta_pb is None.
+    theta_pb : `~astropy.units.Quantity`, optional
+        Primary beam FWHM.
+    pixel_scale : `~astropy.units.Quantity`, optional
+        Pixel size. Defaults to 1/5 of the primary beam.
+    wcs : `~astropy.wcs.WCS`, optional
+        Output WCS. Made with `make_coverage_wcs` if not given.
+    shape : tuple, optional
+        Output shape. Required if ``wcs`` is given.
+    rms_band_dict : dict, optional
+        Passed to `time_to_rms`. Defaults to the 1 km/s line sensitivities.
+
+    Returns
+    -------
+    out_dict : dict
+        ``hits``, ``time``, ``eff_time`` and ``rms`` maps, plus the ``wcs``.
+    '''
+
+    if theta_pb is None:
+        theta_pb = sma_pb_fwhm(freq)
+
+    if pixel_scale is None:
+        pixel_scale = theta_pb / 5.
+
+    if wcs is None:
+        wcs, shape = make_coverage_wcs(ra, dec, pixel_scale, padding=theta_pb)
+    elif shape is None:
+        raise ValueError('shape must be given with wcs.')
+
+    hits, time = grid_otf_pointings(ra, dec, wcs, shape, t_dump=t_dump)
+
+    kernel = primary_beam_weight_kernel(theta_pb, pixel_scale)
+
+    eff_time = convolve_fft(time.to_value(u.s), kernel,
+                            normalize_kernel=False,
+                            boundary='fill', fill_value=0.,
+                            allow_huge=True)
+    # Remove FFT round-off where there is no coverage
+    eff_time[eff_time < 1e-6 * eff_time.max()] = 0.
+    eff_time = eff_time * u.s
+
+    rms_kwargs = {} if rms_band_dict is None else dict(rms_band_dict=rms_band_dict)
+
+    with np.errstate(divide='ignore'):
+        rms = time_to_rms(eff_time, band, **rms_kwargs)
+
+    return dict(hits=hits, time=time, eff_time=eff_time, rms=rms, wcs=wcs)
+
+
+def write_coverage_maps(coverage, filename, overwrite=True):
+    '''
+    Write the output of `otf_coverage_maps` to a multi-extension FITS file.
+    '''
+
+    header = coverage['wcs'].to_header()
+
+    hdus = [fits.PrimaryHDU()]
+    for name in ['hits', 'time', 'eff_time', 'rms']:
+        data = coverage[name]
+
+        this_header = header.copy()
+        if hasattr(data, 'unit'):
+            this_header['BUNIT'] = data.unit.to_string()
+            data = data.value
+
+        hdus.append(fits.ImageHDU(data=data, header=this_header, name=name.upper()))
+
+    fits.HDUList(hdus).writeto(filename, overwrite=overwrite)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from pathlib import Path
+
+    from otf_coords_io import read_otf_coords
+
+    parser = argparse.ArgumentParser(description="Grid OTF pointings into coverage and depth maps.")
+    parser.add_argument("coords_filename",
+                        help="*_target_otf_coords.fits table or columnar directory "
+                             "from extract_spatial_coverage.py")
+    parser.add_argument("--t-dump", type=float, default=0.6,
+                        help="Time per dump in s. Not used if the table has rinteg.")
+    parser.add_argument("--band", default="230")
+    parser.add_argument("--output", default=None)
+
+    args = parser.parse_args()
+
+    coords = read_otf_coords(args.coords_filename)
+
+    t_dump = coords['rinteg'].quantity if 'rinteg' in coords.colnames else args.t_dump * u.s
+
+    band = int(args.band) if args.band.isdigit() else args.band
+
+    coverage = otf_coverage_maps(coords['ra'].quantity, coords['dec'].quantity,
+                                 t_dump=t_dump, band=band)
+
+    output = args.output
+    if output is None:
+        name = Path(args.coords_filename).name.replace(".fits", "").replace("_target_otf_coords", ".fits")
+        output = f"{Path(name).stem}_coverage_maps.fits"
+
+    write_coverage_maps(coverage, output)
@@ -0,0 +1,723 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.convolution import convolve_fft
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+from pyuvdata.uvdata.mir_meta_data import in_dtype, sp_dtype
+
+from pathlib import Path
+import time
+
+from extract_spatial_coverage import apply_spherical_offsets
+from otf_coverage_maps import make_coverage_wcs, primary_beam_weight_kernel
+from otf_instrumentation import count, stage, get_logger
+from otf_map_functions import sma_pb_fwhm
+from otf_track_simulator import parse_obs_script
+from sensitivity_time_functions import time_to_rms
+
+
+logger = get_logger("otf_coverage_monitor")
+
+
+def script_otf_params(script_filename):
+    '''
+    OTF pattern and map centers of a perl observing script.
+
+    Returns
+    -------
+    otf_params : dict
+        ``row_length``, ``row_offset``, ``n_rows``, ``scan_speed``,
+        ``pos_angle`` and ``t_dump`` of the full (interleaved) map.
+    target_coords : `~astropy.coordinates.SkyCoord`
+        Map centers.
+    '''
+
+    script = parse_obs_script(script_filename)
+
+    otf_params = dict(row_length=float(script['rowLength0']) * u.arcsec,
+                      row_offset=float(script['rowOffset0']) * u.arcsec,
+                      n_rows=int(float(script['nRows0'])),
+                      scan_speed=float(script['scanSpeedOTF0']) * u.arcsec / u.s,
+                      pos_angle=float(script.get('posAngle0', 0.)) * u.deg,
+                      t_dump=float(script.get('inttime_sci', 0.6)) * u.s)
+
+    return otf_params, script['target_coords']
+
+
+def _half_rows(across, step, n_rows, start_row):
+    '''
+    Rows of one half matched to the across-row positions.
+
+    Row k of a half is at (k + start_row - (n_half - 1) / 2) * step.
+    '''
+
+    n_half = n_rows // 2 if start_row == 0 else n_rows - n_rows // 2
+
+    position = across / step - start_row + 0.5 * (n_half - 1)
+    row = np.round(position).astype(int)
+    rms = np.sqrt(np.mean((position - row)**2)) * step
+
+    return n_half, row, rms
+
+
+def otf_call_half(offx, offy, row_offset, n_rows,
+                  pos_angle=0 * u.deg,
+                  across_tol=0.25,
+                  **kwargs):
+    '''
+    Which halves of the map the dumps of one `otf` call fit.
+
+    A half fits if the rms across-row offset of the dumps from its rows is
+    within ``across_tol`` row offsets and no dump falls outside them. For even ``n_rows`` the two halves are on
+    different grids, so only one fits; for odd ``n_rows`` they share a grid
+    and only the extra row of the odd half tells them apart.
+
+    Returns
+    -------
+    start_rows : list
+        Start rows (0 and/or 0.5) that fit the dumps.
+    '''
+
+    pa = pos_angle.to_value(u.rad)
+    across = -np.asarray(offx) * np.sin(pa) + np.asarray(offy) * np.cos(pa)
+    step = 2 * row_offset.to_value(u.arcsec)
+
+    fits = []
+    for start_row in [0., 0.5]:
+        n_half, row, rms = _half_rows(across, step, n_rows, start_row)
+        if rms <= across_tol * step / 2. and row.min() >= 0 and row.max() < n_half:
+            fits.append(start_row)
+
+    return fits
+
+
+def check_otf_call(offx, offy, mjd, row_length, row_offset, n_rows, scan_speed,
+                   start_row=0.,
+                   pos_angle=0 * u.deg,
+                   t_dump=0.6 * u.s,
+                   across_tol=0.25,
+                   speed_tol=0.1,
+                   length_tol=0.1):
+    '''
+    Compare the dumps of one `otf` command with its intended rows.
+
+    The map is observed as two `otf` commands (observeTargetOTF) in
+    observeTargetLoopOTFInterleaveMulti: floor(n_rows / 2) rows from start
+    row 0 and ceil(n_rows / 2) rows from start row 0.5, both at twice the
+    row offset. The dumps are rotated into the scan frame and matched to the
+    rows of the half given by ``start_row`` (see `otf_call_half` for telling
+    the halves apart).
+
+    Parameters
+    ----------
+    offx, offy : `~numpy.ndarray`
+        RA and Dec offsets of the dumps in arcsec.
+    mjd : `~numpy.ndarray`
+        Time of the dumps in days.
+    row_length, row_offset, n_rows, scan_speed, pos_angle, t_dump
+        OTF pattern of the full map, as in `interleaved_dump_offsets`.
+    start_row : float
+        0 for the first `otf` call of a map (even rows), 0.5 for the second
+        (odd rows).
+    across_tol : float
+        Allowed rms offset from the row centers, as a fraction of
+        ``row_offset``.
+    speed_tol, length_tol : float
+        Allowed fractional error of the scan speed and row length.
+
+    Returns
+    -------
+    out_dict : dict
+        ``start_row``, ``n_rows`` (intended) and ``n_rows_observed``, the
+        ``missing_rows``, ``across_rms`` (arcsec), measured ``scan_speed``
+        (arcsec/s) and ``row_length`` (arcsec), ``n_dump`` and ``ok``.
+    '''
+
+    offx = np.asarray(offx, dtype=np.float64)
+    offy = np.asarray(offy, dtype=np.float64)
+    time_s = (np.asarray(mjd, dtype=np.float64) - mjd[0]) * 86400.
+
+    row_length = row_length.to_value(u.arcsec)
+    step = 2 * row_offset.to_value(u.arcsec)
+    speed = scan_speed.to_value(u.arcsec / u.s)
+    t_dump = t_dump.to_value(u.s)
+
+    pa = pos_angle.to_value(u.rad)
+    along = offx * np.cos(pa) + offy * np.sin(pa)
+    across = -offx * np.sin(pa) + offy * np.cos(pa)
+
+    n_half, row, across_rms = _half_rows(across, step, n_rows, start_row)
+
+    observed = np.unique(row)
+    missing_rows = np.setdiff1d(np.arange(n_half), observed)
+
+    # Scan speed and length from consecutive dumps within a row
+    same_row = np.diff(row) == 0
+    dt = np.diff(time_s)[same_row]
+    dalong = np.abs(np.diff(along))[same_row]
+    good = dt > 0
+    scan_speed_obs = np.median(dalong[good] / dt[good]) if good.any() else np.nan
+
+    extent = np.array([np.ptp(along[row == this_row]) for this_row in observed])
+    row_length_obs = np.median(extent) + t_dump * scan_speed_obs
+
+    ok = (missing_rows.size == 0
+          and np.all((observed >= 0) & (observed < n_half))
+          and across_rms <= across_tol * step / 2.
+          and abs(scan_speed_obs / speed - 1) <= speed_tol
+          and row_length_obs >= (1 - length_tol) * row_length)
+
+    return dict(start_row=start_row,
+                n_rows=n_half,
+                n_rows_observed=int(np.sum((observed >= 0) & (observed < n_half))),
+                missing_rows=missing_rows,
+                across_rms=across_rms,
+                scan_speed=scan_speed_obs,
+                row_length=row_length_obs,
+                n_dump=offx.size,
+                ok=bool(ok))
+
+
+def _read_new_records(filename, offset, dtype):
+    '''
+    Read the whole records appended to a MIR header file since ``offset``.
+    '''
+
+    filename = Path(filename)
+    if not filename.exists():
+        return np.zeros(0, dtype=dtype), offset
+
+    nbytes = (filename.stat().st_size - offset) // dtype.itemsize * dtype.itemsize
+    if nbytes <= 0:
+        return np.zeros(0, dtype=dtype), offset
+
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        buffer = f.read(nbytes)
+
+    # A partially written record at the end is left for the next poll
+    nbytes = len(buffer) // dtype.itemsize * dtype.itemsize
+
+    return np.frombuffer(buffer[:nbytes], dtype=dtype), offset + nbytes
+
+
+def start_coverage_monitor(mir_filename,
+                           script_filename=None,
+                           otf_params=None,
+                           target_coords=None,
+                           wcs=None,
+                           shape=None,
+                           band=230,
+                           freq=230 * u.GHz,
+                           theta_pb=None,
+                           pixel_scale=None,
+                           gap_time=30 * u.s):
+    '''
+    Set up the state for following a MIR dataset while it is written.
+
+    Parameters
+    ----------
+    mir_filename : str or Path
+        MIR dataset directory. It does not need to exist yet.
+    script_filename : str or Path, optional
+        Perl observing script for the track. Gives ``otf_params`` and
+        ``target_coords`` (see `script_otf_params`).
+    otf_params : dict, optional
+        ``row_length``, ``row_offset``, ``n_rows``, ``scan_speed``,
+        ``pos_angle`` and ``t_dump`` of the full map. Needed to check the
+        `otf` calls.
+    target_coords : `~astropy.coordinates.SkyCoord`, optional
+        Map centers, used to make the WCS.
+    wcs : `~astropy.wcs.WCS`, optional
+        Output WCS. Made with `make_coverage_wcs` from ``target_coords`` if
+        not given.
+    shape : tuple, optional
+        Output shape. Required if ``wcs`` is given.
+    band, freq, theta_pb, pixel_scale
+        As in `otf_coverage_maps`.
+    gap_time : `~astropy.units.Quantity`
+        A break in the OTF dumps longer than this starts a new `otf` call.
+
+    Returns
+    -------
+    state : dict
+        Monitor state, updated in place by `poll_coverage_monitor`.
+    '''
+
+    if script_filename is not None:
+        script_params, script_coords = script_otf_params(script_filename)
+        if otf_params is None:
+            otf_params = script_params
+        if target_coords is None:
+            target_coords = script_coords
+
+    if theta_pb is None:
+        theta_pb = sma_pb_fwhm(freq)
+
+    if pixel_scale is None:
+        pixel_scale = theta_pb / 5.
+
+    if wcs is None:
+        if target_coords is None:
+            raise ValueError('One of script_filename, target_coords or wcs must be given.')
+
+        target_coords = SkyCoord(target_coords)
+
+        # Pad by the half diagonal of a map plus one primary beam
+        padding = theta_pb
+        if otf_params is not None:
+            padding = padding + np.hypot(0.5 * otf_params['row_length'],
+                                         0.5 * otf_params['n_rows'] * otf_params['row_offset'])
+
+        wcs, shape = make_coverage_wcs(np.atleast_1d(target_coords.ra),
+                                       np.atleast_1d(target_coords.dec),
+                                       pixel_scale, padding=padding)
+    elif shape is None:
+        raise ValueError('shape must be given with wcs.')
+
+    kernel = primary_beam_weight_kernel(theta_pb, pixel_scale)
+    half_size = kernel.shape[0] // 2
+
+    return dict(mir_filename=Path(mir_filename),
+                otf_params=otf_params,
+                wcs=wcs,
+                shape=shape,
+                band=band,
+                kernel=kernel,
+                gap_time=gap_time.to_value(u.d),
+                in_offset=0,
+                sp_offset=0,
+                good_inhid=np.zeros(0, dtype=bool),
+                max_sp_inhid=-1,
+                pending=np.zeros(0, dtype=in_dtype),
+                fields={},
+                call=None,
+                calls=[],
+                prev_call=None,
+                hits=np.zeros(shape, dtype=np.int64),
+                time=np.zeros(shape),
+                # Padded by the kernel half-width so updates at the edges
+                # need no clipping
+                eff_time=np.zeros((shape[0] + 2 * half_size, shape[1] + 2 * half_size)),
+                n_int=0,
+                n_otf=0,
+                last_update=None)
+
+
+def _update_good_inhid(state, sp_records):
+    '''
+    Mark the integrations with an unflagged spectral record.
+    '''
+
+    if sp_records.size == 0:
+        return
+
+    inhid = np.asarray(sp_records['inhid'])
+    state['max_sp_inhid'] = max(state['max_sp_inhid'], int(inhid.max()))
+
+    good = inhid[np.asarray(sp_records['flags']) == 0]
+
+    good_inhid = state['good_inhid']
+    if state['max_sp_inhid'] >= good_inhid.size:
+        # Grow geometrically so a long track is not copied on every poll
+        new_size = max(state['max_sp_inhid'] + 1, 2 * good_inhid.size)
+        good_inhid = np.concatenate([good_inhid, np.zeros(new_size - good_inhid.size, dtype=bool)])
+        state['good_inhid'] = good_inhid
+
+    good_inhid[good] = True
+
+
+def _field_ids(state, rar, decr):
+    '''
+    Field IDs in the order the fields are first seen, kept across polls.
+    '''
+
+    pairs, inverse = np.unique(np.stack([rar, decr], axis=1), axis=0, return_inverse=True)
+
+    fields = state['fields']
+    ids = np.array([fields.setdefault(tuple(pair), len(fields)) for pair in pairs], dtype=int)
+
+    return ids[inverse.ravel()]
+
+
+def _grid_dumps(state, lon, lat, rinteg):
+    '''
+    Add dumps to the hit, time and effective-time maps.
+
+    Only the bounding box of the new dumps is convolved with the primary
+    beam kernel, so the cost of a poll scales with the area it touches.
+    '''
+
+    shape = state['shape']
+
+    xpix, ypix = state['wcs'].wcs_world2pix(np.rad2deg(lon), np.rad2deg(lat), 0)
+    xpix = np.round(xpix).astype(int)
+    ypix = np.round(ypix).astype(int)
+
+    inside = (xpix >= 0) & (xpix < shape[1]) & (ypix >= 0) & (ypix < shape[0])
+    if not inside.any():
+        return
+
+    xpix = xpix[inside]
+    ypix = ypix[inside]
+    rinteg = rinteg[inside]
+
+    np.add.at(state['hits'], (ypix, xpix), 1)
+    np.add.at(state['time'], (ypix, xpix), rinteg)
+
+    x0, x1 = xpix.min(), xpix.max() + 1
+    y0, y1 = ypix.min(), ypix.max() + 1
+
+    kernel = state['kernel']
+    half_size = kernel.shape[0] // 2
+
+    patch_shape = (y1 - y0 + 2 * half_size, x1 - x0 + 2 * half_size)
+    flat_index = (ypix - y0 + half_size) * patch_shape[1] + (xpix - x0 + half_size)
+    patch = np.bincount(flat_index, weights=rinteg,
+                        minlength=patch_shape[0] * patch_shape[1]).reshape(patch_shape)
+
+    delta = convolve_fft(patch, kernel,
+                         normalize_kernel=False,
+                         boundary='fill', fill_value=0.)
+
+    state['eff_time'][y0:y1 + 2 * half_size, x0:x1 + 2 * half_size] += delta
+
+
+def _new_call(field_id, mjd):
+    return dict(offx=[], offy=[], mjd=[], field_id=field_id, last_mjd=mjd, ended_by_gain=False)
+
+
+def _finish_call(state, call):
+    '''
+    Check a completed otf call and add it to ``state['calls']``.
+    '''
+
+    offx = np.concatenate(call['offx'])
+    offy = np.concatenate(call['offy'])
+    mjd = np.concatenate(call['mjd'])
+
+    result = dict(field_id=call['field_id'], mjd_start=mjd[0], mjd_end=mjd[-1], n_dump=offx.size)
+
+    # Each visit to a map is gain, even rows, gain, odd rows. A call is the
+    # odd half if the previous otf call was the even half of the same field
+    # and only a gain scan came between them, and continues the previous
+    # half if a break in the dumps split it. observeTargetOTF skips a half
+    # below the elevation limit, so the dump positions override the order
+    # when only one half fits them.
+    prev = state['prev_call']
+    start_row = 0.
+    if prev is not None and prev['field_id'] == call['field_id']:
+        if not prev['ended_by_gain']:
+            start_row = prev['start_row']
+        elif prev['start_row'] == 0:
+            start_row = 0.5
+
+    if state['otf_params'] is not None:
+        fits = otf_call_half(offx, offy, **state['otf_params'])
+        if len(fits) == 1:
+            start_row = fits[0]
+
+    state['prev_call'] = dict(field_id=call['field_id'], start_row=start_row,
+                              ended_by_gain=call['ended_by_gain'])
+
+    if state['otf_params'] is not None:
+        with stage("monitor.check"):
+            result.update(check_otf_call(offx, offy, mjd, start_row=start_row,
+                                         **state['otf_params']))
+
+        if result['ok']:
+            logger.info(f"otf call {len(state['calls'])} on field {call['field_id']}: "
+                        f"{result['n_rows_observed']}/{result['n_rows']} rows from start row "
+                        f"{result['start_row']}, {offx.size} dumps.")
+        else:
+            logger.warning(f"otf call {len(state['calls'])} on field {call['field_id']} does not "
+                           f"match the intended rows: {result['n_rows_observed']}/{result['n_rows']} "
+                           f"rows (missing {list(result['missing_rows'])}), across rms "
+                           f"{result['across_rms']:.1f} arcsec, speed {result['scan_speed']:.2f} "
+                           f"arcsec/s, row length {result['row_length']:.0f} arcsec.")
+
+    count("monitor.calls")
+    state['calls'].append(result)
+
+
+def _segment_calls(state, records, field_id):
+    '''
+    Split the new records into otf calls and check the completed ones.
+
+    A call ends at a non-OTF integration (e.g. a gain scan), a change of
+    field or a break in the dumps longer than ``gap_time``.
+    '''
+
+    is_otf = np.asarray(records['rinteg']) < 2
+    mjd = np.asarray(records['mjd'])
+
+    call = state['call']
+    prev_otf = np.concatenate([[call is not None], is_otf[:-1]])
+    prev_field = np.concatenate([[-1 if call is None else call['field_id']], field_id[:-1]])
+    prev_mjd = np.concatenate([[-np.inf if call is None else call['last_mjd']], mjd[:-1]])
+
+    starts = is_otf & (~prev_otf | (field_id != prev_field) | (mjd - prev_mjd > state['gap_time']))
+    # Index of the first record after each OTF run
+    ends = ~is_otf & prev_otf
+
+    breaks = np.flatnonzero(starts | ends)
+    bounds = np.concatenate([breaks, [records.size]])
+
+    # Records before the first break continue the open call
+    if bounds[0] > 0 and call is not None:
+        for name in ("offx", "offy", "mjd"):
+            call[name].append(np.asarray(records[name][:bounds[0]]))
+        call['last_mjd'] = mjd[bounds[0] - 1]
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if call is not None:
+            # Ended by a non-OTF integration (a gain scan) rather than a
+            # change of field or a break
+            call['ended_by_gain'] = bool(ends[start])
+            _finish_call(state, call)
+            call = None
+
+        if starts[start]:
+            call = _new_call(field_id[start], mjd[end - 1])
+            for name in ("offx", "offy", "mjd"):
+                call[name].append(np.asarray(records[name][start:end]))
+
+    state['call'] = call
+
+
+def poll_coverage_monitor(state, final=False):
+    '''
+    Read the records added to the dataset since the last poll and update
+    the coverage.
+
+    Only the new bytes of in_read and sp_read are read. An integration is
+    processed once the spectral records of a later integration have been
+    seen, so its flags are complete; ``final=True`` processes everything
+    and closes the last otf call.
+
+    Parameters
+    ----------
+    state : dict
+        From `start_coverage_monitor`. Updated in place.
+    final : bool
+        The dataset is complete.
+
+    Returns
+    -------
+    calls : list of dict
+        Checks of the otf calls completed in this poll (see `check_otf_call`).
+    '''
+
+    n_calls = len(state['calls'])
+
+    with stage("monitor.poll"):
+        mir_filename = state['mir_filename']
+
+        with stage("monitor.read"):
+            sp_records, state['sp_offset'] = _read_new_records(mir_filename / "sp_read",
+                                                               state['sp_offset'], sp_dtype)
+            in_records, state['in_offset'] = _read_new_records(mir_filename / "in_read",
+                                                               state['in_offset'], in_dtype)
+
+        _update_good_inhid(state, sp_records)
+
+        if state['pending'].size > 0:
+            in_records = np.concatenate([state['pending'], in_records])
+
+        inhid = np.asarray(in_records['inhid'])
+        ready = np.ones(inhid.size, dtype=bool) if final else inhid < state['max_sp_inhid']
+        # Records are written in order, so keep everything after the first one not ready
+        n_ready = inhid.size if ready.all() else int(np.argmin(ready))
+        state['pending'] = in_records[n_ready:].copy()
+        in_records = in_records[:n_ready]
+
+        if in_records.size > 0:
+            state['n_int'] += in_records.size
+            count("monitor.integrations", in_records.size)
+
+            rar = np.asarray(in_records['rar'])
+            decr = np.asarray(in_records['decr'])
+            is_otf = np.asarray(in_records['rinteg']) < 2
+
+            # Only the OTF maps are numbered, as in extract_spatial_coverage.py
+            field_id = np.full(in_records.size, -1)
+            if is_otf.any():
+                field_id[is_otf] = _field_ids(state, rar[is_otf], decr[is_otf])
+
+            _segment_calls(state, in_records, field_id)
+
+            inhid = inhid[:n_ready]
+            good_inhid = state['good_inhid']
+            in_range = inhid < good_inhid.size
+            select = is_otf.copy()
+            select[in_range] &= good_inhid[inhid[in_range]]
+            select[~in_range] = False
+
+            if select.any():
+                with stage("monitor.grid"):
+                    lon, lat = apply_spherical_offsets(
+                        rar[select], decr[select],
+                        np.deg2rad(np.asarray(in_records['offx'][select], dtype=np.float64) / 3600.),
+                        np.deg2rad(np.asarray(in_records['offy'][select], dtype=np.float64) / 3600.))
+                    _grid_dumps(state, lon, lat,
+                                np.asarray(in_records['rinteg'][select], dtype=np.float64))
+                state['n_otf'] += int(select.sum())
+
+            state['last_update'] = time.time()
+
+        if final and state['call'] is not None:
+            _finish_call(state, state['call'])
+            state['call'] = None
+
+    return state['calls'][n_calls:]
+
+
+def monitor_coverage_maps(state, rms_band_dict=None):
+    '''
+    Current coverage maps, in the same form as `otf_coverage_maps`.
+
+    Can be written with `write_coverage_maps`.
+    '''
+
+    half_size = state['kernel'].shape[0] // 2
+    ny, nx = state['shape']
+
+    eff_time = state['eff_time'][half_size:half_size + ny, half_size:half_size + nx].copy()
+    if eff_time.max() > 0:
+        # Remove FFT round-off where there is no coverage
+        eff_time[eff_time < 1e-6 * eff_time.max()] = 0.
+    eff_time = eff_time * u.s
+
+    rms_kwargs = {} if rms_band_dict is None else dict(rms_band_dict=rms_band_dict)
+
+    with np.errstate(divide='ignore'):
+        rms = time_to_rms(eff_time, state['band'], **rms_kwargs)
+
+    return dict(hits=state['hits'].copy(),
+                time=state['time'] * u.s,
+                eff_time=eff_time,
+                rms=rms,
+                wcs=state['wcs'])
+
+
+def monitor_calls_table(state):
+    '''
+    The otf call checks so far as a table.
+    '''
+
+    calls = [{key: value for key, value in call.items() if key != 'missing_rows'}
+             for call in state['calls']]
+
+    table = Table(rows=calls) if calls else Table()
+    if calls and 'missing_rows' in state['calls'][0]:
+        table['n_missing'] = [call['missing_rows'].size for call in state['calls']]
+
+    return table
+
+
+def follow_mir_dataset(state, interval=10., max_polls=None, idle_timeout=None,
+                       callback=None):
+    '''
+    Poll a dataset until it stops growing.
+
+    Parameters
+    ----------
+    state : dict
+        From `start_coverage_monitor`.
+    interval : float
+        Seconds between polls.
+    max_polls : int, optional
+        Stop after this many polls.
+    idle_timeout : float, optional
+        Stop when nothing has been added for this many seconds. Runs until
+        interrupted if not given.
+    callback : callable, optional
+        Called as ``callback(state, calls)`` after every poll with new data.
+
+    Returns
+    -------
+    state : dict
+        The final state, after a ``final=True`` poll.
+    '''
+
+    npoll = 0
+    last_data = time.time()
+
+    try:
+        while max_polls is None or npoll < max_polls:
+            offsets = (state['in_offset'], state['sp_offset'])
+            calls = poll_coverage_monitor(state)
+            npoll += 1
+
+            if (state['in_offset'], state['sp_offset']) != offsets:
+                last_data = time.time()
+                if callback is not None:
+                    callback(state, calls)
+            elif idle_timeout is not None and time.time() - last_data > idle_timeout:
+                break
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+    poll_coverage_monitor(state, final=True)
+
+    return state
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import logging
+
+    from otf_coverage_maps import write_coverage_maps
+    from otf_instrumentation import enable, write_timing_report
+
+    parser = argparse.ArgumentParser(description="Follow a MIR dataset while it is written and "
+                                                 "update the coverage and depth maps.")
+    parser.add_argument("mir_filename", help="MIR dataset directory.")
+    parser.add_argument("--script", required=True,
+                        help="Perl observing script of the track, for the map centers and "
+                             "the intended OTF rows.")
+    parser.add_argument("--interval", type=float, default=10.,
+                        help="Seconds between polls.")
+    parser.add_argument("--max-polls", type=int, default=None)
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="Stop after this many seconds without new data.")
+    parser.add_argument("--band", default="230")
+    parser.add_argument("--output", default=None,
+                        help="Coverage map FITS file, rewritten after every poll with new data.")
+    parser.add_argument("--calls-output", default=None,
+                        help="Table of the otf call checks, e.g. calls.ecsv.")
+    parser.add_argument("--timing-report", default=None,
+                        help="Write the poll timers to this file (.json or .ecsv).")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.timing_report is not None:
+        enable()
+
+    band = int(args.band) if args.band.isdigit() else args.band
+
+    state = start_coverage_monitor(args.mir_filename, script_filename=args.script, band=band)
+
+    def report(state, calls):
+        logger.info(f"{state['n_int']} integrations, {state['n_otf']} OTF dumps, "
+                    f"{len(state['calls'])} otf calls.")
+        if args.output is not None:
+            write_coverage_maps(monitor_coverage_maps(state), args.output)
+
+    follow_mir_dataset(state, interval=args.interval, max_polls=args.max_polls,
+                       idle_timeout=args.idle_timeout, callback=report)
+
+    report(state, [])
+
+    if args.calls_output is not None:
+        monitor_calls_table(state).write(args.calls_output, overwrite=True)
+
+    if args.timing_report is not None:
+        write_timing_report(args.timing_report)
@@ -0,0 +1,391 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.convolution import convolve_fft
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from otf_coords_io import read_otf_coords
+from otf_map_functions import sma_pb_fwhm
+from otf_coverage_maps import primary_beam_weight_kernel
+from sensitivity_time_functions import time_to_rms
+
+
+# On-disk layout of a coverage store:
+#   index.json            WCS, shape, beam and the per-track hashes
+#   hits.npy, time.npy    cumulative hit count and integration time (s)
+#   eff_time.npy          cumulative beam-weighted effective time (s)
+#   tracks/<track>.npz    sparse per-track contribution, used for removal
+#   undo.npz              map values before an update in progress
+#
+# An add or remove first saves the values it will change to undo.npz and
+# marks the update as pending in the index. The pending mark is cleared in
+# the same atomic index write that records the change, so an update that
+# is interrupted in between is rolled back the next time the store is used.
+
+_STORE_MAPS = ['hits', 'time', 'eff_time']
+
+
+def _index_filename(store_path):
+    return Path(store_path) / "index.json"
+
+
+def _read_index(store_path):
+    with open(_index_filename(store_path), "r") as f:
+        return json.load(f)
+
+
+def _write_index(store_path, index):
+    '''
+    Write the index atomically so an interrupted update cannot corrupt it.
+    '''
+
+    tmp_filename = _index_filename(store_path).with_suffix(".json.tmp")
+    with open(tmp_filename, "w") as f:
+        json.dump(index, f, indent=1)
+
+    os.replace(tmp_filename, _index_filename(store_path))
+
+
+def file_content_hash(filename, block_size=2**20):
+    '''
+    SHA-256 hash of a file's contents, or of all files in a directory (e.g.
+    a columnar coverage table) in name order.
+    '''
+
+    filename = Path(filename)
+    filenames = sorted(filename.iterdir()) if filename.is_dir() else [filename]
+
+    sha = hashlib.sha256()
+    for this_filename in filenames:
+        with open(this_filename, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+
+    return sha.hexdigest()
+
+
+def create_coverage_store(store_path, wcs, shape,
+                          theta_pb=None, freq=230 * u.GHz,
+                          overwrite=False):
+    '''
+    Create an empty on-disk coverage store on a fixed WCS grid.
+
+    Parameters
+    ----------
+    store_path : str or Path
+        Directory for the store.
+    wcs : `~astropy.wcs.WCS`
+        Celestial WCS of the survey footprint.
+    shape : tuple
+        Image shape (ny, nx).
+    theta_pb : `~astropy.units.Quantity`, optional
+        Primary beam FWHM. Defaults to `sma_pb_fwhm` at ``freq``.
+    freq : `~astropy.units.Quantity`
+        Frequency for the primary beam size.
+    overwrite : bool
+        Replace an existing store.
+    '''
+
+    store_path = Path(store_path)
+
+    if _index_filename(store_path).exists() and not overwrite:
+        raise FileExistsError(f"A coverage store already exists at {store_path}.")
+
+    (store_path / "tracks").mkdir(parents=True, exist_ok=True)
+
+    if theta_pb is None:
+        theta_pb = sma_pb_fwhm(freq)
+
+    for name in _STORE_MAPS:
+        dtype = np.int64 if name == 'hits' else np.float64
+        arr = np.lib.format.open_memmap(store_path / f"{name}.npy", mode='w+',
+                                        dtype=dtype, shape=tuple(shape))
+        arr[:] = 0
+        arr.flush()
+        del arr
+
+    index = dict(wcs=wcs.to_header_string(),
+                 shape=list(shape),
+                 theta_pb_arcsec=theta_pb.to_value(u.arcsec),
+                 tracks={})
+
+    _write_index(store_path, index)
+
+
+def _store_wcs(index):
+    return WCS(fits.Header.fromstring(index['wcs']))
+
+
+def _track_contribution(coords, index, t_dump):
+    '''
+    Sparse hits, time and effective time for one track.
+
+    Only the bounding box of the track, padded by the kernel half-width, is
+    gridded and convolved, so the cost does not depend on the mosaic size.
+    '''
+
+    wcs = _store_wcs(index)
+    shape = tuple(index['shape'])
+
+    pixel_scale = np.abs(wcs.wcs.cdelt[1]) * u.deg
+    kernel = primary_beam_weight_kernel(index['theta_pb_arcsec'] * u.arcsec, pixel_scale)
+    half_size = kernel.shape[0] // 2
+
+    xpix, ypix = wcs.wcs_world2pix(coords['ra'].quantity.to_value(u.deg),
+                                   coords['dec'].quantity.to_value(u.deg), 0)
+    xpix = np.round(xpix).astype(int)
+    ypix = np.round(ypix).astype(int)
+
+    inside = (xpix >= 0) & (xpix < shape[1]) & (ypix >= 0) & (ypix < shape[0])
+    if not inside.any():
+        return np.zeros(0, dtype=np.int64), {name: np.zeros(0) for name in _STORE_MAPS}
+
+    t_dump_s = np.broadcast_to(t_dump.to_value(u.s), xpix.shape)[inside]
+    xpix = xpix[inside]
+    ypix = ypix[inside]
+
+    x0 = xpix.min() - half_size
+    y0 = ypix.min() - half_size
+    patch_shape = (ypix.max() + half_size + 1 - y0, xpix.max() + half_size + 1 - x0)
+    npatch = patch_shape[0] * patch_shape[1]
+
+    patch_index = (ypix - y0) * patch_shape[1] + (xpix - x0)
+    hits = np.bincount(patch_index, minlength=npatch).reshape(patch_shape)
+    time = np.bincount(patch_index, weights=t_dump_s, minlength=npatch).reshape(patch_shape)
+
+    eff_time = convolve_fft(time, kernel,
+                            normalize_kernel=False,
+                            boundary='fill', fill_value=0.)
+    eff_time[eff_time < 1e-6 * eff_time.max()] = 0.
+
+    # Drop the padding that falls outside the store's image
+    py, px = np.nonzero(eff_time)
+    keep = (py + y0 >= 0) & (py + y0 < shape[0]) & (px + x0 >= 0) & (px + x0 < shape[1])
+    py = py[keep]
+    px = px[keep]
+
+    flat_index = (py + y0).astype(np.int64) * shape[1] + (px + x0)
+
+    values = dict(hits=hits[py, px],
+                  time=time[py, px],
+                  eff_time=eff_time[py, px])
+
+    return flat_index, values
+
+
+def _apply_contribution(store_path, flat_index, values, sign):
+    '''
+    Add (sign=1) or subtract (sign=-1) a sparse contribution in place.
+    '''
+
+    for name in _STORE_MAPS:
+        arr = np.load(Path(store_path) / f"{name}.npy", mmap_mode='r+')
+        flat = arr.reshape(-1)
+        flat[flat_index] += sign * values[name].astype(arr.dtype)
+        if name != 'hits':
+            # Avoid small negative round-off after removing a track
+            flat[flat_index] = np.maximum(flat[flat_index], 0.)
+        arr.flush()
+        del arr
+
+
+def _undo_filename(store_path):
+    return Path(store_path) / "undo.npz"
+
+
+def _begin_update(store_path, index, flat_index):
+    '''
+    Save the map values at ``flat_index`` and mark an update as pending.
+    '''
+
+    undo = {}
+    for name in _STORE_MAPS:
+        arr = np.load(Path(store_path) / f"{name}.npy", mmap_mode='r')
+        undo[name] = np.array(arr.reshape(-1)[flat_index])
+        del arr
+
+    tmp_filename = Path(store_path) / "undo.tmp.npz"
+    np.savez(tmp_filename, flat_index=flat_index, **undo)
+    os.replace(tmp_filename, _undo_filename(store_path))
+
+    index['pending'] = True
+    _write_index(store_path, index)
+
+
+def _recover_store(store_path):
+    '''
+    Roll back an interrupted add or remove and return the index.
+    '''
+
+    index = _read_index(store_path)
+
+    if index.pop('pending', False):
+        with np.load(_undo_filename(store_path)) as undo:
+            flat_index = undo['flat_index']
+            for name in _STORE_MAPS:
+                arr = np.load(Path(store_path) / f"{name}.npy", mmap_mode='r+')
+                arr.reshape(-1)[flat_index] = undo[name]
+                arr.flush()
+                del arr
+
+        _write_index(store_path, index)
+
+    if _undo_filename(store_path).exists():
+        _undo_filename(store_path).unlink()
+
+    return index
+
+
+def add_track_to_store(store_path, coords_filename, track_id=None,
+                       t_dump=0.6 * u.s):
+    '''
+    Add one track's coverage to the store.
+
+    Tracks already in the store with the same content hash are skipped. If the
+    hash changed (e.g., the track was re-extracted), the old contribution is
+    replaced.
+
+    Parameters
+    ----------
+    store_path : str or Path
+        Coverage store directory.
+    coords_filename : str or Path
+        ``*_target_otf_coords.fits`` table or ``*_target_otf_coords``
+        columnar directory from `extract_spatial_coverage.py`.
+    track_id : str, optional
+        Name for the track. Defaults to the MIR dataset name from the file name.
+    t_dump : `~astropy.units.Quantity`
+        Integration time per dump. The ``rinteg`` column is used instead
+        when the table has one.
+
+    Returns
+    -------
+    added : bool
+        False if the track was already in the store and unchanged.
+    '''
+
+    store_path = Path(store_path)
+    coords_filename = Path(coords_filename)
+
+    if track_id is None:
+        track_id = coords_filename.name.replace(".fits", "").replace("_target_otf_coords", "")
+
+    index = _recover_store(store_path)
+
+    content_hash = file_content_hash(coords_filename)
+
+    if track_id in index['tracks']:
+        if index['tracks'][track_id]['hash'] == content_hash:
+            return False
+
+        remove_track_from_store(store_path, track_id)
+        index = _read_index(store_path)
+
+    coords = read_otf_coords(coords_filename)
+
+    if 'rinteg' in coords.colnames:
+        t_dump = coords['rinteg'].quantity
+
+    flat_index, values = _track_contribution(coords, index, t_dump)
+
+    track_filename = Path("tracks") / f"{track_id}.npz"
+    np.savez(store_path / track_filename, flat_index=flat_index, **values)
+
+    _begin_update(store_path, index, flat_index)
+
+    _apply_contribution(store_path, flat_index, values, 1)
+
+    # Recording the track and clearing the pending mark is one atomic write
+    del index['pending']
+    index['tracks'][track_id] = dict(hash=content_hash,
+                                     file=str(track_filename),
+                                     source=str(coords_filename),
+                                     ndumps=len(coords))
+    _write_index(store_path, index)
+    _undo_filename(store_path).unlink()
+
+    return True
+
+
+def remove_track_from_store(store_path, track_id):
+    '''
+    Remove a track's contribution from the store (e.g., after it is flagged).
+
+    Parameters
+    ----------
+    store_path : str or Path
+        Coverage store directory.
+    track_id : str
+        Name of the track to remove.
+    '''
+
+    store_path = Path(store_path)
+
+    index = _recover_store(store_path)
+
+    if track_id not in index['tracks']:
+        raise KeyError(f"Track {track_id} is not in the coverage store.")
+
+    track_filename = store_path / index['tracks'][track_id]['file']
+
+    with np.load(track_filename) as contribution:
+        values = {name: contribution[name] for name in _STORE_MAPS}
+        flat_index = contribution['flat_index']
+
+    _begin_update(store_path, index, flat_index)
+
+    _apply_contribution(store_path, flat_index, values, -1)
+
+    del index['pending']
+    del index['tracks'][track_id]
+    _write_index(store_path, index)
+    _undo_filename(store_path).unlink()
+
+    track_filename.unlink()
+
+
+def load_coverage_store(store_path, band=230, rms_band_dict=None):
+    '''
+    Load the cumulative coverage maps as memory maps.
+
+    Parameters
+    ----------
+    store_path : str or Path
+        Coverage store directory.
+    band : int or str
+        Band key for `time_to_rms`.
+    rms_band_dict : dict, optional
+        Passed to `time_to_rms`.
+
+    Returns
+    -------
+    out_dict : dict
+        ``hits``, ``time``, ``eff_time`` and ``rms`` maps, the ``wcs`` and
+        the list of ``tracks``. Same keys as `otf_coverage_maps`.
+    '''
+
+    store_path = Path(store_path)
+
+    index = _recover_store(store_path)
+
+    out_dict = {name: np.load(store_path / f"{name}.npy", mmap_mode='r')
+                for name in _STORE_MAPS}
+
+    out_dict['time'] = out_dict['time'] * u.s
+    out_dict['eff_time'] = out_dict['eff_time'] * u.s
+
+    rms_kwargs = {} if rms_band_dict is None else dict(rms_band_dict=rms_band_dict)
+
+    with np.errstate(divide='ignore'):
+        out_dict['rms'] = time_to_rms(out_dict['eff_time'], band, **rms_kwargs)
+
+    out_dict['wcs'] = _store_wcs(index)
+    out_dict['tracks'] = list(index['tracks'].keys())
+
+    return out_dict
@@ -0,0 +1,333 @@
+
+from astropy.table import Table
+
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import logging
+import os
+from pathlib import Path
+import time
+import warnings
+
+
+# Timers, counters and deduplicated warnings for the planning and extraction
+# code. Instrumentation is off by default and then costs one global lookup per
+# stage. Turn it on with `enable`, the `instrumented` context manager, or the
+# SMA_OTF_INSTRUMENT environment variable, e.g.
+#
+#     with instrumented():
+#         extract_spatial_coverage_streaming(mir_filename)
+#     print(timing_report())
+#
+# Warnings given through `warn_once` are always counted. Inside a
+# `deduplicate_warnings` block (entered by the grid sweeps) each message is
+# issued once and later repeats are only counted; elsewhere they are plain
+# `warnings.warn` calls.
+
+_enabled = os.environ.get("SMA_OTF_INSTRUMENT", "") not in ("", "0")
+
+# name -> [calls, total, min, max] in s
+_timers = {}
+_counters = {}
+# message -> number of times it was raised
+_warning_counts = {}
+# Messages already issued in the current `deduplicate_warnings` block
+_dedup_seen = None
+
+_start_time = time.perf_counter()
+
+_null_stage = nullcontext()
+
+
+def get_logger(name):
+    '''
+    Logger for a module, under the "sma_otf" namespace.
+
+    Nothing is shown below the WARNING level unless logging is configured,
+    e.g. with ``logging.basicConfig(level=logging.INFO)``. The command line
+    scripts configure INFO logging.
+    '''
+
+    return logging.getLogger(f"sma_otf.{name}")
+
+
+def enable(flag=True):
+    '''
+    Turn the timers and counters on or off.
+    '''
+
+    global _enabled
+    _enabled = bool(flag)
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    '''
+    Clear the timers, counters and warning counts.
+    '''
+
+    global _start_time
+
+    _timers.clear()
+    _counters.clear()
+    _warning_counts.clear()
+    _start_time = time.perf_counter()
+
+
+class _Stage:
+    '''
+    Adds the time spent inside the block to a named timer.
+    '''
+
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+
+        timer = _timers.get(self.name)
+        if timer is None:
+            _timers[self.name] = [1, elapsed, elapsed, elapsed]
+        else:
+            timer[0] += 1
+            timer[1] += elapsed
+            timer[2] = min(timer[2], elapsed)
+            timer[3] = max(timer[3], elapsed)
+
+        return False
+
+
+def stage(name):
+    '''
+    Time a block of code under ``name`` (e.g. ``"extract.read"``).
+
+    Returns a do-nothing context when instrumentation is off.
+    '''
+
+    return _Stage(name) if _enabled else _null_stage
+
+
+def timed(name=None):
+    '''
+    Decorator timing every call of a function as a stage.
+
+    Parameters
+    ----------
+    name : str, optional
+        Stage name. Defaults to the function name.
+    '''
+
+    def wrapper(func):
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(stage_name):
+                return func(*args, **kwargs)
+
+        return timed_func
+
+    return wrapper
+
+
+def count(name, value=1):
+    '''
+    Add ``value`` to the counter ``name``.
+    '''
+
+    if _enabled:
+        # Keep plain python numbers so the report can be written to JSON
+        _counters[name] = _counters.get(name, 0) + getattr(value, 'item', lambda: value)()
+
+
+def warn_once(message, category=UserWarning, stacklevel=2, key=None):
+    '''
+    Issue a warning once per `deduplicate_warnings` block and count it.
+
+    Outside such a block this is `warnings.warn`, so the usual warning
+    filters apply.
+
+    Parameters
+    ----------
+    message : str
+        Warning message.
+    category : Warning
+        Warning class.
+    stacklevel : int
+        As in `warnings.warn`, counted from the caller of `warn_once`.
+    key : str, optional
+        Key for the deduplication when the message varies, e.g. with a
+        count of the offending values. Defaults to the message.
+    '''
+
+    if key is None:
+        key = message
+
+    _warning_counts[key] = _warning_counts.get(key, 0) + 1
+
+    if _dedup_seen is not None:
+        if key in _dedup_seen:
+            return
+        _dedup_seen.add(key)
+
+    warnings.warn(message, category, stacklevel=stacklevel + 1)
+
+
+@contextmanager
+def deduplicate_warnings():
+    '''
+    Issue each `warn_once` warning only once within the block.
+
+    Nested blocks share the outermost one. Used by the sweeps, e.g.
+    `otf_mapping_params_grid`, so a limit warning is not repeated for every
+    batch or candidate; wrap a loop of scalar calls to do the same.
+    '''
+
+    global _dedup_seen
+
+    if _dedup_seen is not None:
+        yield
+        return
+
+    _dedup_seen = set()
+    try:
+        yield
+    finally:
+        _dedup_seen = None
+
+
+def reset_warnings():
+    '''
+    Clear the warning counts and allow the deduplicated warnings to be
+    issued again.
+    '''
+
+    _warning_counts.clear()
+    if _dedup_seen is not None:
+        _dedup_seen.clear()
+
+
+@contextmanager
+def instrumented(clear=True):
+    '''
+    Enable instrumentation within a block, optionally starting from zero.
+    '''
+
+    was_enabled = _enabled
+    if clear:
+        reset()
+    enable(True)
+
+    try:
+        yield
+    finally:
+        enable(was_enabled)
+
+
+def snapshot():
+    '''
+    Current timers, counters and warning counts as a plain dict.
+
+    Used to send the results from worker processes back to be combined with
+    `merge_snapshot`.
+    '''
+
+    return dict(timers={name: list(values) for name, values in _timers.items()},
+                counters=dict(_counters),
+                warnings=dict(_warning_counts))
+
+
+def merge_snapshot(other):
+    '''
+    Add the timers, counters and warning counts from a `snapshot`.
+    '''
+
+    for name, (calls, total, tmin, tmax) in other['timers'].items():
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [calls, total, tmin, tmax]
+        else:
+            timer[0] += calls
+            timer[1] += total
+            timer[2] = min(timer[2], tmin)
+            timer[3] = max(timer[3], tmax)
+
+    for name, value in other['counters'].items():
+        _counters[name] = _counters.get(name, 0) + value
+
+    for message, value in other['warnings'].items():
+        _warning_counts[message] = _warning_counts.get(message, 0) + value
+
+
+def timing_report():
+    '''
+    Summary of the timers.
+
+    Returns
+    -------
+    report : `~astropy.table.Table`
+        Number of calls, total, mean, min and max time (s) for each stage,
+        and the fraction of the wall time since the last `reset`, sorted by
+        total time. ``meta`` holds the ``counters``, ``warnings`` and
+        ``wall_time``.
+    '''
+
+    wall_time = time.perf_counter() - _start_time
+
+    names = sorted(_timers, key=lambda name: -_timers[name][1])
+
+    rows = []
+    for name in names:
+        calls, total, tmin, tmax = _timers[name]
+        rows.append([name, calls, total, total / calls, tmin, tmax, total / wall_time])
+
+    report = Table(rows=rows if rows else None,
+                   names=['stage', 'calls', 'total', 'mean', 'min', 'max', 'fraction'],
+                   dtype=[str, int, float, float, float, float, float])
+
+    for name in ['total', 'mean', 'min', 'max']:
+        report[name].unit = 's'
+        report[name].format = '.4g'
+    report['fraction'].format = '.3f'
+
+    report.meta['wall_time'] = wall_time
+    report.meta['counters'] = dict(_counters)
+    report.meta['warnings'] = dict(_warning_counts)
+
+    return report
+
+
+def write_timing_report(filename):
+    '''
+    Write `timing_report` to a .json file, or any table format astropy can
+    write (e.g. .ecsv), with the counters and warnings included.
+    '''
+
+    filename = Path(filename)
+
+    report = timing_report()
+
+    if filename.suffix == ".json":
+        out = dict(wall_time=report.meta['wall_time'],
+                   stages={row['stage']: {name: row[name].item() for name in report.colnames[1:]}
+                           for row in report},
+                   counters=report.meta['counters'],
+                   warnings=report.meta['warnings'])
+        with open(filename, "w") as f:
+            json.dump(out, f, indent=1)
+    else:
+        report.write(filename, overwrite=True)
+
+    return filename
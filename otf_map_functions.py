@@ -1,8 +1,9 @@
 
 import numpy as np
 import astropy.units as u
+import warnings
 
-from warnings import warn
+from otf_instrumentation import count, deduplicate_warnings, timed, warn_once
 
 
 def sma_pb_fwhm(freq):
@@ -16,6 +17,63 @@ def sma_pb_fwhm(freq):
     return fwhm
 
 
+# Recomended limits on the OTF parameters: (name, comparison, limit, message)
+_OTF_PARAM_LIMITS = [
+    ('oversample_row_space', 'lt', 2.,
+     'oversample_row_space < 2. Recomended minimum value is 2.'),
+    ('t_dump', 'lt', 0.6 * u.s,
+     't_dump < 0.6s. Recomended minimum value is 0.6s for SWARM correlator.'),
+    ('t_loop', 'gt', 15 * u.min,
+     't_loop > 15min. Recomended maximum value is 15 min (includes gain calibration time).'),
+    ('t_delay', 'lt', 3 * u.s,
+     't_delay < 3s. Recomended minimum value is 3s.'),
+    ('t_ramp', 'lt', 3 * u.s,
+     't_ramp < 3s. Recomended minimum value is 3s.'),
+    ('t_row_delay', 'lt', 2 * u.s,
+     't_row_delay < 2s. Recomended minimum value is 2s.'),
+    ('t_gain', 'lt', 3 * u.min,
+     't_gain < 3min. Recomended minimum value is 3min.'),
+    ('beam_per_dump', 'gt', 0.125,
+     'beam_per_dump > 0.125. Recomended maximum value is 0.125. Large values will smear the beam.'),
+]
+
+
+def _check_otf_limits(**params):
+    '''
+    Warn once per parameter when any value is outside the recomended limits.
+
+    Works for scalars and arrays. For arrays, the number of offending values
+    is appended to the warning. Inside a sweep (see
+    `otf_instrumentation.deduplicate_warnings`) each warning is only issued
+    the first time; the offending values are counted under
+    ``otf_limits.<parameter>``.
+    '''
+
+    for name, comparison, limit, message in _OTF_PARAM_LIMITS:
+        if name not in params:
+            continue
+
+        value = params[name]
+
+        if comparison == 'lt':
+            bad = np.less(value, limit)
+        else:
+            bad = np.greater(value, limit)
+
+        nbad = np.count_nonzero(bad)
+        if nbad == 0:
+            continue
+
+        count(f'otf_limits.{name}', nbad)
+
+        key = message
+        if np.ndim(bad) > 0:
+            message = f'{message} ({nbad} of {np.size(bad)} configurations)'
+
+        warn_once(message, stacklevel=4, key=key)
+
+
+@timed('otf_params.scalar')
 def otf_mapping_params(row_length, row_width,
                        time_per_track,
                        theta_pb=55*u.arcsec,
@@ -87,29 +145,10 @@ def otf_mapping_params(row_length, row_width,
 
 
     # Set recomended lower limits on parameters
-    if oversample_row_space < 2:
-        warn('oversample_row_space < 2. Recomended minimum value is 2.')
-
-    if t_dump < 0.6 * u.s:
-        warn('t_dump < 0.6s. Recomended minimum value is 0.6s for SWARM correlator.')
-
-    if t_loop > 15 * u.min:
-        warn('t_loop > 15min. Recomended maximum value is 15 min (includes gain calibration time).')
-
-    if t_delay < 3 * u.s:
-        warn('t_delay < 3s. Recomended minimum value is 3s.')
-
-    if t_ramp < 3 * u.s:
-        warn('t_ramp < 3s. Recomended minimum value is 3s.')
-
-    if t_row_delay < 2 * u.s:
-        warn('t_row_delay < 2s. Recomended minimum value is 2s.')
-
-    if t_gain < 3 * u.min:
-        warn('t_gain < 3min. Recomended minimum value is 3min.')
-
-    if beam_per_dump > 0.125:
-        warn('beam_per_dump > 0.125. Recomended maximum value is 0.125. Large values will smear the beam.')
+    _check_otf_limits(oversample_row_space=oversample_row_space,
+                      t_dump=t_dump, t_loop=t_loop, t_delay=t_delay,
+                      t_ramp=t_ramp, t_row_delay=t_row_delay,
+                      t_gain=t_gain, beam_per_dump=beam_per_dump)
 
     # Calculate theta_pb if not provided
     if theta_pb is None:
@@ -184,3 +223,426 @@ def otf_mapping_params(row_length, row_width,
     return out_dict
 
 
+def _to_float(value, unit, name):
+    '''
+    Convert a Quantity to a plain float array in the given unit.
+    '''
+
+    if not hasattr(value, 'unit'):
+        raise ValueError(f'{name} must be an astropy Quantity.')
+
+    if not value.unit.is_equivalent(unit):
+        raise ValueError(f'{name} must be in units equivalent to {unit}.')
+
+    return np.asarray(value.to_value(unit), dtype=float)
+
+
+@timed('otf_params.grid')
+def otf_mapping_params_grid(row_length, row_width,
+                            time_per_track,
+                            theta_pb=55*u.arcsec,
+                            reffreq_pb=230*u.GHz,
+                            oversample_row_space=2.,
+                            time_per_beam=1*u.min,
+                            t_dump=1.7 * u.s,
+                            beam_per_dump=0.1,
+                            t_loop=15 * u.min,
+                            t_gain=3 * u.min,
+                            t_delay=3*u.s,
+                            t_row_delay=2*u.s,
+                            t_ramp=3*u.s,
+                            as_table=True,
+                            ):
+    '''
+    Batched version of `otf_mapping_params` for parameter sweeps.
+
+    All inputs take the same meaning as in `otf_mapping_params`, but may be
+    arrays that broadcast against each other. For an outer-product grid, give
+    each parameter its own axis, e.g. ``row_length[:, None]`` and
+    ``t_dump[None, :]``. Units are checked and the recomended limits are
+    warned about once per call, then the calculation runs on plain float
+    arrays in a single pass.
+
+    Parameters
+    ----------
+    row_length, row_width, time_per_track, theta_pb, reffreq_pb,
+    oversample_row_space, time_per_beam, t_dump, beam_per_dump, t_loop,
+    t_gain, t_delay, t_row_delay, t_ramp
+        See `otf_mapping_params`. Each may be a scalar or an array.
+    as_table : bool
+        Return a flattened `~astropy.table.QTable` with one row per
+        configuration. Otherwise, return a dictionary of Quantity arrays with
+        the broadcast shape of the inputs.
+
+    Returns
+    -------
+    out : `~astropy.table.QTable` or dict
+        Mapping parameters with the same keys as `otf_mapping_params`, plus the
+        varied input parameters.
+
+    '''
+
+    # Ensure required args have the correct units
+    row_length = _to_float(row_length, u.arcsec, 'row_length')
+    row_width = _to_float(row_width, u.arcsec, 'row_width')
+    time_per_track = _to_float(time_per_track, u.s, 'time_per_track')
+
+    if theta_pb is None:
+        theta_pb = sma_pb_fwhm(reffreq_pb)
+    theta_pb = _to_float(theta_pb, u.arcsec, 'theta_pb')
+
+    time_per_beam = _to_float(time_per_beam, u.s, 'time_per_beam')
+    t_dump_s = _to_float(t_dump, u.s, 't_dump')
+    t_loop_s = _to_float(t_loop, u.s, 't_loop')
+    t_gain_s = _to_float(t_gain, u.s, 't_gain')
+    t_delay_s = _to_float(t_delay, u.s, 't_delay')
+    t_row_delay_s = _to_float(t_row_delay, u.s, 't_row_delay')
+    t_ramp_s = _to_float(t_ramp, u.s, 't_ramp')
+
+    oversample_row_space = np.asarray(oversample_row_space, dtype=float)
+    beam_per_dump = np.asarray(beam_per_dump, dtype=float)
+
+    # Set recomended lower limits on parameters. Once per sweep.
+    with deduplicate_warnings():
+        _check_otf_limits(oversample_row_space=oversample_row_space,
+                          t_dump=t_dump_s * u.s, t_loop=t_loop_s * u.s,
+                          t_delay=t_delay_s * u.s, t_ramp=t_ramp_s * u.s,
+                          t_row_delay=t_row_delay_s * u.s, t_gain=t_gain_s * u.s,
+                          beam_per_dump=beam_per_dump)
+
+    (row_length, row_width, time_per_track, theta_pb, time_per_beam,
+     t_dump_s, t_loop_s, t_gain_s, t_delay_s, t_row_delay_s, t_ramp_s,
+     oversample_row_space, beam_per_dump) = \
+        np.broadcast_arrays(row_length, row_width, time_per_track, theta_pb,
+                            time_per_beam, t_dump_s, t_loop_s, t_gain_s,
+                            t_delay_s, t_row_delay_s, t_ramp_s,
+                            oversample_row_space, beam_per_dump)
+
+    # Same steps as otf_mapping_params. Angles in arcsec, times in s.
+    R_target = theta_pb * beam_per_dump / t_dump_s
+
+    total_area = row_length * row_width
+
+    beam_area = 0.5665 * theta_pb**2
+
+    N_eff = total_area / beam_area
+
+    time_all_beams = N_eff * time_per_beam
+
+    theta_row = theta_pb / oversample_row_space
+
+    N_beam_row = row_length / theta_pb
+
+    t_row = row_length / R_target
+
+    Nrow = np.ceil((row_width + theta_pb) / theta_row)
+
+    t_otf_map = t_delay_s + Nrow * (t_row + t_row_delay_s + t_ramp_s)
+
+    N_otf_maps = time_all_beams / t_otf_map
+
+    N_gain = np.ceil(t_otf_map / (t_loop_s - t_gain_s))
+
+    t_otf_map_total = t_otf_map + N_gain * t_gain_s
+
+    t_total_mapping_time = N_otf_maps * t_otf_map_total
+
+    N_tracks = t_total_mapping_time / time_per_track
+
+    maps_per_track = np.ceil(N_otf_maps) / N_tracks
+
+    out_dict = dict(row_length=(row_length * u.arcsec).to(u.arcmin),
+                    row_width=(row_width * u.arcsec).to(u.arcmin),
+                    total_area=(total_area * u.arcsec**2).to(u.arcmin**2),
+                    beam_area=(beam_area * u.arcsec**2).to(u.arcmin**2),
+                    N_eff=N_eff * u.one,
+                    time_all_beams=(time_all_beams * u.s).to(u.hr),
+                    time_per_beam=(time_per_beam * u.s).to(u.min),
+                    theta_pb=theta_pb * u.arcsec,
+                    oversample_row_space=oversample_row_space * u.one,
+                    beam_per_dump=beam_per_dump * u.one,
+                    t_dump=t_dump_s * u.s,
+                    theta_row=theta_row * u.arcsec,
+                    N_beam_row=N_beam_row * u.one,
+                    R_target=R_target * u.arcsec / u.s,
+                    t_row=(t_row * u.s).to(u.min),
+                    Nrow=Nrow * u.one,
+                    t_otf_map=(t_otf_map * u.s).to(u.min),
+                    N_otf_maps=N_otf_maps * u.one,
+                    N_gain=N_gain * u.one,
+                    t_otf_map_total=(t_otf_map_total * u.s).to(u.hr),
+                    t_total_mapping_time=(t_total_mapping_time * u.s).to(u.hr),
+                    N_tracks=N_tracks * u.one,
+                    maps_per_track=maps_per_track * u.one)
+
+    if not as_table:
+        return out_dict
+
+    from astropy.table import QTable
+
+    return QTable({key: value.ravel() for key, value in out_dict.items()})
+
+
+def otf_mapping_params_table(params, **kwargs):
+    '''
+    Run `otf_mapping_params_grid` on the rows of a parameter table.
+
+    Parameters
+    ----------
+    params : `~astropy.table.Table` or `~astropy.table.QTable`
+        One configuration per row. Columns named after the arguments of
+        `otf_mapping_params_grid` are used as inputs. Columns with units are
+        converted to Quantities.
+    kwargs : dict
+        Fixed values for any arguments not given as columns.
+
+    Returns
+    -------
+    out : `~astropy.table.QTable`
+        Mapping parameters, one row per input row.
+
+    '''
+
+    inputs = dict(kwargs)
+
+    for name in params.colnames:
+        col = params[name]
+        if getattr(col, 'unit', None) is not None and not hasattr(col, 'to_value'):
+            col = col.quantity
+        elif getattr(col, 'unit', None) is None:
+            col = np.asarray(col)
+        inputs[name] = col
+
+    inputs['as_table'] = True
+
+    return otf_mapping_params_grid(**inputs)
+
+
+def otf_sampling_nonuniformity(spacing, theta_pb=55*u.arcsec):
+    '''
+    Fractional peak-to-trough ripple in the sensitivity of a regular OTF sampling.
+
+    The weight from Gaussian beams on a regular grid is periodic. The leading
+    Fourier term of the sum of the squared beams gives a ripple of
+    ``4 exp(-2 pi^2 sigma_w^2 / spacing^2)``, where ``sigma_w`` is the width of
+    the squared beam. This is accurate when the ripple is small (well-sampled maps).
+
+    Parameters
+    ----------
+    spacing : `~astropy.units.Quantity`
+        Spacing between rows or dumps in angular units.
+    theta_pb : `~astropy.units.Quantity`
+        Primary beam FWHM.
+
+    Returns
+    -------
+    ripple : float or `~numpy.ndarray`
+        Fractional ripple in the summed weight.
+
+    '''
+
+    sigma_w = (theta_pb / np.sqrt(8 * np.log(2))) / np.sqrt(2)
+
+    ratio = (sigma_w / spacing).to_value(u.one)
+
+    return 4 * np.exp(-2 * np.pi**2 * ratio**2)
+
+
+@timed('otf_params.optimize')
+def optimize_otf_params(time_per_beam,
+                        time_per_track,
+                        row_length,
+                        row_width,
+                        target_area=None,
+                        n_maps=None,
+                        theta_pb=55*u.arcsec,
+                        beam_per_dump=np.linspace(0.05, 0.125, 16),
+                        oversample_row_space=np.array([2., 2.5, 3., 3.5, 4.]),
+                        t_dump_min=0.6 * u.s,
+                        beam_per_dump_max=0.125,
+                        t_loop=15 * u.min,
+                        t_loop_max=15 * u.min,
+                        t_gain=3 * u.min,
+                        max_gain_loops_per_map=2,
+                        verbose=False,
+                        **kwargs):
+    '''
+    Find the OTF parameters on the Pareto front of total time and sensitivity uniformity.
+
+    The row geometry, ``beam_per_dump`` and ``oversample_row_space`` are
+    discrete candidates. ``t_dump`` is continuous, but the total time only
+    depends on it through the gain calibration overhead, which is smallest
+    when an OTF map exactly fills an integer number of gain loops. The
+    continuous axis is therefore reduced to the ``t_dump`` values giving
+    1 to ``max_gain_loops_per_map`` full loops, plus the hardware limit
+    ``t_dump_min``. Candidates outside the hardware limits are pruned before
+    evaluation with `otf_mapping_params_grid`.
+
+    Parameters
+    ----------
+    time_per_beam : `~astropy.units.Quantity`
+        Required time per beam.
+    time_per_track : `~astropy.units.Quantity`
+        Time per track. See `otf_mapping_params`.
+    row_length : `~astropy.units.Quantity`
+        Candidate row lengths. Broadcast against ``row_width`` to give the
+        candidate map geometries.
+    row_width : `~astropy.units.Quantity`
+        Candidate row widths.
+    target_area : `~astropy.units.Quantity`, optional
+        Total area to map. Sets the number of maps for each geometry.
+    n_maps : int, optional
+        Fixed number of maps (e.g., 22 for the M31 mosaic). Used instead of
+        ``target_area``. Defaults to 1 if neither is given.
+    theta_pb : `~astropy.units.Quantity`
+        Primary beam size.
+    beam_per_dump : array
+        Candidate number of primary beams per dump.
+    oversample_row_space : array
+        Candidate oversampling factors for the row spacing.
+    t_dump_min : `~astropy.units.Quantity`
+        Minimum dump time allowed by the correlator.
+    beam_per_dump_max : float
+        Maximum number of beams per dump to avoid smearing.
+    t_loop : `~astropy.units.Quantity`
+        Time per gain loop.
+    t_loop_max : `~astropy.units.Quantity`
+        Maximum allowed ``t_loop``.
+    t_gain : `~astropy.units.Quantity`
+        Total for gain calibration per loop.
+    max_gain_loops_per_map : int
+        Maximum number of gain loops one map may span. The interleaved
+        observing scripts split each map into 2 halves.
+    verbose : bool
+        Print the size of the search and the Pareto front.
+    kwargs : dict
+        Passed to `otf_mapping_params_grid` (e.g., ``t_delay``, ``t_ramp``).
+
+    Returns
+    -------
+    front : `~astropy.table.QTable`
+        Pareto-optimal configurations, sorted by total time. Includes the
+        `otf_mapping_params` outputs and ``n_maps``, ``total_time``,
+        ``total_tracks`` and ``nonuniformity``.
+
+    '''
+
+    if t_loop > t_loop_max:
+        raise ValueError(f't_loop must be <= {t_loop_max}.')
+
+    if t_dump_min < 0.6 * u.s:
+        warnings.warn('t_dump_min < 0.6s. Recomended minimum value is 0.6s for SWARM correlator.')
+
+    t_delay = kwargs.get('t_delay', 3 * u.s)
+    t_row_delay = kwargs.get('t_row_delay', 2 * u.s)
+    t_ramp = kwargs.get('t_ramp', 3 * u.s)
+
+    # Prune the discrete candidates outside the hardware limits.
+    beam_per_dump = np.atleast_1d(np.asarray(beam_per_dump, dtype=float))
+    beam_per_dump = beam_per_dump[beam_per_dump <= beam_per_dump_max]
+
+    oversample_row_space = np.atleast_1d(np.asarray(oversample_row_space, dtype=float))
+
+    if beam_per_dump.size == 0 or oversample_row_space.size == 0:
+        raise ValueError('No beam_per_dump or oversample_row_space candidates within the limits.')
+
+    row_length, row_width = np.broadcast_arrays(np.atleast_1d(row_length.to_value(u.arcsec)),
+                                                np.atleast_1d(row_width.to_value(u.arcsec)))
+    row_length = row_length.ravel()
+    row_width = row_width.ravel()
+
+    theta = theta_pb.to_value(u.arcsec)
+    t_gain_s = t_gain.to_value(u.s)
+    t_loop_s = t_loop.to_value(u.s)
+    t_row_overhead = (t_row_delay + t_ramp).to_value(u.s)
+
+    # Axes: (geometry, beam_per_dump, oversample, t_dump option)
+    length = row_length[:, None, None, None]
+    width = row_width[:, None, None, None]
+    bpd = beam_per_dump[None, :, None, None]
+    oversample = oversample_row_space[None, None, :, None]
+
+    n_loops = np.arange(1, max_gain_loops_per_map + 1, dtype=float)
+    n_loops = n_loops[None, None, None, :]
+
+    Nrow = np.ceil((width + theta) / (theta / oversample))
+
+    # Row time that makes the map just fill n_loops gain loops.
+    t_map_target = n_loops * (t_loop_s - t_gain_s) * (1 - 1e-9)
+    t_row = (t_map_target - t_delay.to_value(u.s)) / Nrow - t_row_overhead
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_dump_loop = np.where(t_row > 0, theta * bpd * t_row / length, np.nan)
+
+    t_dump_bound = np.broadcast_to(t_dump_min.to_value(u.s), t_dump_loop.shape[:3] + (1,))
+    t_dump_s = np.concatenate([t_dump_loop, t_dump_bound], axis=-1)
+
+    shape = t_dump_s.shape
+    length, width, bpd, oversample = [np.broadcast_to(arr, shape) for arr in
+                                      (length, width, bpd, oversample)]
+
+    valid = np.isfinite(t_dump_s) & (t_dump_s >= t_dump_min.to_value(u.s))
+
+    count('otf_params.candidates', valid.size)
+    count('otf_params.evaluated', np.count_nonzero(valid))
+
+    if verbose:
+        print(f'Evaluating {np.count_nonzero(valid)} of {valid.size} candidate configurations.')
+
+    with deduplicate_warnings():
+        results = otf_mapping_params_grid(length[valid] * u.arcsec,
+                                          width[valid] * u.arcsec,
+                                          time_per_track,
+                                          theta_pb=theta_pb,
+                                          oversample_row_space=oversample[valid],
+                                          time_per_beam=time_per_beam,
+                                          t_dump=t_dump_s[valid] * u.s,
+                                          beam_per_dump=bpd[valid],
+                                          t_loop=t_loop,
+                                          t_gain=t_gain,
+                                          as_table=True,
+                                          **kwargs)
+
+    # Maps longer than the allowed number of gain loops are not schedulable.
+    results = results[results['N_gain'].value <= max_gain_loops_per_map]
+
+    if n_maps is None:
+        if target_area is None:
+            n_maps = np.ones(len(results))
+        else:
+            n_maps = np.ceil((target_area / results['total_area']).to_value(u.one))
+    else:
+        n_maps = np.full(len(results), n_maps, dtype=float)
+
+    results['n_maps'] = n_maps
+    results['total_time'] = n_maps * results['t_total_mapping_time']
+    results['total_tracks'] = n_maps * results['N_tracks']
+
+    ripple_row = otf_sampling_nonuniformity(results['theta_row'], theta_pb)
+    ripple_dump = otf_sampling_nonuniformity(results['beam_per_dump'].value * theta_pb, theta_pb)
+    results['nonuniformity'] = ripple_row + ripple_dump
+
+    # Pareto front: sort by total time, keep rows that improve on the best
+    # uniformity of all faster configurations. Objectives equal to within
+    # round-off are ties, so total times are grouped before sorting.
+    rtol = 1e-9
+    total_time = results['total_time'].value
+    by_time = np.argsort(total_time, kind='stable')
+    time_group = np.zeros(len(results), dtype=int)
+    time_group[by_time[1:]] = np.cumsum(~np.isclose(total_time[by_time[1:]],
+                                                    total_time[by_time[:-1]],
+                                                    rtol=rtol, atol=0.))
+
+    order = np.lexsort((results['nonuniformity'], time_group))
+    nonuniformity = np.asarray(results['nonuniformity'])[order]
+    best_so_far = np.minimum.accumulate(nonuniformity)
+    on_front = np.ones(len(order), dtype=bool)
+    on_front[1:] = ((nonuniformity[1:] < best_so_far[:-1])
+                    & ~np.isclose(nonuniformity[1:], best_so_far[:-1], rtol=rtol, atol=0.))
+
+    front = results[order[on_front]]
+
+    if verbose:
+        print(f'{len(front)} configurations on the Pareto front.')
+
+    return front
@@ -0,0 +1,592 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import Angle, SkyCoord
+from astropy.table import QTable
+from regions import RectangleSkyRegion, PolygonSkyRegion, EllipseSkyRegion
+
+import itertools
+import re
+
+from otf_instrumentation import timed
+from otf_map_functions import otf_mapping_params_grid, sma_pb_fwhm
+from otf_script_generator import target_line
+
+
+# CRTF rotbox/box, e.g.
+# rotbox[[10.186364deg, 40.615841deg], [0.233333deg, 0.150000deg], 306.000000deg], label='Brick-D-Row-1-Col-1'
+_CRTF_BOX_RE = re.compile(r"^\s*(rotbox|box)\s*\[\s*\[\s*([^,\]]+),\s*([^\]]+)\]\s*,"
+                          r"\s*\[\s*([^,\]]+),\s*([^\]]+)\]\s*(?:,\s*([^\]]+))?\]"
+                          r"(?:.*?label\s*=\s*['\"]([^'\"]*)['\"])?")
+
+
+_CRTF_VALUE_RE = re.compile(r"^\s*([-+0-9.eE]+)\s*([a-z]*)\s*$")
+
+
+def _crtf_quantity(values):
+    '''
+    Parse CRTF angle strings with units (e.g. "10.1deg", "840arcsec") to degrees.
+    '''
+
+    numbers = np.empty(len(values))
+    unit_names = []
+    for ii, value in enumerate(values):
+        match = _CRTF_VALUE_RE.match(value)
+        if match is None:
+            raise ValueError(f"Cannot parse CRTF value: {value}")
+        numbers[ii] = float(match.group(1))
+        unit_names.append(match.group(2) or 'deg')
+
+    unit_names = np.array(unit_names)
+
+    # One conversion per unit
+    for unit_name in np.unique(unit_names):
+        mask = unit_names == unit_name
+        numbers[mask] = (numbers[mask] * u.Unit(unit_name)).to_value(u.deg)
+
+    return numbers * u.deg
+
+
+def read_crtf_rotboxes(filename):
+    '''
+    Read the boxes in a CRTF region file into a table.
+
+    A regex-based reader for the ``rotbox`` and ``box`` lines written for the
+    OTF mosaics. It skips building `regions` objects, which dominates the read
+    time for survey layouts with hundreds of tiles. Other shapes are ignored.
+
+    Parameters
+    ----------
+    filename : str or Path
+        CRTF file.
+
+    Returns
+    -------
+    table : `~astropy.table.QTable`
+        ``label``, ``ra``, ``dec``, ``width``, ``height`` and ``angle``.
+    '''
+
+    matches = []
+    with open(filename, "r") as f:
+        for line in f:
+            match = _CRTF_BOX_RE.match(line)
+            if match is not None:
+                matches.append(match.groups())
+
+    if len(matches) == 0:
+        raise ValueError(f"No box regions found in {filename}")
+
+    _, ra, dec, width, height, angle, labels = zip(*matches)
+
+    angle = [value if value is not None else "0deg" for value in angle]
+    labels = [value if value is not None else "" for value in labels]
+
+    return QTable([list(labels), _crtf_quantity(ra), _crtf_quantity(dec),
+                   _crtf_quantity(width).to(u.arcsec), _crtf_quantity(height).to(u.arcsec),
+                   _crtf_quantity(angle)],
+                  names=['label', 'ra', 'dec', 'width', 'height', 'angle'])
+
+
+def regions_to_table(regions):
+    '''
+    Pull the centers, sizes and angles of `~regions.RectangleSkyRegion` into arrays.
+
+    Parameters
+    ----------
+    regions : list of `~regions.RectangleSkyRegion`
+        E.g., from `~regions.Regions.read`.
+
+    Returns
+    -------
+    table : `~astropy.table.QTable`
+        Same columns as `read_crtf_rotboxes`.
+    '''
+
+    ra = np.array([this_region.center.ra.deg for this_region in regions]) * u.deg
+    dec = np.array([this_region.center.dec.deg for this_region in regions]) * u.deg
+
+    width = np.array([this_region.width.to_value(u.arcsec) for this_region in regions]) * u.arcsec
+    height = np.array([this_region.height.to_value(u.arcsec) for this_region in regions]) * u.arcsec
+    angle = np.array([this_region.angle.to_value(u.deg) for this_region in regions]) * u.deg
+
+    labels = [this_region.meta.get('label', "") for this_region in regions]
+
+    return QTable([labels, ra, dec, width, height, angle],
+                  names=['label', 'ra', 'dec', 'width', 'height', 'angle'])
+
+
+def otf_position_angles(angle, width, height):
+    '''
+    Convert region position angles to the OTF convention.
+
+    The PA is taken along the long axis of the box, wrapped to 0-180 deg, and
+    complemented by 180 deg to match the OTF convention.
+
+    Parameters
+    ----------
+    angle : `~astropy.units.Quantity`
+        Region angles.
+    width, height : `~astropy.units.Quantity`
+        Region sizes.
+
+    Returns
+    -------
+    otf_pa : `~astropy.units.Quantity`
+    '''
+
+    pa = angle.to_value(u.deg)
+
+    # If width>height, shift PA by -90 deg
+    pa = np.where(width > height, pa - 90., pa)
+
+    # Into 0-180 deg. No distinction by 180 deg flips
+    pa = np.where(pa < 0., pa + 180., pa)
+    pa = np.where(pa > 180., pa - 180., pa)
+
+    # To match the OTF convention, take the complement by 180 deg
+    otf_pa = np.where(pa == 0., 0., 180. - pa)
+
+    return otf_pa * u.deg
+
+
+def check_otf_position_angles(otf_pa, labels=None, atol=1e-3 * u.deg):
+    '''
+    Check that all maps share the same OTF position angle.
+
+    Parameters
+    ----------
+    otf_pa : `~astropy.units.Quantity`
+        OTF position angles from `otf_position_angles`.
+    labels : list, optional
+        Region labels for the error message.
+    atol : `~astropy.units.Quantity`
+        Tolerance.
+
+    Returns
+    -------
+    otf_pa0 : `~astropy.units.Quantity`
+        The common position angle.
+    '''
+
+    pa = otf_pa.to_value(u.deg)
+
+    # Difference from the first map, wrapped to +/-90 deg
+    diff = (pa - pa[0] + 90.) % 180. - 90.
+    mismatch = np.abs(diff) > atol.to_value(u.deg)
+
+    if mismatch.any():
+        if labels is None:
+            labels = np.arange(len(pa))
+        bad = [f"{labels[ii]} ({pa[ii]:.2f} deg)" for ii in np.flatnonzero(mismatch)]
+        raise ValueError(f"OTF PAs differ from {pa[0]:.2f} deg for: {', '.join(bad)}")
+
+    return otf_pa[0]
+
+
+def sexagesimal_strings(ra, dec):
+    '''
+    RA (hours) and Dec (deg) strings with ':' separators for a set of positions.
+    '''
+
+    ra_str = Angle(ra).to_string(u.hour, sep=':')
+    dec_str = Angle(dec).to_string(u.deg, sep=':')
+
+    return np.atleast_1d(ra_str), np.atleast_1d(dec_str)
+
+
+def table_to_sma_lines(table, region_prefix='M31', velocity=-296, epoch=2000):
+    '''
+    Target lines for the perl scripts for every region in a table,
+    e.g. "M31-Brick-D-Row-1-Col-1 -r 0:40:44.72736 -d 40:36:57.0276 -e 2000 -v -296".
+
+    Parameters
+    ----------
+    table : `~astropy.table.QTable`
+        From `read_crtf_rotboxes` or `regions_to_table`.
+    region_prefix : str
+        Prefix for the target names.
+    velocity : float
+        LSR velocity (km/s).
+    epoch : int
+        Coordinate epoch.
+
+    Returns
+    -------
+    names : list
+        Target names.
+    lines : list
+        Quoted target strings.
+    '''
+
+    ra_str, dec_str = sexagesimal_strings(table['ra'], table['dec'])
+
+    names = [f"{region_prefix}-{label}" for label in table['label']]
+
+    lines = [target_line(name, ra, dec, velocity, epoch=epoch)
+             for name, ra, dec in zip(names, ra_str, dec_str)]
+
+    return names, lines
+
+
+def fit_otf_tile_size(time_per_track, maps_per_track,
+                      aspect=14. / 9.,
+                      row_length=np.arange(60., 1801., 10.) * u.arcsec,
+                      max_gain_loops_per_map=2,
+                      t_loop=15 * u.min,
+                      t_gain=3 * u.min,
+                      **kwargs):
+    '''
+    Largest OTF map size that fits the gain loop and per-track map budget.
+
+    The map time including gain calibration (``t_otf_map_total``) must fit
+    ``maps_per_track`` times into ``time_per_track`` and use at most
+    ``max_gain_loops_per_map`` gain loops.
+
+    Parameters
+    ----------
+    time_per_track : `~astropy.units.Quantity`
+        Time per track.
+    maps_per_track : int
+        Number of maps per track.
+    aspect : float
+        Ratio of row length to the width of the map.
+    row_length : `~astropy.units.Quantity`
+        Candidate row lengths.
+    max_gain_loops_per_map : int
+        Maximum number of gain loops per map. Use 2 for the interleaved maps.
+    t_loop, t_gain : `~astropy.units.Quantity`
+        See `otf_mapping_params`.
+    kwargs
+        Passed to `otf_mapping_params_grid`.
+
+    Returns
+    -------
+    params : dict
+        `otf_mapping_params_grid` output for the chosen size.
+    '''
+
+    row_length = np.atleast_1d(row_length)
+
+    grid = otf_mapping_params_grid(row_length, row_length / aspect, time_per_track,
+                                   t_loop=t_loop, t_gain=t_gain,
+                                   as_table=False, **kwargs)
+
+    fits = ((grid['N_gain'].to_value(u.one) <= max_gain_loops_per_map)
+            & (grid['t_otf_map_total'] * maps_per_track <= time_per_track))
+
+    if not fits.any():
+        raise ValueError("No map size fits the time budget. Decrease maps_per_track "
+                         "or the smallest row_length.")
+
+    best = np.flatnonzero(fits)[np.argmax(row_length[fits])]
+
+    return {key: value[best] for key, value in grid.items()}
+
+
+def box_axis_vectors(angle):
+    '''
+    Unit vectors (east, north) along the width and height of a box with the
+    `regions` sky angle convention (counter-clockwise from west).
+    '''
+
+    theta = angle.to_value(u.rad)
+
+    width_dir = np.array([-np.cos(theta), np.sin(theta)])
+    height_dir = np.array([np.sin(theta), np.cos(theta)])
+
+    return width_dir, height_dir
+
+
+def footprint_vertices(footprint, n_ellipse=72):
+    '''
+    Polygon vertices of a sky footprint.
+
+    Parameters
+    ----------
+    footprint : `~regions.RectangleSkyRegion`, `~regions.PolygonSkyRegion`,
+        `~regions.EllipseSkyRegion` or `~astropy.coordinates.SkyCoord`
+        Footprint. A SkyCoord is taken as the polygon vertices.
+    n_ellipse : int
+        Number of vertices for an ellipse.
+
+    Returns
+    -------
+    vertices : `~astropy.coordinates.SkyCoord`
+    '''
+
+    if isinstance(footprint, SkyCoord):
+        return footprint
+
+    if isinstance(footprint, PolygonSkyRegion):
+        return footprint.vertices
+
+    width_dir, height_dir = box_axis_vectors(footprint.angle)
+
+    if isinstance(footprint, RectangleSkyRegion):
+        su = 0.5 * footprint.width.to_value(u.deg) * np.array([-1, 1, 1, -1])
+        sv = 0.5 * footprint.height.to_value(u.deg) * np.array([-1, -1, 1, 1])
+    elif isinstance(footprint, EllipseSkyRegion):
+        phi = np.linspace(0, 2 * np.pi, n_ellipse, endpoint=False)
+        su = 0.5 * footprint.width.to_value(u.deg) * np.cos(phi)
+        sv = 0.5 * footprint.height.to_value(u.deg) * np.sin(phi)
+    else:
+        raise TypeError(f"Unsupported footprint type: {type(footprint)}")
+
+    east = su * width_dir[0] + sv * height_dir[0]
+    north = su * width_dir[1] + sv * height_dir[1]
+
+    return footprint.center.spherical_offsets_by(east * u.deg, north * u.deg)
+
+
+def points_in_polygon(x, y, poly_x, poly_y):
+    '''
+    Vectorized even-odd ray casting test for points in a polygon.
+
+    Parameters
+    ----------
+    x, y : `~numpy.ndarray`
+        Points, any shape.
+    poly_x, poly_y : `~numpy.ndarray`
+        Polygon vertices (not closed).
+
+    Returns
+    -------
+    inside : `~numpy.ndarray`
+        Boolean array with the shape of ``x``.
+    '''
+
+    x = np.asarray(x)[..., None]
+    y = np.asarray(y)[..., None]
+
+    x0 = np.asarray(poly_x)
+    y0 = np.asarray(poly_y)
+    x1 = np.roll(x0, -1)
+    y1 = np.roll(y0, -1)
+
+    crosses = (y0 > y) != (y1 > y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+
+    return (np.count_nonzero(crosses & (x < x_cross), axis=-1) % 2) == 1
+
+
+@timed('mosaic.tile')
+def tile_otf_footprint(footprint, time_per_track, maps_per_track,
+                       position_angle=None,
+                       row_length=None,
+                       row_width=None,
+                       theta_pb=None,
+                       freq=230 * u.GHz,
+                       overlap=None,
+                       min_coverage=0.2,
+                       n_phase=4,
+                       n_sample=5,
+                       n_footprint_sample=100,
+                       label_prefix="",
+                       **kwargs):
+    '''
+    Tile a sky footprint with rotated OTF maps.
+
+    The map size is fit to the time budget with `fit_otf_tile_size` unless
+    ``row_length`` and ``row_width`` are given. Tiles are laid on a grid
+    rotated to ``position_angle`` in the tangent plane about the footprint
+    center. Each tile is sampled on an ``n_sample`` x ``n_sample`` grid of
+    points and kept if at least ``min_coverage`` of them fall in the
+    footprint. ``n_phase`` x ``n_phase`` shifts of the grid are tried and the
+    layout covering the most of the footprint (then with the fewest tiles,
+    then with the least area outside the footprint) is kept.
+
+    Parameters
+    ----------
+    footprint : region or `~astropy.coordinates.SkyCoord`
+        See `footprint_vertices`.
+    time_per_track : `~astropy.units.Quantity`
+        Time per track.
+    maps_per_track : int
+        Number of maps per track.
+    position_angle : `~astropy.units.Quantity`, optional
+        Sky angle of the tiles (`regions` convention). Defaults to the
+        footprint's angle, or 0 deg.
+    row_length, row_width : `~astropy.units.Quantity`, optional
+        Map size. The width of the tiles is the row length.
+    theta_pb : `~astropy.units.Quantity`, optional
+        Primary beam FWHM. Defaults to `sma_pb_fwhm` at ``freq``.
+    freq : `~astropy.units.Quantity`
+        Frequency for the primary beam size.
+    overlap : `~astropy.units.Quantity`, optional
+        Overlap between adjacent tiles. Defaults to half the primary beam.
+    min_coverage : float
+        Minimum fraction of a tile inside the footprint.
+    n_phase : int
+        Number of grid shifts per axis.
+    n_sample : int
+        Number of containment test points per tile axis.
+    n_footprint_sample : int
+        Number of test points per axis across the footprint, used to score
+        the covered fraction of each layout.
+    label_prefix : str
+        Prefix for the tile labels, e.g. "Brick-A-".
+    kwargs
+        Passed to `fit_otf_tile_size`.
+
+    Returns
+    -------
+    tiles : `~astropy.table.QTable`
+        Same columns as `read_crtf_rotboxes`, plus ``row``, ``col`` and
+        ``coverage``. The OTF parameters are in ``tiles.meta['otf_params']``.
+    '''
+
+    if theta_pb is None:
+        theta_pb = sma_pb_fwhm(freq)
+
+    if overlap is None:
+        overlap = 0.5 * theta_pb
+
+    if position_angle is None:
+        position_angle = getattr(footprint, 'angle', 0 * u.deg)
+
+    otf_params = None
+    if row_length is None or row_width is None:
+        otf_params = fit_otf_tile_size(time_per_track, maps_per_track,
+                                       theta_pb=theta_pb, **kwargs)
+        row_length = otf_params['row_length']
+        row_width = otf_params['row_width']
+
+    vertices = footprint_vertices(footprint)
+
+    # Footprint center from the mean unit vector
+    center = SkyCoord(vertices.cartesian.mean(), frame=vertices.frame,
+                      representation_type='cartesian')
+    center = SkyCoord(center.spherical.lon, center.spherical.lat, frame=vertices.frame)
+
+    east, north = center.spherical_offsets_to(vertices)
+    east = east.to_value(u.deg)
+    north = north.to_value(u.deg)
+
+    # Footprint in the rotated tile frame
+    width_dir, height_dir = box_axis_vectors(position_angle)
+    poly_u = east * width_dir[0] + north * width_dir[1]
+    poly_v = east * height_dir[0] + north * height_dir[1]
+
+    size_u = row_length.to_value(u.deg)
+    size_v = row_width.to_value(u.deg)
+    step_u = size_u - overlap.to_value(u.deg)
+    step_v = size_v - overlap.to_value(u.deg)
+
+    # Sample offsets within a tile, relative to its center
+    frac = (np.arange(n_sample) + 0.5) / n_sample - 0.5
+    sample_u = np.repeat(frac * size_u, n_sample)
+    sample_v = np.tile(frac * size_v, n_sample)
+
+    # Points filling the footprint, to score how much of it each layout covers
+    fp_u, fp_v = np.meshgrid(np.linspace(poly_u.min(), poly_u.max(), n_footprint_sample),
+                             np.linspace(poly_v.min(), poly_v.max(), n_footprint_sample))
+    fp_inside = points_in_polygon(fp_u, fp_v, poly_u, poly_v)
+    fp_u = fp_u[fp_inside]
+    fp_v = fp_v[fp_inside]
+
+    best = None
+
+    for phase_u, phase_v in itertools.product(np.arange(n_phase) / n_phase, repeat=2):
+
+        # Grid covering the bounding box of the footprint
+        cols = np.arange(np.floor((poly_u.min() - 0.5 * size_u) / step_u - phase_u),
+                         np.ceil((poly_u.max() + 0.5 * size_u) / step_u - phase_u) + 1)
+        rows = np.arange(np.floor((poly_v.min() - 0.5 * size_v) / step_v - phase_v),
+                         np.ceil((poly_v.max() + 0.5 * size_v) / step_v - phase_v) + 1)
+
+        cc, rr = np.meshgrid(cols, rows)
+        tile_u = ((cc + phase_u) * step_u).ravel()
+        tile_v = ((rr + phase_v) * step_v).ravel()
+
+        inside = points_in_polygon(tile_u[:, None] + sample_u[None, :],
+                                   tile_v[:, None] + sample_v[None, :],
+                                   poly_u, poly_v)
+        coverage = inside.mean(axis=1)
+
+        keep = coverage >= min_coverage
+
+        in_tile = ((np.abs(fp_u[:, None] - tile_u[None, keep]) <= 0.5 * size_u)
+                   & (np.abs(fp_v[:, None] - tile_v[None, keep]) <= 0.5 * size_v))
+        covered = np.round(in_tile.any(axis=1).mean(), 3)
+
+        score = (-covered, keep.sum(), -coverage[keep].sum())
+
+        if best is None or score < best[0]:
+            best = (score, tile_u[keep], tile_v[keep], coverage[keep])
+
+    _, tile_u, tile_v, coverage = best
+
+    if tile_u.size == 0:
+        raise ValueError("No tiles cover the footprint. Decrease min_coverage.")
+
+    # Number rows and columns from 1 along the tile axes
+    col = np.round((tile_u - tile_u.min()) / step_u).astype(int) + 1
+    row = np.round((tile_v - tile_v.min()) / step_v).astype(int) + 1
+
+    order = np.lexsort((row, col))
+    tile_u, tile_v, coverage = tile_u[order], tile_v[order], coverage[order]
+    row, col = row[order], col[order]
+
+    tile_east = tile_u * width_dir[0] + tile_v * height_dir[0]
+    tile_north = tile_u * width_dir[1] + tile_v * height_dir[1]
+
+    tile_centers = center.spherical_offsets_by(tile_east * u.deg, tile_north * u.deg)
+
+    labels = [f"{label_prefix}Row-{rr}-Col-{cc}" for rr, cc in zip(row, col)]
+
+    ntile = len(labels)
+
+    tiles = QTable([labels, tile_centers.ra.to(u.deg), tile_centers.dec.to(u.deg),
+                    np.full(ntile, row_length.to_value(u.arcsec)) * u.arcsec,
+                    np.full(ntile, row_width.to_value(u.arcsec)) * u.arcsec,
+                    np.full(ntile, position_angle.to_value(u.deg)) * u.deg,
+                    row, col, coverage],
+                   names=['label', 'ra', 'dec', 'width', 'height', 'angle',
+                          'row', 'col', 'coverage'])
+
+    if otf_params is not None:
+        tiles.meta['otf_params'] = otf_params
+
+    return tiles
+
+
+def write_crtf_rotboxes(table, filename, color='c', linewidth=2):
+    '''
+    Write boxes to a CRTF region file, in the format of `m31_sma_otf_mosaics.crtf`.
+    '''
+
+    lines = ["#CRTFv0", "global coord=J2000"]
+
+    for label, ra, dec, width, height, angle in zip(table['label'],
+                                                    table['ra'].to_value(u.deg),
+                                                    table['dec'].to_value(u.deg),
+                                                    table['width'].to_value(u.deg),
+                                                    table['height'].to_value(u.deg),
+                                                    table['angle'].to_value(u.deg)):
+        lines.append(f"rotbox[[{ra:.6f}deg, {dec:.6f}deg], [{width:.6f}deg, {height:.6f}deg], "
+                     f"{angle:.6f}deg], label='{label}', color={color}, linewidth={linewidth}")
+
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_ds9_boxes(table, filename, color='cyan', width=2):
+    '''
+    Write boxes to a DS9 region file.
+    '''
+
+    lines = ["# Region file format: DS9", f"global color={color} width={width}", "fk5"]
+
+    for label, ra, dec, box_width, box_height, angle in zip(table['label'],
+                                                            table['ra'].to_value(u.deg),
+                                                            table['dec'].to_value(u.deg),
+                                                            table['width'].to_value(u.arcsec),
+                                                            table['height'].to_value(u.arcsec),
+                                                            table['angle'].to_value(u.deg)):
+        lines.append(f'box({ra:.9f}, {dec:.9f}, {box_width:.4f}", {box_height:.4f}", {angle:.6f}) '
+                     f'# text={{{label}}}')
+
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
@@ -0,0 +1,288 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+
+from extract_spatial_coverage import project_otf_offsets, write_field_centers
+from otf_track_simulator import parse_obs_script, otf_params_to_script_values
+
+
+def otf_dump_offsets(row_length, row_offset, n_rows, scan_speed,
+                     t_dump=0.6 * u.s,
+                     pos_angle=0 * u.deg,
+                     start_row=0.,
+                     t_delay=3 * u.s,
+                     t_row_delay=2 * u.s,
+                     t_ramp=3 * u.s):
+    '''
+    Offsets and times of the dumps in one `otf` command.
+
+    Follows the `otf -v -l -y -n -p -i` options used in observeTargetOTF. Rows
+    are scanned in alternate directions and the pattern is centered on the
+    target: row ``k`` is at ``(k + start_row - (n_rows - 1) / 2) * row_offset``
+    perpendicular to the scan direction. Dumps fill each row at the scan speed,
+    after the ramp up.
+
+    Parameters
+    ----------
+    row_length : `~astropy.units.Quantity`
+        Row length (-l).
+    row_offset : `~astropy.units.Quantity`
+        Step between rows (-y).
+    n_rows : int
+        Number of rows (-n).
+    scan_speed : `~astropy.units.Quantity`
+        Scan speed (-v).
+    t_dump : `~astropy.units.Quantity`
+        Integration time per dump ($inttime_sci).
+    pos_angle : `~astropy.units.Quantity`
+        Scan position angle w.r.t. the RA axis (-p).
+    start_row : float
+        Index of the starting row (-i).
+    t_delay, t_row_delay, t_ramp : `~astropy.units.Quantity`
+        Initial delay, delay between rows and ramp up time per row.
+
+    Returns
+    -------
+    offx, offy : `~numpy.ndarray`
+        RA and Dec offsets in arcsec.
+    time : `~numpy.ndarray`
+        Time of each dump from the start of the command in s.
+    row : `~numpy.ndarray`
+        Row index of each dump.
+    '''
+
+    row_length = row_length.to_value(u.arcsec)
+    speed = scan_speed.to_value(u.arcsec / u.s)
+    t_dump = t_dump.to_value(u.s)
+
+    n_rows = int(n_rows)
+
+    row_time = row_length / speed
+    n_dump = int(np.floor(row_time / t_dump))
+
+    # Along the row, from one end of the row
+    along = (np.arange(n_dump) + 0.5) * t_dump * speed - 0.5 * row_length
+    along = np.broadcast_to(along, (n_rows, n_dump)).copy()
+    # Alternate the scan direction on every other row
+    along[1::2] = along[1::2, ::-1]
+
+    rows = np.arange(n_rows)
+    across = (rows + start_row - 0.5 * (n_rows - 1)) * row_offset.to_value(u.arcsec)
+    across = np.broadcast_to(across[:, None], (n_rows, n_dump))
+
+    pa = pos_angle.to_value(u.rad)
+    offx = along * np.cos(pa) - across * np.sin(pa)
+    offy = along * np.sin(pa) + across * np.cos(pa)
+
+    row_start = (t_delay.to_value(u.s)
+                 + rows * (row_time + t_row_delay.to_value(u.s) + t_ramp.to_value(u.s))
+                 + t_ramp.to_value(u.s))
+    time = row_start[:, None] + (np.arange(n_dump) + 0.5)[None, :] * t_dump
+
+    row_index = np.broadcast_to(rows[:, None], (n_rows, n_dump))
+
+    return offx.ravel(), offy.ravel(), time.ravel(), row_index.ravel()
+
+
+def interleaved_dump_offsets(row_length, row_offset, n_rows, scan_speed,
+                             t_dump=0.6 * u.s,
+                             pos_angle=0 * u.deg,
+                             t_gain=3 * u.min,
+                             **kwargs):
+    '''
+    Dump offsets for one map in observeTargetLoopOTFInterleaveMulti.
+
+    The even rows (floor(n_rows / 2), start row 0) are observed first, then a
+    gain scan, then the odd rows (ceil(n_rows / 2), start row 0.5), both at
+    twice the row offset.
+
+    Parameters
+    ----------
+    row_length, row_offset, n_rows, scan_speed, t_dump, pos_angle
+        See `otf_dump_offsets`. ``n_rows`` and ``row_offset`` are for the full map.
+    t_gain : `~astropy.units.Quantity`
+        Time of the gain scan between the two halves.
+    kwargs
+        Passed to `otf_dump_offsets`.
+
+    Returns
+    -------
+    offx, offy, time, row
+        See `otf_dump_offsets`. Times are from the start of the first half.
+    '''
+
+    n_rows = int(n_rows)
+
+    offx0, offy0, time0, row0 = otf_dump_offsets(row_length, 2 * row_offset, n_rows // 2,
+                                                 scan_speed, t_dump=t_dump,
+                                                 pos_angle=pos_angle, start_row=0.,
+                                                 **kwargs)
+    offx1, offy1, time1, row1 = otf_dump_offsets(row_length, 2 * row_offset, n_rows - n_rows // 2,
+                                                 scan_speed, t_dump=t_dump,
+                                                 pos_angle=pos_angle, start_row=0.5,
+                                                 **kwargs)
+
+    # The second half starts after the first and the gain scan
+    t_first = 0. if time0.size == 0 else time0.max() + 0.5 * t_dump.to_value(u.s)
+    time1 = time1 + t_first + t_gain.to_value(u.s)
+
+    return (np.concatenate([offx0, offx1]),
+            np.concatenate([offy0, offy1]),
+            np.concatenate([time0, time1]),
+            np.concatenate([2 * row0, 2 * row1 + 1]))
+
+
+def simulate_otf_sampling(targets, row_length, row_offset, n_rows, scan_speed,
+                          t_dump=0.6 * u.s,
+                          pos_angle=0 * u.deg,
+                          interleave=True,
+                          verbose=False,
+                          **kwargs):
+    '''
+    Predict the dump positions for a sequence of OTF maps.
+
+    The pattern of one map is computed once and offset to every target in a
+    single vectorized projection, so a whole semester (millions of dumps)
+    is generated in about a second.
+
+    Parameters
+    ----------
+    targets : `~astropy.coordinates.SkyCoord`
+        Map centers in observing order. Repeated maps share a field ID, as in
+        the observed data.
+    row_length, row_offset, n_rows, scan_speed, t_dump, pos_angle
+        See `otf_dump_offsets`.
+    interleave : bool
+        Use the interleaved even/odd rows of observeTargetLoopOTFInterleaveMulti.
+        Otherwise, each map is a single `otf` command.
+    verbose : bool
+        Print the number of dumps per field.
+    kwargs
+        Passed to `interleaved_dump_offsets` or `otf_dump_offsets`.
+
+    Returns
+    -------
+    coords_table : `~astropy.table.Table`
+        ``ra``, ``dec`` and ``field_id`` of each dump, the same as the
+        `extract_spatial_coverage.py` output.
+    coord_target : `~astropy.coordinates.SkyCoord`
+        Unique field centers, indexed by the field ID.
+    '''
+
+    if interleave:
+        offx, offy, _, _ = interleaved_dump_offsets(row_length, row_offset, n_rows, scan_speed,
+                                                    t_dump=t_dump, pos_angle=pos_angle, **kwargs)
+    else:
+        offx, offy, _, _ = otf_dump_offsets(row_length, row_offset, n_rows, scan_speed,
+                                            t_dump=t_dump, pos_angle=pos_angle, **kwargs)
+
+    targets = SkyCoord(targets)
+    n_maps = len(targets)
+    n_dump = offx.size
+
+    rar = np.repeat(np.atleast_1d(targets.ra.to_value(u.rad)), n_dump)
+    decr = np.repeat(np.atleast_1d(targets.dec.to_value(u.rad)), n_dump)
+
+    return project_otf_offsets(np.tile(offx, n_maps), np.tile(offy, n_maps),
+                               rar, decr, verbose=verbose)
+
+
+def simulate_script_sampling(script_filename, otf_params=None, t_dump=None,
+                             verbose=False, **kwargs):
+    '''
+    Predict the dump positions for every map in a perl observing script.
+
+    Parameters
+    ----------
+    script_filename : str or Path
+        Script using observeTargetLoopOTFInterleaveMulti, e.g. from
+        `m31_obs_script_generator.py`.
+    otf_params : dict, optional
+        `otf_mapping_params` output to use instead of the script's OTF values.
+    t_dump : `~astropy.units.Quantity`, optional
+        Time per dump. Defaults to $inttime_sci in the script.
+    kwargs
+        Passed to `simulate_otf_sampling`.
+
+    Returns
+    -------
+    coords_table, coord_target
+        See `simulate_otf_sampling`.
+    '''
+
+    script = parse_obs_script(script_filename)
+
+    params = {key: float(script[key])
+              for key in ['rowLength0', 'rowOffset0', 'nRows0', 'scanSpeedOTF0']}
+    if otf_params is not None:
+        params.update(otf_params_to_script_values(otf_params))
+
+    if t_dump is None:
+        t_dump = float(script.get('inttime_sci', 0.6)) * u.s
+
+    return simulate_otf_sampling(script['target_coords'],
+                                 params['rowLength0'] * u.arcsec,
+                                 params['rowOffset0'] * u.arcsec,
+                                 params['nRows0'],
+                                 params['scanSpeedOTF0'] * u.arcsec / u.s,
+                                 t_dump=t_dump,
+                                 pos_angle=float(script.get('posAngle0', 0.)) * u.deg,
+                                 verbose=verbose,
+                                 **kwargs)
+
+
+def coverage_uniformity(eff_time, threshold=0.5):
+    '''
+    Uniformity of the effective time (noise) over the well-covered area.
+
+    Parameters
+    ----------
+    eff_time : `~astropy.units.Quantity` or `~numpy.ndarray`
+        Effective time map, e.g. from `otf_coverage_maps`.
+    threshold : float
+        Pixels above this fraction of the maximum are included.
+
+    Returns
+    -------
+    out_dict : dict
+        ``median`` effective time, fractional ``scatter`` (std / median),
+        ``min_ratio`` (min / median) and the implied ``rms_scatter`` of the
+        noise, and the number of pixels used (``npix``).
+    '''
+
+    values = np.asarray(u.Quantity(eff_time).value)
+    mask = values > threshold * values.max()
+
+    median = np.median(values[mask])
+    scatter = np.std(values[mask]) / median
+
+    return dict(median=median,
+                scatter=scatter,
+                min_ratio=values[mask].min() / median,
+                rms_scatter=0.5 * scatter,
+                npix=int(mask.sum()))
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(description="Predict the OTF dump positions for perl observing scripts.")
+    parser.add_argument("script_filenames", nargs='+', help="Perl observing scripts.")
+    parser.add_argument("--output-path", default=".")
+
+    args = parser.parse_args()
+
+    output_path = Path(args.output_path)
+
+    for script_filename in args.script_filenames:
+        coords_table, coord_target = simulate_script_sampling(script_filename)
+
+        name = f"{Path(script_filename).stem}_predicted"
+
+        coords_table.write(output_path / f"{name}_target_otf_coords.fits", overwrite=True)
+        write_field_centers(coord_target, output_path / f"{name}_field_centers.fits")
+
+        print(f"{script_filename}: {len(coords_table)} dumps in {len(coord_target)} fields.")
@@ -0,0 +1,244 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+import itertools
+
+from otf_instrumentation import timed
+from otf_track_simulator import sma_location
+
+
+# Ratio of sidereal to solar time rates
+_SIDEREAL_RATE = 1.0027379093
+
+
+def elevation_at_lst(coords, lst, location=sma_location):
+    '''
+    Elevation of sources at a set of local sidereal times.
+
+    Parameters
+    ----------
+    coords : `~astropy.coordinates.SkyCoord`
+        Source positions, shape (N_sources,).
+    lst : `~astropy.units.Quantity`
+        Local sidereal times (angle or hourangle) of any shape.
+
+    Returns
+    -------
+    el : `~astropy.units.Quantity`
+        Elevation with shape (N_sources,) + lst.shape.
+    '''
+
+    lst = np.asarray(lst.to_value(u.rad))
+
+    ra = np.atleast_1d(coords.ra.to_value(u.rad)).reshape((-1,) + (1,) * lst.ndim)
+    dec = np.atleast_1d(coords.dec.to_value(u.rad)).reshape((-1,) + (1,) * lst.ndim)
+    lat = location.lat.to_value(u.rad)
+
+    sin_el = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(lst - ra)
+
+    return np.rad2deg(np.arcsin(sin_el)) * u.deg
+
+
+def assign_tracks_to_bricks(nmaps_per_brick, n_tracks, maps_per_track):
+    '''
+    Split a number of tracks between bricks to even out the depth per map.
+
+    Each track is given to the brick with the fewest map repeats so far, so the
+    final repeats per map differ by at most one track's worth between bricks.
+
+    Parameters
+    ----------
+    nmaps_per_brick : dict
+        Number of maps in each brick.
+    n_tracks : int
+        Total number of tracks.
+    maps_per_track : int
+        Number of maps observed per track.
+
+    Returns
+    -------
+    ntracks_per_brick : dict
+        Number of tracks for each brick.
+    '''
+
+    ntracks_per_brick = {brick: 0 for brick in nmaps_per_brick}
+
+    for _ in range(n_tracks):
+        # Depth per map after adding this track to each brick
+        new_depth = {brick: (ntracks_per_brick[brick] + 1) * maps_per_track / nmaps
+                     for brick, nmaps in nmaps_per_brick.items()}
+        this_brick = min(new_depth, key=new_depth.get)
+        ntracks_per_brick[this_brick] += 1
+
+    return ntracks_per_brick
+
+
+@timed('schedule.maps')
+def schedule_otf_maps(map_names, map_coords, track_maps, maps_per_track,
+                      track_lst_start=None,
+                      time_per_map=30 * u.min,
+                      min_elevation=32 * u.deg,
+                      location=sma_location,
+                      slew_weight=1.,
+                      airmass_weight=1.,
+                      depth_weight=10.,
+                      lookahead=2,
+                      initial_repeats=None):
+    '''
+    Assign and order maps within a sequence of tracks.
+
+    Greedy with a look-ahead: at each slot of each track, every sequence of the
+    next ``lookahead`` maps is scored and the first map of the cheapest sequence
+    is kept. The cost of observing a map in a slot is
+
+        slew_weight * slew (deg) + airmass_weight * (airmass - 1)
+        + depth_weight * (2 * (repeats - mean repeats) + 1)
+
+    where the last term is the increase in the variance of the number of
+    repeats across all maps. Slots where a map is below ``min_elevation`` are
+    penalized so they are only used if no other map is up.
+
+    Parameters
+    ----------
+    map_names : list
+        Names of all maps.
+    map_coords : `~astropy.coordinates.SkyCoord`
+        Map centers, same order as ``map_names``.
+    track_maps : list
+        For each track, the list of map names that may be observed (e.g., the
+        maps in one brick).
+    maps_per_track : int or list
+        Number of maps per track (the ``@mainTarg`` length).
+    track_lst_start : `~astropy.units.Quantity`
+        LST at the start of each track. Required: the elevation and airmass
+        terms are only meaningful for the real track start times.
+    time_per_map : `~astropy.units.Quantity`
+        Time per map including its share of the gain calibration.
+    min_elevation : `~astropy.units.Quantity`
+        Target elevation limit ($MINEL_TARG).
+    slew_weight, airmass_weight, depth_weight : float
+        Cost weights.
+    lookahead : int
+        Number of slots scored at each step.
+    initial_repeats : dict, optional
+        Repeats per map already observed in earlier tracks.
+
+    Returns
+    -------
+    schedule : list
+        Ordered map names for each track.
+    summary : `~astropy.table.Table`
+        Per-track slew, airmass and low-elevation time.
+    '''
+
+    map_names = list(map_names)
+    name_index = {name: ii for ii, name in enumerate(map_names)}
+
+    n_tracks = len(track_maps)
+    nslots = np.broadcast_to(np.asarray(maps_per_track, dtype=int), (n_tracks,))
+
+    repeats = np.zeros(len(map_names))
+    if initial_repeats is not None:
+        for name, value in initial_repeats.items():
+            repeats[name_index[name]] = value
+
+    # Mean repeats at the end of the plan sets the depth balance target
+    target_repeats = (repeats.sum() + nslots.sum()) / len(map_names)
+
+    slew = map_coords[:, None].separation(map_coords[None, :]).to_value(u.deg)
+
+    # Slot length in sidereal hours
+    slot_lst = time_per_map.to_value(u.hr) * _SIDEREAL_RATE
+
+    if track_lst_start is None:
+        raise ValueError("track_lst_start is required: give the LST at the start of each track.")
+
+    track_lst_start = np.broadcast_to(track_lst_start.to_value(u.hourangle), (n_tracks,))
+
+    # Airmass sampled at the start, middle and end of each slot:
+    # shape (N_maps, N_tracks, N_slots, 3)
+    max_slots = nslots.max()
+    lst = (track_lst_start[:, None, None]
+           + slot_lst * (np.arange(max_slots)[None, :, None]
+                         + np.array([0., 0.5, 1.])[None, None, :]))
+    el = elevation_at_lst(map_coords, lst * u.hourangle, location=location).to_value(u.deg)
+
+    low_el = el < min_elevation.to_value(u.deg)
+    airmass = 1. / np.sin(np.deg2rad(np.clip(el, 1., 90.)))
+    el_cost = (airmass_weight * (airmass - 1.) + 1e3 * low_el).mean(axis=-1)
+    low_el_time = low_el.mean(axis=-1) * time_per_map.to_value(u.hr)
+
+    schedule = []
+    rows = []
+
+    for tt in range(n_tracks):
+
+        candidates = np.array([name_index[name] for name in track_maps[tt]])
+
+        order = []
+        prev = None
+
+        for ss in range(nslots[tt]):
+
+            depth = lookahead if ss + lookahead <= nslots[tt] else nslots[tt] - ss
+
+            best_cost = np.inf
+            best_first = None
+
+            for seq in itertools.product(candidates, repeat=depth):
+                cost = 0.
+                this_prev = prev
+                extra = {}
+                for kk, mm in enumerate(seq):
+                    nrep = repeats[mm] + extra.get(mm, 0)
+                    cost += depth_weight * (2 * (nrep - target_repeats) + 1)
+                    cost += el_cost[mm, tt, ss + kk]
+                    if this_prev is not None:
+                        cost += slew_weight * slew[this_prev, mm]
+                    extra[mm] = extra.get(mm, 0) + 1
+                    this_prev = mm
+
+                if cost < best_cost:
+                    best_cost = cost
+                    best_first = seq[0]
+
+            order.append(best_first)
+            repeats[best_first] += 1
+            prev = best_first
+
+        order = np.array(order)
+
+        schedule.append([map_names[mm] for mm in order])
+
+        slots = np.arange(nslots[tt])
+        rows.append([tt + 1, len(order),
+                     slew[order[:-1], order[1:]].sum(),
+                     airmass[order, tt, slots].mean(),
+                     el[order, tt, slots].min(),
+                     low_el_time[order, tt, slots].sum()])
+
+    summary = Table(rows=rows, names=['track', 'n_maps', 'slew', 'mean_airmass',
+                                      'min_elevation', 'time_below_min_el'])
+    summary['slew'].unit = u.deg
+    summary['min_elevation'].unit = u.deg
+    summary['time_below_min_el'].unit = u.hr
+
+    summary.meta['repeats'] = {name: int(repeats[ii]) for ii, name in enumerate(map_names)}
+
+    return schedule, summary
+
+
+def regions_to_map_coords(region_dict):
+    '''
+    Map names and centers from the brick -> {name: region} dictionary used in
+    `m31_obs_script_generator.py`.
+    '''
+
+    map_names = [name for brick in region_dict for name in region_dict[brick]]
+    map_coords = SkyCoord([region_dict[brick][name].center
+                           for brick in region_dict for name in region_dict[brick]])
+
+    return map_names, map_coords
@@ -0,0 +1,320 @@
+
+import astropy.units as u
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import json
+from pathlib import Path
+import re
+
+from otf_map_functions import otf_mapping_params
+from otf_track_simulator import otf_params_to_script_values
+
+
+# Placeholders in the templates, e.g. {science_targets}
+_PLACEHOLDER_RE = re.compile(r'\{([a-z_]+)\}')
+
+# Perl scalar assignments in the script header, e.g. $rowLength0 = "840";
+_ASSIGNMENT_RE = re.compile(r'(\$(\w+)\s*=\s*(["\']?))([^"\';\n]*)(\3\s*;)')
+
+
+def compile_template(text):
+    '''
+    Split an observing script template into literal text and fields.
+
+    Fields are the ``{placeholder}`` markers (e.g., ``{science_targets}``) and
+    the value of the first assignment of each perl scalar in the script header
+    (before the subroutine definitions), so any existing observing script can
+    also be used as a template.
+
+    Parameters
+    ----------
+    text : str
+        Template contents.
+
+    Returns
+    -------
+    compiled : dict
+        ``segments`` (literal text), ``fields`` (field names between the
+        segments), ``placeholders`` and ``defaults`` (the template's variable
+        values).
+    '''
+
+    header_end = text.find("\nsub ")
+    if header_end < 0:
+        header_end = len(text)
+
+    spans = []
+    defaults = {}
+
+    for match in _ASSIGNMENT_RE.finditer(text, 0, header_end):
+        name = match.group(2)
+        # Skip commented lines
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        if "#" in text[line_start:match.start()]:
+            continue
+        if name in defaults:
+            continue
+        defaults[name] = match.group(4)
+        spans.append((match.start(4), match.end(4), name))
+
+    placeholders = []
+    for match in _PLACEHOLDER_RE.finditer(text):
+        spans.append((match.start(), match.end(), match.group(1)))
+        placeholders.append(match.group(1))
+
+    spans.sort()
+
+    segments = []
+    fields = []
+    last = 0
+    for start, end, name in spans:
+        segments.append(text[last:start])
+        fields.append(name)
+        last = end
+    segments.append(text[last:])
+
+    return dict(segments=segments, fields=fields,
+                placeholders=placeholders, defaults=defaults)
+
+
+@lru_cache(maxsize=None)
+def _load_template_cached(template_filename, mtime_ns):
+    with open(template_filename, "r") as f:
+        return compile_template(f.read())
+
+
+def load_template(template_filename):
+    '''
+    Read and compile a template. Cached until the file is modified.
+    '''
+
+    template_filename = Path(template_filename).resolve()
+
+    return _load_template_cached(str(template_filename),
+                                 template_filename.stat().st_mtime_ns)
+
+
+def target_line(name, ra, dec, velocity, epoch=2000):
+    '''
+    Format a target for @mainTarg or $targ0,
+    e.g. "M82 -r 09:55:59.7 -d +69:40:55 -e 2000 -v 270".
+    '''
+
+    return f'"{name} -r {ra} -d {dec} -e {epoch} -v {velocity}"'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f"{value:g}"
+
+    return str(value)
+
+
+@lru_cache(maxsize=256)
+def _cached_otf_script_values(otf_params_items):
+    kwargs = {key: u.Quantity(value) if isinstance(value, str) else value
+              for key, value in otf_params_items}
+
+    return otf_params_to_script_values(otf_mapping_params(verbose=False, **kwargs))
+
+
+def otf_script_values(otf_params):
+    '''
+    Perl OTF loop values from `otf_mapping_params` inputs.
+
+    Parameters
+    ----------
+    otf_params : dict
+        Keyword arguments of `otf_mapping_params`. Quantities can be given as
+        strings (e.g. ``"840 arcsec"``) for JSON configs.
+
+    Returns
+    -------
+    out_dict : dict
+        ``rowLength0``, ``rowOffset0``, ``nRows0`` and ``scanSpeedOTF0``.
+    '''
+
+    items = tuple(sorted((key, value.to_string() if isinstance(value, u.Quantity) else value)
+                         for key, value in otf_params.items()))
+
+    out_dict = dict(_cached_otf_script_values(items))
+    out_dict['nRows0'] = int(round(out_dict['nRows0']))
+
+    return out_dict
+
+
+def render_template(template, targets=None, variables=None, otf_params=None):
+    '''
+    Fill a compiled template.
+
+    Parameters
+    ----------
+    template : dict or str or Path
+        Output of `compile_template`, or a template file name.
+    targets : list, optional
+        Science targets for ``{science_targets}``. Each is a target string
+        (see `target_line`) or a dict of `target_line` arguments.
+    variables : dict, optional
+        Perl scalar values to set, e.g. ``{'posAngle0': 54, 'cal0': '0136+478'}``.
+    otf_params : dict, optional
+        `otf_mapping_params` inputs. Sets the row length, row offset, number
+        of rows and scan speed; explicit ``variables`` take precedence.
+
+    Returns
+    -------
+    text : str
+        Rendered script.
+    '''
+
+    if not isinstance(template, dict):
+        template = load_template(template)
+
+    values = dict(template['defaults'])
+
+    if otf_params is not None:
+        values.update(otf_script_values(otf_params))
+
+    if variables is not None:
+        unknown = set(variables) - set(template['defaults'])
+        if unknown:
+            raise KeyError(f"Variables not set in the template: {sorted(unknown)}")
+        values.update(variables)
+
+    if targets is not None:
+        lines = []
+        for this_target in targets:
+            if isinstance(this_target, dict):
+                lines.append(target_line(**this_target))
+            elif this_target.startswith('"'):
+                lines.append(this_target)
+            else:
+                lines.append(f'"{this_target}"')
+        values['science_targets'] = ",\n".join(lines)
+
+    missing = set(template['placeholders']) - set(values)
+    if missing:
+        raise ValueError(f"No values given for template fields: {sorted(missing)}")
+
+    pieces = [template['segments'][0]]
+    for name, segment in zip(template['fields'], template['segments'][1:]):
+        pieces.append(_format_value(values[name]))
+        pieces.append(segment)
+
+    return "".join(pieces)
+
+
+def _render_one(job):
+    '''
+    Render and write one script. Module-level so it can run in a worker process.
+    '''
+
+    text = render_template(job['template'],
+                           targets=job.get('targets'),
+                           variables=job.get('variables'),
+                           otf_params=job.get('otf_params'))
+
+    # The templates start with an empty line. Slice this out.
+    if text.startswith("\n"):
+        text = text[1:]
+
+    output_filename = Path(job['output'])
+    output_filename.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(output_filename, "w") as f:
+        f.write(text)
+
+    return str(output_filename)
+
+
+def render_scripts(config, n_workers=None):
+    '''
+    Render observing scripts in bulk from a declarative config.
+
+    The config is a dict (or a JSON file name) with a list of ``scripts``.
+    Each entry has an ``output`` file name and any of ``template``,
+    ``targets``, ``variables`` and ``otf_params`` (see `render_template`).
+    Keys in ``defaults`` apply to every script, with ``variables`` and
+    ``otf_params`` merged per key. Relative paths are taken from
+    ``output_path`` (outputs) and ``template_path`` (templates), which
+    default to the config's directory. For example::
+
+        {"output_path": "m31_observing_scripts",
+         "defaults": {"template": "m31_otf_sub_basetemplate.pl",
+                      "variables": {"posAngle0": 54, "cal0": "0136+478"},
+                      "otf_params": {"row_length": "840 arcsec",
+                                     "row_width": "600 arcsec",
+                                     "time_per_track": "7 hr"}},
+         "scripts": [{"output": "sub_Brick_A_track_1.pl",
+                      "targets": ["M31-Brick-A-Row-1-Col-7 -r 0:45:16.88 -d 41:40:09.3 -e 2000 -v -296"]}]}
+
+    Parameters
+    ----------
+    config : dict or str or Path
+        Config or JSON config file.
+    n_workers : int, optional
+        Number of processes. Defaults to the number of CPUs; 1 renders serially.
+
+    Returns
+    -------
+    output_filenames : list
+        Written scripts.
+    '''
+
+    base_path = Path(".")
+    if not isinstance(config, dict):
+        base_path = Path(config).parent
+        with open(config, "r") as f:
+            config = json.load(f)
+
+    output_path = base_path / config.get('output_path', ".")
+    template_path = base_path / config.get('template_path', config.get('output_path', "."))
+
+    defaults = config.get('defaults', {})
+
+    jobs = []
+    for entry in config['scripts']:
+        job = {key: value for key, value in defaults.items()
+               if key not in ['variables', 'otf_params']}
+        job.update({key: value for key, value in entry.items()
+                    if key not in ['variables', 'otf_params']})
+
+        for key in ['variables', 'otf_params']:
+            merged = dict(defaults.get(key, {}))
+            merged.update(entry.get(key, {}))
+            if merged:
+                job[key] = merged
+
+        if 'template' not in job:
+            raise ValueError(f"No template given for {entry['output']}")
+
+        job['template'] = str(template_path / job['template'])
+        job['output'] = str(output_path / job['output'])
+
+        jobs.append(job)
+
+    # Compile each template once in this process; this also checks they exist.
+    for template_filename in set(job['template'] for job in jobs):
+        load_template(template_filename)
+
+    if n_workers == 1 or len(jobs) < 2:
+        return [_render_one(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_render_one, jobs))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render OTF observing scripts from a JSON config.")
+    parser.add_argument("config", help="JSON config file.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes (default: number of CPUs).")
+
+    args = parser.parse_args()
+
+    output_filenames = render_scripts(args.config, n_workers=args.workers)
+
+    print(f"Wrote {len(output_filenames)} scripts.")
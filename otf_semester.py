@@ -0,0 +1,494 @@
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+from astropy.time import Time
+
+from otf_instrumentation import count, get_logger, timed
+from otf_schedule import elevation_at_lst, _SIDEREAL_RATE
+from otf_track_simulator import sma_location, calibrator_coords
+
+
+logger = get_logger("otf_semester")
+
+
+def otf_project(name, otf_params, coords, calibrators,
+                n_maps=None,
+                maps_done=0,
+                min_elevation=20 * u.deg,
+                max_elevation=83 * u.deg,
+                cal_min_elevation=17 * u.deg,
+                cal_max_elevation=83 * u.deg,
+                overhead=1 * u.hr,
+                min_track_length=2 * u.hr,
+                weight=1.):
+    '''
+    Describe one OTF project for `pack_semester`.
+
+    Parameters
+    ----------
+    name : str
+        Project name.
+    otf_params : dict
+        Output of `otf_mapping_params`. Only ``t_otf_map_total`` (time per
+        map with its gain calibration) and ``N_otf_maps`` are used.
+    coords : `~astropy.coordinates.SkyCoord` or str
+        Target position(s). With several targets, all must be up.
+    calibrators : list
+        Gain calibrator names (keys of ``calibrator_coords``) or SkyCoords.
+        At least one must be up, as in the primary/secondary fallback.
+    n_maps : int, optional
+        Maps to schedule. Defaults to ceil(N_otf_maps) - maps_done.
+    maps_done : int
+        Maps already observed.
+    min_elevation, max_elevation : `~astropy.units.Quantity`
+        Target elevation limits ($MINEL_TARG, $MAXEL_TARG).
+    cal_min_elevation, cal_max_elevation : `~astropy.units.Quantity`
+        Gain calibrator limits ($MINEL_GAIN, $MAXEL_GAIN).
+    overhead : `~astropy.units.Quantity`
+        Time per track not spent on maps (flux, bandpass, setup).
+    min_track_length : `~astropy.units.Quantity`
+        Shortest track worth scheduling, including the overhead.
+    weight : float
+        Priority. The value of one completed map.
+
+    Returns
+    -------
+    project : dict
+    '''
+
+    if n_maps is None:
+        n_maps = int(np.ceil(u.Quantity(otf_params['N_otf_maps']).to_value(u.one))) - maps_done
+
+    cal_coords = SkyCoord([calibrator_coords[cal] if isinstance(cal, str) else cal
+                           for cal in calibrators])
+
+    return dict(name=name,
+                coords=SkyCoord(coords, unit=(u.hourangle, u.deg)) if isinstance(coords, str)
+                else SkyCoord(coords),
+                calibrators=cal_coords,
+                t_map=u.Quantity(otf_params['t_otf_map_total']).to(u.hr),
+                n_maps=max(int(n_maps), 0),
+                min_elevation=min_elevation,
+                max_elevation=max_elevation,
+                cal_min_elevation=cal_min_elevation,
+                cal_max_elevation=cal_max_elevation,
+                overhead=overhead,
+                min_track_length=min_track_length,
+                weight=weight)
+
+
+def night_windows(first_night, n_nights, duration=12 * u.hr, skip=None):
+    '''
+    Consecutive observing windows, one per night.
+
+    Parameters
+    ----------
+    first_night : `~astropy.time.Time` or str
+        UTC start of the first window.
+    n_nights : int
+        Number of nights.
+    duration : `~astropy.units.Quantity`
+        Length of each window.
+    skip : list of int, optional
+        Nights (0-based) to leave out, e.g. engineering or lost to weather.
+
+    Returns
+    -------
+    nights : `~astropy.table.Table`
+        ``night`` index, ``start`` (Time) and ``duration`` (hr).
+    '''
+
+    index = np.arange(n_nights)
+    if skip is not None:
+        index = np.setdiff1d(index, skip)
+
+    nights = Table()
+    nights['night'] = index
+    nights['start'] = Time(first_night) + index * u.day
+    nights['duration'] = np.full(index.size, duration.to_value(u.hr)) * u.hr
+
+    return nights
+
+
+def observable_slots(projects, nights, slot=15 * u.min, location=sma_location):
+    '''
+    Which slots of each night each project can be observed in.
+
+    A slot is usable when all targets are within the target limits and at
+    least one gain calibrator is within the calibrator limits, at both ends
+    of the slot.
+
+    Returns
+    -------
+    ok : `~numpy.ndarray`
+        Boolean array (N_projects, N_nights, N_slots).
+    lst_start : `~numpy.ndarray`
+        LST (hr) at the start of each night.
+    '''
+
+    slot_hr = slot.to_value(u.hr)
+    durations = u.Quantity(nights['duration']).to_value(u.hr)
+    nslots = np.floor(durations / slot_hr + 1e-9).astype(int)
+    max_slots = nslots.max()
+
+    lst_start = Time(nights['start']).sidereal_time('mean', longitude=location.lon).to_value(u.hourangle)
+
+    edges = np.arange(max_slots + 1)
+    lst = (lst_start[:, None] + edges[None, :] * slot_hr * _SIDEREAL_RATE) * u.hourangle
+
+    in_night = edges[None, :max_slots] < nslots[:, None]
+
+    ok = np.zeros((len(projects), len(nights), max_slots), dtype=bool)
+    for ii, project in enumerate(projects):
+        el = elevation_at_lst(project['coords'], lst, location=location).to_value(u.deg)
+        up = np.all((el >= project['min_elevation'].to_value(u.deg)) &
+                    (el <= project['max_elevation'].to_value(u.deg)), axis=0)
+
+        cal_el = elevation_at_lst(project['calibrators'], lst, location=location).to_value(u.deg)
+        up &= np.any((cal_el >= project['cal_min_elevation'].to_value(u.deg)) &
+                     (cal_el <= project['cal_max_elevation'].to_value(u.deg)), axis=0)
+
+        ok[ii] = up[:, :-1] & up[:, 1:] & in_night
+
+    return ok, lst_start
+
+
+def _longest_runs(ok):
+    '''
+    Longest run of consecutive True slots along the last axis.
+    '''
+
+    run = np.zeros(ok.shape[:-1], dtype=int)
+    longest = np.zeros(ok.shape[:-1], dtype=int)
+    for ss in range(ok.shape[-1]):
+        run = (run + 1) * ok[..., ss]
+        np.maximum(longest, run, out=longest)
+
+    return longest
+
+
+def _best_tracks(ok, slot_hr, t_map, overhead, min_slots, cap, full_maps, price,
+                 track_cost, partial_cost):
+    '''
+    Best set of non-overlapping tracks in every night, for fixed prices.
+
+    Dynamic program over the slot boundaries, vectorized over nights,
+    projects and track start slots. ``cap`` limits the maps of a single track.
+
+    Returns
+    -------
+    tracks : list
+        (value, night, project, start slot, end slot, maps) for each track.
+    '''
+
+    nproj, nnight, nslot = ok.shape
+
+    cum = np.zeros((nproj, nnight, nslot + 1), dtype=int)
+    np.cumsum(ok, axis=-1, out=cum[..., 1:])
+
+    best = np.zeros((nnight, nslot + 1))
+    # -1: slot left empty; otherwise project * nslot + start slot
+    choice = np.full((nnight, nslot + 1), -1)
+
+    t_map = t_map[:, None, None]
+    overhead = overhead[:, None, None]
+    price3 = price[:, None, None]
+    cap3 = cap[:, None, None]
+    full3 = np.minimum(full_maps, cap)[:, None, None]
+
+    for bb in range(1, nslot + 1):
+        best[:, bb] = best[:, bb - 1]
+
+        length = bb - np.arange(bb)
+        usable = (cum[:, :, bb, None] - cum[:, :, :bb]) == length
+
+        maps = np.minimum(np.floor((length * slot_hr - overhead) / t_map + 1e-9), cap3)
+        valid = usable & (length >= min_slots[:, None, None]) & (maps >= 1)
+
+        # A small cost per slot keeps tracks no longer than their maps need
+        value = price3 * (maps - track_cost - partial_cost * (maps < full3) - 1e-3 * length)
+        total = np.where(valid, best[None, :, :bb] + value, -np.inf)
+
+        total = total.transpose(1, 0, 2).reshape(nnight, nproj * bb)
+        idx = np.argmax(total, axis=1)
+        top = total[np.arange(nnight), idx]
+
+        better = top > best[:, bb]
+        best[better, bb] = top[better]
+        choice[better, bb] = (idx[better] // bb) * nslot + idx[better] % bb
+
+    tracks = []
+    for nn in range(nnight):
+        bb = nslot
+        while bb > 0:
+            this = choice[nn, bb]
+            if this < 0:
+                bb -= 1
+                continue
+            pp, aa = divmod(this, nslot)
+            maps = min(np.floor(((bb - aa) * slot_hr - overhead[pp, 0, 0]) / t_map[pp, 0, 0] + 1e-9),
+                       cap[pp])
+            value = price[pp] * (maps - track_cost - partial_cost * (maps < min(full_maps[pp], cap[pp])))
+            tracks.append((value, nn, pp, aa, bb, int(maps)))
+            bb = aa
+
+    return tracks
+
+
+def _pack_once(ok, slot_hr, t_map, overhead, min_slots, n_maps, full_maps, price,
+               track_cost, partial_cost):
+    '''
+    Repeatedly solve all nights and accept the best tracks within the map budgets.
+    '''
+
+    ok = ok.copy()
+    remaining = n_maps.astype(float).copy()
+    accepted = []
+
+    while remaining.max() > 0:
+        proposals = _best_tracks(ok & (remaining > 0)[:, None, None], slot_hr, t_map, overhead,
+                                 min_slots, remaining, full_maps, price, track_cost, partial_cost)
+        count("semester.proposals", len(proposals))
+        if len(proposals) == 0:
+            break
+
+        used_nights = set()
+        n_accepted = 0
+        for value, nn, pp, aa, bb, maps in sorted(proposals, key=lambda track: -track[0]):
+            if nn in used_nights or remaining[pp] < 1:
+                continue
+
+            if maps > remaining[pp]:
+                # Shorten the track to the maps still needed
+                maps = int(remaining[pp])
+                bb = aa + int(np.ceil((maps * t_map[pp] + overhead[pp]) / slot_hr - 1e-9))
+                if bb - aa < min_slots[pp]:
+                    continue
+
+            accepted.append((nn, pp, aa, bb, maps))
+            remaining[pp] -= maps
+            ok[:, nn, aa:bb] = False
+            n_accepted += 1
+
+            # The rest of this night's solution assumed the old budgets
+            used_nights.add(nn)
+
+        if n_accepted == 0:
+            break
+
+    return accepted
+
+
+@timed('semester.pack')
+def pack_semester(projects, nights,
+                  slot=15 * u.min,
+                  track_cost=0.5,
+                  partial_cost=2.,
+                  partial_fraction=0.75,
+                  n_iter=4,
+                  location=sma_location):
+    '''
+    Pack the maps of several OTF projects into the available nights.
+
+    Each night can hold several tracks, one project each, in non-overlapping
+    LST windows where the project's targets and a gain calibrator are up.
+    Completed maps are maximized, with a penalty per track and per partial
+    track (fewer maps than a ``partial_fraction`` of the project's longest
+    possible track). Projects with little observable time compared to their
+    demand are given a higher price so they are not crowded out, and the
+    prices of projects left incomplete are raised over ``n_iter`` passes.
+    The elevation masks are computed once, so re-running after losing a
+    night (drop it from ``nights`` and reduce ``n_maps``) takes about a
+    second for a semester.
+
+    Parameters
+    ----------
+    projects : list of dict
+        From `otf_project`.
+    nights : `~astropy.table.Table`
+        ``start`` (Time) and ``duration`` of each window, e.g. from
+        `night_windows`.
+    slot : `~astropy.units.Quantity`
+        Time resolution of the track boundaries.
+    track_cost, partial_cost : float
+        Penalty per track and per partial track, in maps.
+    partial_fraction : float
+        Tracks with fewer maps than this fraction of a full track are partial.
+    n_iter : int
+        Number of pricing passes. The best plan is returned.
+    location : `~astropy.coordinates.EarthLocation`
+        Observatory location.
+
+    Returns
+    -------
+    tracks : `~astropy.table.Table`
+        One row per track, in time order: ``night``, ``project``, ``start``
+        and ``end`` (UTC), ``lst_start``, ``lst_end``, ``duration``,
+        ``n_maps`` and ``partial``.
+    summary : `~astropy.table.Table`
+        Per project: maps requested and scheduled, tracks, partial tracks,
+        scheduled hours and ``completion``.
+    '''
+
+    nproj = len(projects)
+    slot_hr = slot.to_value(u.hr)
+
+    ok, lst_start = observable_slots(projects, nights, slot=slot, location=location)
+
+    t_map = np.array([project['t_map'].to_value(u.hr) for project in projects])
+    overhead = np.array([project['overhead'].to_value(u.hr) for project in projects])
+    n_maps = np.array([project['n_maps'] for project in projects])
+    weight = np.array([project['weight'] for project in projects], dtype=float)
+    min_slots = np.array([max(1, int(np.ceil(project['min_track_length'].to_value(u.hr) / slot_hr - 1e-9)))
+                          for project in projects])
+
+    # A full track uses the longest observable window of a typical night
+    longest = _longest_runs(ok) * slot_hr
+    typical = np.array([np.median(row[row > 0]) if np.any(row > 0) else 0. for row in longest])
+    full_maps = np.maximum(1, np.floor(partial_fraction * (typical - overhead) / t_map))
+
+    # Demand over supply of observable time, including the track overheads
+    demand = n_maps * t_map + overhead * np.ceil(n_maps / np.maximum(full_maps, 1))
+    supply = longest.sum(axis=1)
+    scarcity = np.clip(demand / np.maximum(supply, slot_hr), 0.1, 10.)
+    price = weight * np.sqrt(scarcity / np.median(scarcity))
+
+    best_plan = None
+    best_score = None
+    for _ in range(max(1, n_iter)):
+        plan = _pack_once(ok, slot_hr, t_map, overhead, min_slots, n_maps, full_maps, price,
+                          track_cost, partial_cost)
+
+        done = np.bincount([pp for _, pp, _, _, _ in plan],
+                           weights=[maps for _, _, _, _, maps in plan], minlength=nproj)
+        n_partial = sum(maps < min(full_maps[pp], n_maps[pp]) for _, pp, _, _, maps in plan)
+
+        score = (np.sum(weight * done), -n_partial, -len(plan))
+        if best_score is None or score > best_score:
+            best_plan, best_score = plan, score
+
+        incomplete = done < n_maps
+        if not incomplete.any():
+            break
+        price = np.where(incomplete, price * 1.5, price)
+
+    nights_start = Time(nights['start'])
+    night_index = np.asarray(nights['night']) if 'night' in nights.colnames else np.arange(len(nights))
+
+    plan = sorted(best_plan, key=lambda track: (track[0], track[2]))
+
+    tracks = Table()
+    tracks['night'] = [night_index[nn] for nn, _, _, _, _ in plan]
+    tracks['project'] = [projects[pp]['name'] for _, pp, _, _, _ in plan]
+    tracks['start'] = Time([nights_start[nn] + aa * slot for nn, _, aa, _, _ in plan]) \
+        if len(plan) > 0 else Time([], format='mjd')
+    tracks['end'] = Time([nights_start[nn] + bb * slot for nn, _, _, bb, _ in plan]) \
+        if len(plan) > 0 else Time([], format='mjd')
+    tracks['lst_start'] = [np.mod(lst_start[nn] + aa * slot_hr * _SIDEREAL_RATE, 24.)
+                           for nn, _, aa, _, _ in plan] * u.hourangle
+    tracks['lst_end'] = [np.mod(lst_start[nn] + bb * slot_hr * _SIDEREAL_RATE, 24.)
+                         for nn, _, _, bb, _ in plan] * u.hourangle
+    tracks['duration'] = [(bb - aa) * slot_hr for _, _, aa, bb, _ in plan] * u.hr
+    tracks['n_maps'] = np.array([maps for _, _, _, _, maps in plan], dtype=int)
+    tracks['partial'] = np.array([maps < min(full_maps[pp], n_maps[pp]) for _, pp, _, _, maps in plan],
+                                 dtype=bool)
+
+    summary = Table()
+    summary['project'] = [project['name'] for project in projects]
+    summary['n_maps'] = n_maps
+    summary['maps_scheduled'] = [int(np.sum(tracks['n_maps'][tracks['project'] == name]))
+                                 for name in summary['project']]
+    summary['n_tracks'] = [int(np.sum(tracks['project'] == name)) for name in summary['project']]
+    summary['n_partial'] = [int(np.sum(tracks['partial'][tracks['project'] == name]))
+                            for name in summary['project']]
+    summary['full_track_maps'] = full_maps.astype(int)
+    summary['hours'] = [float(np.sum(tracks['duration'][tracks['project'] == name].value))
+                        for name in summary['project']] * u.hr
+    summary['completion'] = np.where(n_maps > 0, summary['maps_scheduled'] / np.maximum(n_maps, 1), 1.)
+    summary['completion'].format = '.2f'
+
+    logger.info(f"Scheduled {int(np.sum(summary['maps_scheduled']))} of {int(n_maps.sum())} maps "
+                f"in {len(tracks)} tracks ({int(np.sum(tracks['partial']))} partial).")
+
+    return tracks, summary
+
+
+def _config_quantity(value, unit):
+    '''
+    Quantity from a JSON config value: a number in ``unit`` or a string like "30 min".
+    '''
+
+    if isinstance(value, str):
+        return u.Quantity(value).to(unit)
+
+    return value * unit
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import json
+    import logging
+
+    from otf_map_functions import otf_mapping_params
+
+    parser = argparse.ArgumentParser(description="Pack the maps of several OTF projects into a "
+                                                 "semester of nights.")
+    parser.add_argument("config",
+                        help="JSON file with a 'projects' list. Each project has a name, coords "
+                             "('09:55:59.7 +69:40:55', or a list), calibrators, and either "
+                             "t_map (hr) and n_maps, or otf_params for otf_mapping_params "
+                             "(strings with units, e.g. '7.5 arcmin'). Optional: maps_done, "
+                             "min_elevation, max_elevation, cal_min_elevation, cal_max_elevation "
+                             "(deg), overhead, min_track_length (hr) and weight.")
+    parser.add_argument("--start", required=True,
+                        help="UTC start of the first night, e.g. 2025-11-01T04:00:00")
+    parser.add_argument("--nights", type=int, default=90)
+    parser.add_argument("--duration", type=float, default=12., help="Hours per night.")
+    parser.add_argument("--skip", type=int, nargs="*", default=None,
+                        help="Nights (0-based) that are not available, e.g. lost to weather.")
+    parser.add_argument("--slot", type=float, default=15., help="Slot length in minutes.")
+    parser.add_argument("--output", default=None, help="Track table, e.g. semester.ecsv.")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+
+    projects = []
+    for entry in config['projects']:
+        if 'otf_params' in entry:
+            otf_params = otf_mapping_params(**{key: u.Quantity(value) if isinstance(value, str) else value
+                                               for key, value in entry['otf_params'].items()})
+        else:
+            otf_params = dict(t_otf_map_total=entry['t_map'] * u.hr, N_otf_maps=entry['n_maps'])
+
+        coords = entry['coords']
+        if not isinstance(coords, str):
+            coords = SkyCoord(coords, unit=(u.hourangle, u.deg))
+
+        kwargs = {key: _config_quantity(entry[key], u.deg)
+                  for key in ['min_elevation', 'max_elevation', 'cal_min_elevation', 'cal_max_elevation']
+                  if key in entry}
+        kwargs.update({key: _config_quantity(entry[key], u.hr)
+                       for key in ['overhead', 'min_track_length'] if key in entry})
+
+        projects.append(otf_project(entry['name'], otf_params, coords, entry['calibrators'],
+                                    maps_done=entry.get('maps_done', 0),
+                                    weight=entry.get('weight', 1.),
+                                    **kwargs))
+
+    nights = night_windows(args.start, args.nights, duration=args.duration * u.hr, skip=args.skip)
+
+    tracks, summary = pack_semester(projects, nights, slot=args.slot * u.min)
+
+    summary.pprint(max_lines=-1, max_width=-1)
+
+    if args.output is not None:
+        tracks.write(args.output, overwrite=True)
+    else:
+        tracks.pprint(max_lines=-1, max_width=-1)
@@ -0,0 +1,415 @@
+
+# Simulate a night of the generated OTF observing scripts.
+#
+# Replays the observeTargetLoopOTFInterleaveMulti loop in the perl templates
+# (e.g. m31_observing_scripts/m31_otf_sub_basetemplate.pl) with source
+# elevations, the primary/secondary gain calibrator fallback and the ipoint
+# cadence, using the same time estimates as the perl [SIMULATION MODE].
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import EarthLocation, SkyCoord
+from astropy.table import Table
+from astropy.time import Time
+
+import re
+from pathlib import Path
+
+
+# SMA array center on Maunakea
+sma_location = EarthLocation.from_geodetic(lon=-155.4775 * u.deg,
+                                           lat=19.8242 * u.deg,
+                                           height=4080 * u.m)
+
+# J2000 positions of the calibrators used in these scripts (SMA calibrator list)
+calibrator_coords = {"0136+478": SkyCoord("01:36:58.59 +47:51:29.1", unit=(u.hourangle, u.deg)),
+                     "0013+408": SkyCoord("00:13:31.13 +40:51:37.1", unit=(u.hourangle, u.deg)),
+                     "0359+509": SkyCoord("03:59:29.75 +50:57:50.2", unit=(u.hourangle, u.deg)),
+                     "0228+673": SkyCoord("02:28:50.05 +67:21:03.0", unit=(u.hourangle, u.deg)),
+                     "0958+655": SkyCoord("09:58:47.25 +65:33:54.8", unit=(u.hourangle, u.deg)),
+                     "0841+708": SkyCoord("08:41:24.37 +70:53:42.2", unit=(u.hourangle, u.deg)),
+                     "0721+713": SkyCoord("07:21:53.45 +71:20:36.4", unit=(u.hourangle, u.deg)),
+                     "2158-150": SkyCoord("21:58:06.28 -15:01:09.3", unit=(u.hourangle, u.deg)),
+                     "2246-121": SkyCoord("22:46:18.23 -12:06:51.3", unit=(u.hourangle, u.deg)),
+                     "2258-279": SkyCoord("22:58:05.96 -27:58:21.3", unit=(u.hourangle, u.deg)),
+                     "3c84": SkyCoord("03:19:48.16 +41:30:42.1", unit=(u.hourangle, u.deg)),
+                     "3c273": SkyCoord("12:29:06.70 +02:03:08.6", unit=(u.hourangle, u.deg)),
+                     "3c279": SkyCoord("12:56:11.17 -05:47:21.5", unit=(u.hourangle, u.deg)),
+                     }
+
+
+def parse_obs_script(script_filename):
+    '''
+    Read the targets and loop parameters from a generated perl observing script.
+
+    Parameters
+    ----------
+    script_filename : str or Path
+        Perl script, e.g. from `m31_obs_script_generator.py`.
+
+    Returns
+    -------
+    out_dict : dict
+        ``targets`` (list of names), ``target_coords`` (SkyCoord) and the perl
+        scalar variables (``rowLength0``, ``cal0``, ``MINEL_TARG``, ...) as strings.
+        ``elLimitBuffer`` is only included when the script's OTF elevation check
+        uses ``$MINEL_TARG + $elLimitBuffer``.
+    '''
+
+    with open(script_filename, "r") as f:
+        lines = f.readlines()
+
+    # Drop comments. Perl comments start with # outside of strings; the
+    # calibrator names contain no #, so this is safe for these scripts.
+    code = "".join(line.split("#")[0] + "\n" if not line.lstrip().startswith("#") else "\n"
+                   for line in lines)
+
+    # The OTF elevation buffer is set inside observeTargetOTF in the scripts that use one.
+    el_buffer = re.search(r'\$elLimitBuffer\s*=\s*([-\d.]+)\s*;', code)
+    uses_buffer = re.search(r'\$MINEL_TARG\s*\+\s*\$elLimitBuffer', code) is not None
+
+    # Only the script header, before the perl subroutine definitions.
+    code = code.split("\nsub ")[0]
+
+    variables = {}
+    for match in re.finditer(r'\$(\w+)\s*=\s*["\']?([^"\';]*)["\']?\s*;', code):
+        variables.setdefault(match.group(1), match.group(2).strip())
+
+    targ_block = re.search(r'@mainTarg\s*=\s*\((.*?)\);', code, re.S)
+    if targ_block is None:
+        raise ValueError(f"No @mainTarg list found in {script_filename}. Only scripts using "
+                         "observeTargetLoopOTFInterleaveMulti are supported.")
+
+    names = []
+    ras = []
+    decs = []
+    for match in re.finditer(r'"(\S+)\s+-r\s+(\S+)\s+-d\s+(\S+)', targ_block.group(1)):
+        names.append(match.group(1))
+        ras.append(match.group(2))
+        decs.append(match.group(3))
+
+    out_dict = dict(variables)
+    if el_buffer is not None and uses_buffer:
+        out_dict['elLimitBuffer'] = el_buffer.group(1)
+    out_dict['targets'] = names
+    out_dict['target_coords'] = SkyCoord(ras, decs, unit=(u.hourangle, u.deg))
+
+    return out_dict
+
+
+def source_elevation(coords, times, location=sma_location):
+    '''
+    Elevation of sources at a set of times.
+
+    Uses the apparent sidereal time at ``location`` and the spherical
+    hour-angle relation. Precession and refraction are ignored (< 0.5 deg),
+    which is well below the elevation limit buffers.
+
+    Parameters
+    ----------
+    coords : `~astropy.coordinates.SkyCoord`
+        Source positions, shape (N_sources,).
+    times : `~astropy.time.Time`
+        Times, shape (N_times,).
+
+    Returns
+    -------
+    el : `~astropy.units.Quantity`
+        Elevation with shape (N_sources, N_times).
+    '''
+
+    lst = times.sidereal_time('apparent', longitude=location.lon).to_value(u.rad)
+
+    ra = np.atleast_1d(coords.ra.to_value(u.rad))[:, None]
+    dec = np.atleast_1d(coords.dec.to_value(u.rad))[:, None]
+    lat = location.lat.to_value(u.rad)
+
+    hour_angle = lst[None, :] - ra
+
+    sin_el = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(hour_angle)
+
+    return np.rad2deg(np.arcsin(sin_el)) * u.deg
+
+
+def gain_scan_time(n_int, int_length, do_tsys=True):
+    '''
+    Duration of observeGainTarget. Matches the perl simulation mode.
+    '''
+
+    tsys_time = 5.0 if do_tsys else 0.0
+    init_time = 5.0
+    wait_time = 4.0
+
+    return (init_time + tsys_time + wait_time + n_int * int_length) * u.s
+
+
+def otf_scan_time(row_length, n_rows, scan_speed,
+                  init_delay=3., row_delay=2., ramp_delay=3.):
+    '''
+    Duration of one otf call in observeTargetOTF. Matches the perl simulation mode.
+    '''
+
+    row_time = row_length / scan_speed
+
+    return (init_delay + n_rows * (row_time + row_delay + ramp_delay)) * u.s
+
+
+def otf_params_to_script_values(otf_params):
+    '''
+    Convert `otf_mapping_params` output to the perl OTF loop parameters.
+
+    Returns
+    -------
+    out_dict : dict
+        ``rowLength0`` and ``rowOffset0`` (arcsec), ``nRows0`` and
+        ``scanSpeedOTF0`` (arcsec/s), as floats.
+    '''
+
+    return dict(rowLength0=u.Quantity(otf_params['row_length']).to_value(u.arcsec),
+                rowOffset0=u.Quantity(otf_params['theta_row']).to_value(u.arcsec),
+                nRows0=float(u.Quantity(otf_params['Nrow']).value),
+                scanSpeedOTF0=u.Quantity(otf_params['R_target']).to_value(u.arcsec / u.s))
+
+
+def simulate_track(script_filename, start_time,
+                   otf_params=None,
+                   calibrators=calibrator_coords,
+                   n_iter_point=5,
+                   t_ipoint=3 * u.min,
+                   t_setup=0 * u.min,
+                   el_buffer_otf=None,
+                   time_resolution=1 * u.min,
+                   max_duration=16 * u.hr,
+                   location=sma_location):
+    '''
+    Simulate the OTF science loop of one observing script.
+
+    Elevations for all targets and calibrators are computed once on a
+    ``time_resolution`` grid and interpolated, so the timeline itself is a
+    short loop over the scheduled scans.
+
+    Parameters
+    ----------
+    script_filename : str or Path
+        Generated perl script.
+    start_time : `~astropy.time.Time`
+        Time the science loop starts.
+    otf_params : dict, optional
+        Output of `otf_mapping_params`. Overrides the OTF parameters in the script.
+    calibrators : dict
+        Calibrator name -> SkyCoord.
+    n_iter_point : int
+        Run ipoint on the primary gain calibrator every n-th target (perl default is 5).
+    t_ipoint : `~astropy.units.Quantity`
+        Assumed duration of an ipoint.
+    t_setup : `~astropy.units.Quantity`
+        Time before the science loop starts (e.g., initial flux/bandpass).
+    el_buffer_otf : float, optional
+        Extra elevation (deg) above MINEL_TARG required to start an OTF scan.
+        Defaults to the script's ``$elLimitBuffer``, or 0 if the script checks
+        only ``$MINEL_TARG`` (e.g. the M31 templates).
+    time_resolution : `~astropy.units.Quantity`
+        Spacing of the precomputed elevation grid.
+    max_duration : `~astropy.units.Quantity`
+        Length of the precomputed elevation grid.
+    location : `~astropy.coordinates.EarthLocation`
+        Observatory location.
+
+    Returns
+    -------
+    timeline : `~astropy.table.Table`
+        One row per scan: ``action``, ``source``, ``target_index``,
+        ``start``, ``duration``, ``elevation`` and ``observed``.
+    summary : dict
+        ``maps_completed``, ``maps_scheduled``, ``end_time`` and the number
+        of gain scans on each calibrator.
+    '''
+
+    script = parse_obs_script(script_filename)
+
+    params = {key: script.get(key) for key in ['rowLength0', 'rowOffset0', 'nRows0', 'scanSpeedOTF0']}
+    if otf_params is not None:
+        params.update(otf_params_to_script_values(otf_params))
+    params = {key: float(value) for key, value in params.items()}
+
+    cal0 = script['cal0']
+    cal1 = script['cal1']
+    ncal0 = float(script.get('ncal0', 6))
+    ncal1 = float(script.get('ncal1', 6))
+    inttime_gain = float(script.get('inttime_gain', 15))
+    minel_targ = float(script['MINEL_TARG'])
+    if el_buffer_otf is None:
+        el_buffer_otf = float(script.get('elLimitBuffer', 0.))
+    minel_gain = float(script['MINEL_GAIN'])
+    maxel_gain = float(script['MAXEL_GAIN'])
+    final_ptg = script.get('finalptgcal', cal0)
+
+    for name in [cal0, cal1, final_ptg]:
+        if name not in calibrators:
+            raise KeyError(f"No coordinates for calibrator {name}. Add it to calibrators.")
+
+    # Precompute the elevation of every source on a fine grid.
+    cal_names = list(dict.fromkeys([cal0, cal1, final_ptg]))
+    all_coords = SkyCoord([calibrators[name] for name in cal_names] + list(script['target_coords']))
+
+    grid_offsets = np.arange(0, max_duration.to_value(u.s) + 1, time_resolution.to_value(u.s))
+    grid_times = start_time + grid_offsets * u.s
+    el_grid = source_elevation(all_coords, grid_times, location=location).to_value(u.deg)
+
+    source_index = {name: ii for ii, name in enumerate(cal_names)}
+    target_offset = len(cal_names)
+
+    def elevation(isource, t_s):
+        return np.interp(t_s, grid_offsets, el_grid[isource])
+
+    half_rows = [np.floor(params['nRows0'] / 2), np.ceil(params['nRows0'] / 2)]
+    t_otf = [otf_scan_time(params['rowLength0'], nrows, params['scanSpeedOTF0']).to_value(u.s)
+             for nrows in half_rows]
+    t_gain0 = gain_scan_time(ncal0, inttime_gain).to_value(u.s)
+    t_gain1 = gain_scan_time(ncal1, inttime_gain).to_value(u.s)
+    t_ipoint_s = t_ipoint.to_value(u.s)
+
+    rows = []
+    now = t_setup.to_value(u.s)
+
+    def add_row(action, source, target_index, duration, el, observed):
+        rows.append((action, source, target_index, now, duration, el, observed))
+
+    def gain_scan(target_index):
+        # Primary gain cal, falling back to the secondary if it is too low.
+        nonlocal now
+        el0 = elevation(source_index[cal0], now)
+        if el0 >= minel_targ:
+            add_row('gain', cal0, target_index, t_gain0, el0, True)
+            now += t_gain0
+            return
+        add_row('gain', cal0, target_index, 0., el0, False)
+
+        el1 = elevation(source_index[cal1], now)
+        observed = el1 >= minel_targ
+        add_row('gain', cal1, target_index, t_gain1 if observed else 0., el1, observed)
+        if observed:
+            now += t_gain1
+
+    def ipoint(name, target_index):
+        nonlocal now
+        el = elevation(source_index[name], now)
+        observed = (el >= minel_gain) & (el <= maxel_gain)
+        add_row('ipoint', name, target_index, t_ipoint_s if observed else 0., el, observed)
+        if observed:
+            now += t_ipoint_s
+
+    maps_completed = 0
+
+    for target_index, target in enumerate(script['targets']):
+
+        halves_observed = 0
+
+        for half in range(2):
+            gain_scan(target_index)
+
+            el = elevation(target_offset + target_index, now)
+            observed = el >= minel_targ + el_buffer_otf
+            add_row('otf', target, target_index, t_otf[half] if observed else 0., el, observed)
+            if observed:
+                now += t_otf[half]
+                halves_observed += 1
+
+        if halves_observed == 2:
+            maps_completed += 1
+
+        if target_index % n_iter_point == 0:
+            ipoint(cal0, target_index)
+
+    # Final gain scans and pointing
+    for name, t_gain_this in [(cal0, t_gain0), (cal1, t_gain1)]:
+        el = elevation(source_index[name], now)
+        observed = el >= minel_targ
+        add_row('gain', name, -1, t_gain_this if observed else 0., el, observed)
+        if observed:
+            now += t_gain_this
+
+    ipoint(final_ptg, -1)
+
+    timeline = Table(rows=rows, names=['action', 'source', 'target_index', 'start',
+                                       'duration', 'elevation', 'observed'],
+                     dtype=[str, str, int, float, float, float, bool])
+    timeline['start'] = start_time + timeline['start'] * u.s
+    timeline['duration'].unit = u.s
+    timeline['elevation'].unit = u.deg
+
+    if now > max_duration.to_value(u.s):
+        raise ValueError("Track is longer than max_duration. Increase max_duration.")
+
+    gain_mask = (timeline['action'] == 'gain') & timeline['observed']
+
+    summary = dict(maps_completed=maps_completed,
+                   maps_scheduled=len(script['targets']),
+                   end_time=start_time + now * u.s,
+                   duration=(now * u.s).to(u.hr),
+                   n_gain_primary=int(np.sum(gain_mask & (timeline['source'] == cal0))),
+                   n_gain_secondary=int(np.sum(gain_mask & (timeline['source'] == cal1))))
+
+    return timeline, summary
+
+
+def simulate_tracks(script_filenames, start_times, **kwargs):
+    '''
+    Simulate many observing scripts and summarize them in one table.
+
+    Parameters
+    ----------
+    script_filenames : list
+        Perl scripts.
+    start_times : `~astropy.time.Time`
+        Start time of each track's science loop. Scalar or one per script.
+    kwargs : dict
+        Passed to `simulate_track`.
+
+    Returns
+    -------
+    summary : `~astropy.table.Table`
+        One row per script.
+    timelines : dict
+        Script name -> timeline table.
+    '''
+
+    start_times = Time(start_times)
+    if start_times.isscalar:
+        start_times = Time([start_times] * len(script_filenames))
+
+    summaries = []
+    timelines = {}
+    for script_filename, start_time in zip(script_filenames, start_times):
+        timeline, summary = simulate_track(script_filename, start_time, **kwargs)
+
+        name = Path(script_filename).name
+        timelines[name] = timeline
+
+        summary['script'] = name
+        summaries.append(summary)
+
+    summary_table = Table(rows=[[this['script'], this['maps_completed'], this['maps_scheduled'],
+                                 this['duration'].value, this['end_time'].isot,
+                                 this['n_gain_primary'], this['n_gain_secondary']]
+                                for this in summaries],
+                          names=['script', 'maps_completed', 'maps_scheduled', 'duration',
+                                 'end_time', 'n_gain_primary', 'n_gain_secondary'])
+    summary_table['duration'].unit = u.hr
+
+    return summary_table, timelines
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulate the OTF loop of generated observing scripts.")
+    parser.add_argument("scripts", nargs="+")
+    parser.add_argument("--start", required=True,
+                        help="UTC start time of the science loop, e.g. 2025-10-15T05:00:00")
+
+    args = parser.parse_args()
+
+    summary_table, _ = simulate_tracks(args.scripts, Time(args.start))
+    summary_table.pprint(max_lines=-1, max_width=-1)
@@ -1,12 +1,15 @@
 
 import numpy as np
+from functools import lru_cache
 
 import astropy.units as u
 import astropy.constants as con
-from astropy.modeling.models import BlackBody
+from astropy.table import Table
 
 from radio_beam import Beam
 
+from otf_instrumentation import timed
+
 
 def sma_pb_fwhm(freq):
 
@@ -100,14 +103,143 @@ def make_the_time_line(rms, band,
 def time_to_rms(time, band,
                 unit_time=1 * u.hr,
                 rms_band_dict=wsma_1kms_rms):
-    
+    '''
+    Expected rms after ``time``: the per-band rms in ``unit_time`` scaled by
+    1 / sqrt(time / unit_time). The inverse of `make_the_time_line`.
+    '''
+
     rms_per_unit = rms_band_dict[band]
-    
-    rms_per_time = rms_per_unit * np.sqrt((time / unit_time).to(u.one))
+
+    rms_per_time = rms_per_unit / np.sqrt((time / unit_time).to(u.one))
     
     return rms_per_time
 
 
+# Array versions of the time/rms conversions. The per-band rms are converted
+# to plain floats once and cached, so large tables of bands and rms values can
+# be built without Quantity arithmetic on every element.
+
+_rms_band_dicts = {'line': wsma_1kms_rms,
+                   'continuum': wsma_continuum_rms}
+
+
+def _rms_band_table(rms_band_dict):
+    '''
+    Convert a band -> rms dictionary to string keys and float values in one unit.
+    '''
+
+    unit = next(iter(rms_band_dict.values())).unit
+
+    return ({str(band): rms.to_value(unit) for band, rms in rms_band_dict.items()},
+            unit)
+
+
+@lru_cache(maxsize=None)
+def _cached_rms_band_table(kind):
+    return _rms_band_table(_rms_band_dicts[kind])
+
+
+def _band_rms_values(bands, kind='line', rms_band_dict=None):
+    '''
+    Look up the per-unit-time rms for an array of bands.
+
+    Returns a float array with the shape of ``bands`` and the rms unit.
+    '''
+
+    if rms_band_dict is None:
+        if kind not in _rms_band_dicts:
+            raise ValueError(f"kind must be one of {list(_rms_band_dicts)}.")
+        table, unit = _cached_rms_band_table(kind)
+    else:
+        table, unit = _rms_band_table(rms_band_dict)
+
+    bands = np.asarray(bands).astype(str)
+
+    unique_bands, inverse = np.unique(bands, return_inverse=True)
+
+    missing = [band for band in unique_bands if band not in table]
+    if len(missing) > 0:
+        raise KeyError(f"No rms for bands {missing}. Available: {list(table)}")
+
+    values = np.array([table[band] for band in unique_bands])[inverse]
+
+    return values.reshape(bands.shape), unit
+
+
+def make_the_time_array(rms, bands,
+                        kind='line',
+                        unit_time=1 * u.hr,
+                        rms_band_dict=None,
+                        return_quantity=True):
+    '''
+    Array version of `make_the_time_line` and `make_the_time_continuum`.
+
+    Parameters
+    ----------
+    rms : `~astropy.units.Quantity`
+        Target rms values. Broadcast against ``bands``.
+    bands : array
+        Band keys, e.g. ``[230, 345, "230_curr"]``.
+    kind : {'line', 'continuum'}
+        Which sensitivity table to use when ``rms_band_dict`` is not given.
+    unit_time : `~astropy.units.Quantity`
+        Time the per-band rms refers to.
+    rms_band_dict : dict, optional
+        Custom band -> rms dictionary (e.g., from `make_wsma_intint_rms`).
+    return_quantity : bool
+        Return a Quantity in hours. Otherwise a plain float array in hours.
+
+    Returns
+    -------
+    time : `~astropy.units.Quantity` or `~numpy.ndarray`
+        Required time.
+    '''
+
+    rms_per_unit, unit = _band_rms_values(bands, kind=kind, rms_band_dict=rms_band_dict)
+
+    rms = rms.to_value(unit)
+
+    time = unit_time.to_value(u.hr) * (rms_per_unit / rms)**2
+
+    return time * u.hr if return_quantity else time
+
+
+def time_to_rms_array(time, bands,
+                      kind='line',
+                      unit_time=1 * u.hr,
+                      rms_band_dict=None,
+                      return_quantity=True):
+    '''
+    Array version of `time_to_rms`.
+
+    Parameters
+    ----------
+    time : `~astropy.units.Quantity`
+        Integration times. Broadcast against ``bands``.
+    bands : array
+        Band keys, e.g. ``[230, 345, "230_curr"]``.
+    kind : {'line', 'continuum'}
+        Which sensitivity table to use when ``rms_band_dict`` is not given.
+    unit_time : `~astropy.units.Quantity`
+        Time the per-band rms refers to.
+    rms_band_dict : dict, optional
+        Custom band -> rms dictionary.
+    return_quantity : bool
+        Return a Quantity in the unit of the rms table. Otherwise a plain float array.
+
+    Returns
+    -------
+    rms : `~astropy.units.Quantity` or `~numpy.ndarray`
+        Expected rms.
+    '''
+
+    rms_per_unit, unit = _band_rms_values(bands, kind=kind, rms_band_dict=rms_band_dict)
+
+    rms = rms_per_unit / np.sqrt(time.to_value(u.hr) / unit_time.to_value(u.hr))
+
+    return rms * unit if return_quantity else rms
+
+
 
 # Dust opacity relations
 
@@ -158,10 +290,120 @@ R31_range_l22 = [0.2, 0.42]
 R32_l22 = 0.50
 R32_range_l22 = [0.23, 0.59]
 
+# Ranges for the Monte Carlo sampling in `mass_sensitivity_mc`
+
+# 0.3 dex about the Galactic value (Bolatto+13). Sampled log-uniformly.
+alpha_CO_range_b13 = [4.35 * 10**-0.3, 4.35 * 10**0.3] * (u.solMass / u.pc**2) / (u.K * u.km / u.s)
+
+# M31 distance, 785 +/- 25 kpc (McConnachie+05)
+distance_range_m31 = [0.76, 0.81] * u.Mpc
+
+Tdust_range_m31 = [15, 25] * u.K
+
 
 
 FWHM_TO_AREA = 2*np.pi/(8*np.log(2))
 
+# Rayleigh-Jeans Jy -> K constant, c^2 / (2 k_B), in K GHz^2 sr / Jy
+_JTOK_CONST = (con.c**2 / (2 * con.k_B)).to_value(u.K * u.GHz**2 / u.Jy)
+
+
+def gaussian_beam_sr(beam_size):
+    '''
+    Solid angle of a circular Gaussian beam. Matches `radio_beam.Beam.sr`.
+    '''
+
+    return (FWHM_TO_AREA * beam_size**2).to(u.sr)
+
+
+def gaussian_beam_jtok(beam_size, freq):
+    '''
+    Closed-form, vectorized Jy/beam to K factor for a circular Gaussian beam.
+
+    Same Rayleigh-Jeans conversion as `radio_beam.Beam.jtok`, but without
+    building a `~radio_beam.Beam`. ``beam_size`` and ``freq`` broadcast.
+
+    Returns
+    -------
+    jtok : `~astropy.units.Quantity`
+        Conversion factor in K / Jy.
+    '''
+
+    beam_sr = FWHM_TO_AREA * beam_size.to_value(u.rad)**2
+
+    return _JTOK_CONST / (freq.to_value(u.GHz)**2 * beam_sr) * u.K / u.Jy
+
+
+@lru_cache(maxsize=4096)
+def _cached_beam_jtok(beam_size_arcsec, freq_ghz):
+    return Beam(beam_size_arcsec * u.arcsec).jtok(freq_ghz * u.GHz).to_value(u.K)
+
+
+def beam_jtok(beam_size, freq):
+    '''
+    Jy/beam to K factor, cached for scalar (beam_size, freq) pairs.
+
+    Scalars are looked up in an LRU cache of `radio_beam.Beam.jtok` values.
+    Arrays use `gaussian_beam_jtok`.
+
+    Returns
+    -------
+    jtok : `~astropy.units.Quantity`
+        Conversion factor in K / Jy.
+    '''
+
+    if beam_size.isscalar and freq.isscalar:
+        return _cached_beam_jtok(float(beam_size.to_value(u.arcsec)),
+                                 float(freq.to_value(u.GHz))) * u.K / u.Jy
+
+    return gaussian_beam_jtok(beam_size, freq)
+
+# Planck function for the dust conversions. B_nu = A nu^3 / (exp(X nu / T) - 1)
+# with nu in GHz, T in K and B_nu in Jy / sr.
+_PLANCK_A = (2 * con.h * u.GHz**3 / con.c**2).to_value(u.Jy)
+_PLANCK_X = (con.h * u.GHz / (con.k_B * u.K)).to_value(u.one)
+
+
+def planck_bnu(nu_ghz, temp_k):
+    '''
+    Planck function in Jy / sr on plain float arrays.
+
+    Matches `~astropy.modeling.models.BlackBody` to floating point precision
+    (relative error < 1e-14). ``nu_ghz`` and ``temp_k`` broadcast.
+    '''
+
+    nu_ghz = np.asarray(nu_ghz, dtype=float)
+
+    return _PLANCK_A * nu_ghz**3 / np.expm1(_PLANCK_X * nu_ghz / np.asarray(temp_k, dtype=float))
+
+
+@lru_cache(maxsize=4096)
+def _cached_planck_bnu(nu_ghz, temp_k):
+    return float(planck_bnu(nu_ghz, temp_k))
+
+
+def dust_bnu(nu, temperature):
+    '''
+    B_nu(T) for the dust conversions, cached for scalar (nu, T) pairs.
+
+    Scalars are looked up in an LRU cache, so sweeps that call the dust
+    conversions in a loop over a few bands and temperatures evaluate each
+    pair once. Arrays use `planck_bnu`. Both are exact; there is no
+    interpolation and no range limit.
+
+    Returns
+    -------
+    bnu : `~astropy.units.Quantity`
+        Specific intensity in Jy / sr.
+    '''
+
+    if np.isscalar(nu.value) and np.isscalar(temperature.value):
+        return _cached_planck_bnu(float(nu.to_value(u.GHz)),
+                                  float(temperature.to_value(u.K))) * u.Jy / u.sr
+
+    return planck_bnu(nu.to_value(u.GHz), temperature.to_value(u.K)) * u.Jy / u.sr
+
+
 def alpha_to_X(alpha_CO, mu=2.7):
     return (alpha_CO / (mu * con.m_p)).to((u.cm**-2) / (u.K * u.km / u.s))
 
@@ -175,8 +417,9 @@ def h2mass_to_co_brightness(mh2,
                             beam_size=5*u.arcsec,
                             to_jy=True,
                             ):
-
-    beam = Beam(beam_size.to(u.arcsec))
+    '''
+    All inputs may be arrays that broadcast against each other.
+    '''
 
     # phys_scale = (beam_size.to(u.rad).value * distance).to(u.pc)
 
@@ -191,7 +434,7 @@ def h2mass_to_co_brightness(mh2,
     I_10 = mh2.to(u.solMass).value / (1.05e4 * X_CO_norm * distance.to(u.Mpc).value**2)
     I_10 = I_10 * u.Jy * u.km / u.s
 
-    I_10 = I_10  * (beam.jtok(115.271 * u.GHz) / u.Jy)
+    I_10 = I_10  * beam_jtok(beam_size, 115.271 * u.GHz)
 
     I_21 = R21 * I_10
 
@@ -204,9 +447,9 @@ def h2mass_to_co_brightness(mh2,
         # I_21 = I_21  * (beam.jtok(230.538 * u.GHz) / u.Jy)
         # I_32 = I_32  * (beam.jtok(345.796 * u.GHz) / u.Jy)
 
-        I_10 = I_10  / (beam.jtok(115.271 * u.GHz) / u.Jy)
-        I_21 = I_21  / (beam.jtok(230.538 * u.GHz) / u.Jy)
-        I_32 = I_32  / (beam.jtok(345.796 * u.GHz) / u.Jy)
+        I_10 = I_10  / beam_jtok(beam_size, 115.271 * u.GHz)
+        I_21 = I_21  / beam_jtok(beam_size, 230.538 * u.GHz)
+        I_32 = I_32  / beam_jtok(beam_size, 345.796 * u.GHz)
 
     return {"CO10": I_10, "CO21": I_21, "CO32": I_32}
 
@@ -233,22 +476,22 @@ def h2mass_to_dust_brightness(mh2, nu=230*u.GHz, gdr=100, Tdust=20 * u.K,
 
     #   kappa_nu=0.0425 * u.m**2 / u.kg,  # Forbrich+20
 
-    beam = Beam(beam_size.to(u.arcsec))
+    beam_sr = gaussian_beam_sr(beam_size)
 
     phys_scale = (beam_size.to(u.rad).value * distance).to(u.pc)
 
     m_dust = mh2 / gdr
 
     if verbose:
-        print(m_dust, kappa_nu(nu), Tdust, BlackBody(temperature=Tdust)(nu), phys_scale)
+        print(m_dust, kappa_nu(nu), Tdust, dust_bnu(nu, Tdust), phys_scale)
 
-    S_nu = (m_dust * kappa_nu(nu) * BlackBody(temperature=Tdust)(nu)) / (FWHM_TO_AREA * phys_scale**2)
+    S_nu = (m_dust * kappa_nu(nu) * dust_bnu(nu, Tdust)) / (FWHM_TO_AREA * phys_scale**2)
     S_nu = S_nu.to(u.MJy / u.sr)
 
     if add_beam_unit:
-        S_nu = (S_nu * beam.sr / u.beam).to(u.Jy / u.beam)
+        S_nu = (S_nu * beam_sr / u.beam).to(u.Jy / u.beam)
     else:
-        S_nu = (S_nu * beam.sr).to(u.Jy)
+        S_nu = (S_nu * beam_sr).to(u.Jy)
 
     return S_nu
 
@@ -270,13 +513,393 @@ def dust_to_h2mass(S_nu, nu=230*u.GHz, gdr=100, Tdust=20 * u.K,
 
     #   kappa_nu=0.0425 * u.m**2 / u.kg,  # Forbrich+20
 
-    beam = Beam(beam_size.to(u.arcsec))
+    beam_sr = gaussian_beam_sr(beam_size)
 
     phys_scale = (beam_size.to(u.rad).value * distance).to(u.pc)
 
-    m_dust = S_nu * phys_scale**2 / (kappa_nu(nu) *  BlackBody(temperature=Tdust)(nu)) / (beam.sr)
+    m_dust = S_nu * phys_scale**2 / (kappa_nu(nu) *  dust_bnu(nu, Tdust)) / (beam_sr)
     
     m_gas = m_dust * gdr
 
     return m_gas
 
+
+
+# Mass-sensitivity grids
+
+kappa_laws = {'chiang18': kappa_nu_chiang18,
+              'MW': kappa_nu_MW}
+
+# CO line observed in each band for the line sensitivity
+band_co_lines = {230: "CO21", 345: "CO32", "230_curr": "CO21"}
+
+
+def blackbody_nu(nu, temperature):
+    '''
+    Vectorized Planck function B_nu(T). Same units as `~astropy.modeling.models.BlackBody`.
+
+    ``nu`` and ``temperature`` broadcast against each other.
+    '''
+
+    bnu = planck_bnu(nu.to_value(u.GHz), temperature.to_value(u.K))
+
+    return (bnu * u.Jy / u.sr).to(u.erg / (u.cm**2 * u.s * u.Hz * u.sr))
+
+
+@timed('sensitivity.mass_grid')
+def mass_sensitivity_grid(mh2,
+                          distance=0.78 * u.Mpc,
+                          beam_size=5*u.arcsec,
+                          alpha_CO=4.35*(u.solMass / u.pc**2) / (u.K * u.km / u.s),
+                          R21=R21_l22,
+                          R32=R32_l22,
+                          Tdust=20 * u.K,
+                          kappa_law='chiang18',
+                          gdr=100,
+                          band=230,
+                          int_time=None,
+                          sigma=4.5*u.km/u.s,
+                          snr=5.):
+    '''
+    Evaluate CO and dust detection limits on an N-dimensional grid in one pass.
+
+    Every argument given as a 1D array (or list) becomes an axis of the grid,
+    in the order of the signature; scalars are held fixed. The CO line in
+    each band is set by ``band_co_lines`` and the dust continuum is evaluated
+    at the band frequency.
+
+    Parameters
+    ----------
+    mh2 : `~astropy.units.Quantity`
+        H2 mass.
+    distance, beam_size, alpha_CO, R21, R32, Tdust, gdr
+        See `h2mass_to_co_brightness` and `h2mass_to_dust_brightness`.
+    kappa_law : str or list of str
+        Keys of ``kappa_laws``.
+    band : int, str or list
+        Band keys (e.g., 230, 345, "230_curr").
+    int_time : `~astropy.units.Quantity`, optional
+        Integration times. If given, the achieved S/N is also returned.
+    sigma : `~astropy.units.Quantity`
+        Line velocity dispersion for the peak brightness.
+    snr : float
+        Required signal-to-noise for a detection.
+
+    Returns
+    -------
+    grid : dict
+        ``dims`` (axis names), ``coords`` (axis values), and the arrays
+        ``co_intint``, ``co_tpeak`` (Jy), ``dust_flux`` (Jy), ``time_line``
+        and ``time_continuum`` (hr; NaN where the band has no sensitivity),
+        plus ``snr_line`` and ``snr_continuum`` if ``int_time`` is given.
+        Use `select_grid` to slice it.
+    '''
+
+    inputs = dict(mh2=mh2, distance=distance, beam_size=beam_size,
+                  alpha_CO=alpha_CO, R21=R21, R32=R32, Tdust=Tdust,
+                  kappa_law=kappa_law, gdr=gdr, band=band)
+    if int_time is not None:
+        inputs['int_time'] = int_time
+
+    dims = [name for name, value in inputs.items()
+            if np.ndim(value) == 1 and not isinstance(value, str)]
+    ndim = len(dims)
+
+    coords = {}
+    values = {}
+    for name, value in inputs.items():
+        if name in dims:
+            coords[name] = value
+            shape = [1] * ndim
+            shape[dims.index(name)] = len(value)
+            if name in ['kappa_law', 'band']:
+                values[name] = np.array(value, dtype=object).reshape(shape)
+            else:
+                values[name] = np.reshape(value, shape)
+        else:
+            values[name] = np.array(value, dtype=object).reshape((1,) * ndim) \
+                if name in ['kappa_law', 'band'] else value
+
+    # Band-dependent terms, broadcast along the band axis only
+    band_values = values['band']
+    freq = np.vectorize(lambda b: float(str(b).split('_')[0]), otypes=[float])(band_values) * u.GHz
+    line_rms = np.vectorize(lambda b: wsma_1kms_rms[b].to_value(u.Jy * u.km / u.s)
+                            if b in wsma_1kms_rms else np.nan, otypes=[float])(band_values)
+    cont_rms = np.vectorize(lambda b: wsma_continuum_rms[b].to_value(u.Jy)
+                            if b in wsma_continuum_rms else np.nan, otypes=[float])(band_values)
+    line_name = np.vectorize(lambda b: band_co_lines.get(b, ""), otypes=[object])(band_values)
+
+    kappa = np.vectorize(lambda law, nu: kappa_laws[law](nu * u.GHz).to_value(u.cm**2 / u.g),
+                         otypes=[float])(values['kappa_law'], freq.to_value(u.GHz)) * u.cm**2 / u.g
+
+    # CO lines
+    co = h2mass_to_co_brightness(values['mh2'],
+                                 alpha_CO=values['alpha_CO'],
+                                 R21=values['R21'],
+                                 R32=values['R32'],
+                                 distance=values['distance'],
+                                 beam_size=values['beam_size'],
+                                 to_jy=True)
+
+    nan_line = np.full(np.shape(co['CO21']), np.nan) * co['CO21'].unit
+    co_intint = np.where(line_name == "CO21", co['CO21'],
+                         np.where(line_name == "CO32", co['CO32'], nan_line))
+
+    co_tpeak = get_Tpeak_gaussian(co_intint, sigma=sigma).to(u.Jy)
+
+    # Unresolved dust continuum: S = M_dust kappa B_nu / D^2
+    dust_flux = (values['mh2'] / values['gdr'] * kappa *
+                 blackbody_nu(freq, values['Tdust']) / values['distance']**2)
+    dust_flux = (dust_flux * u.sr).to(u.Jy)
+
+    # Required time for a snr detection. The line rms is per 1 km/s channel.
+    line_rms_req = co_tpeak.to_value(u.Jy) / snr
+    cont_rms_req = dust_flux.to_value(u.Jy) / snr
+
+    time_line = (line_rms / line_rms_req)**2 * u.hr
+    time_continuum = (cont_rms / cont_rms_req)**2 * u.hr
+
+    out = dict(co_intint=co_intint, co_tpeak=co_tpeak, dust_flux=dust_flux,
+               time_line=time_line, time_continuum=time_continuum)
+
+    if int_time is not None:
+        hours = values['int_time'].to_value(u.hr)
+        out['snr_line'] = co_tpeak.to_value(u.Jy) / (line_rms / np.sqrt(hours))
+        out['snr_continuum'] = dust_flux.to_value(u.Jy) / (cont_rms / np.sqrt(hours))
+
+    full_shape = tuple(len(coords[name]) for name in dims)
+    for key in out:
+        if hasattr(out[key], 'unit'):
+            out[key] = u.Quantity(np.broadcast_to(out[key].value, full_shape),
+                                  out[key].unit, copy=False)
+        else:
+            out[key] = np.broadcast_to(out[key], full_shape)
+
+    out['dims'] = dims
+    out['coords'] = coords
+
+    return out
+
+
+def select_grid(grid, **selection):
+    '''
+    Slice a `mass_sensitivity_grid` output by axis values.
+
+    Numeric axes select the nearest value; band and kappa_law axes match exactly.
+    The selected axes are dropped from the output.
+
+    Example: ``select_grid(grid, distance=0.78*u.Mpc, band=230)``.
+    '''
+
+    index = [slice(None)] * len(grid['dims'])
+
+    for name, value in selection.items():
+        if name not in grid['dims']:
+            raise KeyError(f"{name} is not an axis of the grid. Axes are {grid['dims']}.")
+
+        axis_values = grid['coords'][name]
+        if name in ['kappa_law', 'band']:
+            matches = [ii for ii, this_value in enumerate(axis_values) if this_value == value]
+            if len(matches) == 0:
+                raise KeyError(f"{value} is not on the {name} axis.")
+            idx = matches[0]
+        else:
+            axis_values = u.Quantity(axis_values)
+            idx = int(np.argmin(np.abs(axis_values - value)))
+
+        index[grid['dims'].index(name)] = idx
+
+    index = tuple(index)
+
+    out = {key: value[index] for key, value in grid.items() if key not in ['dims', 'coords']}
+    out['dims'] = [name for name in grid['dims'] if name not in selection]
+    out['coords'] = {name: grid['coords'][name] for name in out['dims']}
+
+    return out
+
+
+def _sample_parameter(value, n_samples, rng, log=False):
+    '''
+    Draw ``n_samples`` values of a parameter for `mass_sensitivity_mc`.
+
+    A scalar is held fixed, a 2-element [low, high] range is sampled
+    uniformly (log-uniformly with ``log``, for ranges given in dex) and an
+    array of ``n_samples`` values is used as given.
+    '''
+
+    unit = getattr(value, 'unit', None)
+    values = np.asarray(value.value if unit is not None else value, dtype=float)
+
+    if values.ndim == 0:
+        samples = np.full(n_samples, float(values))
+    elif values.size == n_samples:
+        samples = values
+    elif values.size == 2 and log:
+        samples = 10**rng.uniform(np.log10(values[0]), np.log10(values[1]), n_samples)
+    elif values.size == 2:
+        samples = rng.uniform(values[0], values[1], n_samples)
+    else:
+        raise ValueError(f"Expected a scalar, a [low, high] range or {n_samples} samples. "
+                         f"Got {values.size} values.")
+
+    return samples * unit if unit is not None else samples
+
+
+@timed('sensitivity.mass_mc')
+def mass_sensitivity_mc(mh2,
+                        n_samples=10**5,
+                        distance=distance_range_m31,
+                        beam_size=5*u.arcsec,
+                        alpha_CO=alpha_CO_range_b13,
+                        R21=R21_range_l22,
+                        R32=R32_range_l22,
+                        Tdust=Tdust_range_m31,
+                        kappa_law=('chiang18', 'MW'),
+                        gdr=100,
+                        band=(230, 345),
+                        int_time=None,
+                        sigma=4.5*u.km/u.s,
+                        snr=5.,
+                        percentiles=(2.5, 16, 50, 84, 97.5),
+                        return_samples=False,
+                        seed=None):
+    '''
+    Monte Carlo distributions of the CO and dust brightness and required time.
+
+    All realizations are drawn and evaluated in one vectorized batch with
+    the same relations as `mass_sensitivity_grid`, so 10^6 samples take
+    well under a second.
+
+    Parameters
+    ----------
+    mh2 : `~astropy.units.Quantity`
+        H2 mass.
+    n_samples : int
+        Number of realizations.
+    distance, beam_size, alpha_CO, R21, R32, Tdust, gdr
+        A scalar is held fixed, a [low, high] range (e.g. ``R21_range_l22``)
+        is sampled uniformly, and an array of ``n_samples`` values is used
+        as given (e.g. draws from another distribution). An ``alpha_CO``
+        range is sampled uniformly in log, as for the 0.3 dex
+        ``alpha_CO_range_b13``.
+    kappa_law : str or list of str
+        Keys of ``kappa_laws``, drawn with equal probability.
+    band : int, str or list
+        Band keys (e.g., 230, 345, "230_curr"). The same realizations are
+        used for every band.
+    int_time : `~astropy.units.Quantity`, optional
+        Integration time. If given, the probability of reaching ``snr`` in
+        that time is also returned.
+    sigma : `~astropy.units.Quantity`
+        Line velocity dispersion for the peak brightness.
+    snr : float
+        Required signal-to-noise for a detection.
+    percentiles : list of float
+        Percentiles in the summary table.
+    return_samples : bool
+        Also return the drawn parameters and the per-realization results.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    out_dict : dict
+        ``summary``, a `~astropy.table.Table` with the mean and percentiles of
+        ``co_intint``, ``co_tpeak`` and ``dust_flux`` (Jy) and ``time_line``
+        and ``time_continuum`` (hr) for each band. If ``int_time`` is given,
+        ``detect_fraction`` holds the fraction of realizations detected in
+        the line and continuum for each band. With ``return_samples``,
+        ``samples`` holds the drawn parameters and ``results`` the
+        per-realization values with shape (N_bands, n_samples).
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    bands = [band] if np.ndim(band) == 0 or isinstance(band, str) else list(band)
+    laws = [kappa_law] if isinstance(kappa_law, str) else list(kappa_law)
+
+    samples = {name: _sample_parameter(value, n_samples, rng, log=name == 'alpha_CO')
+               for name, value in [('distance', distance), ('beam_size', beam_size),
+                                   ('alpha_CO', alpha_CO), ('R21', R21), ('R32', R32),
+                                   ('Tdust', Tdust), ('gdr', gdr)]}
+    law_index = rng.integers(len(laws), size=n_samples)
+    samples['kappa_law'] = np.array(laws)[law_index]
+
+    if np.all(samples['beam_size'] == samples['beam_size'][0]):
+        # Keep the beam scalar so the Jy -> K factor comes from the cache
+        samples['beam_size'] = samples['beam_size'][0]
+
+    co = h2mass_to_co_brightness(mh2,
+                                 alpha_CO=samples['alpha_CO'],
+                                 R21=samples['R21'],
+                                 R32=samples['R32'],
+                                 distance=samples['distance'],
+                                 beam_size=samples['beam_size'],
+                                 to_jy=True)
+
+    # Dust terms common to all bands: M_dust / D^2 in g / cm^2
+    dust_column = (mh2 / samples['distance']**2).to_value(u.g / u.cm**2) / samples['gdr']
+    tdust = samples['Tdust']
+
+    results = {name: np.full((len(bands), n_samples), np.nan)
+               for name in ['co_intint', 'co_tpeak', 'dust_flux', 'time_line', 'time_continuum']}
+
+    for ii, this_band in enumerate(bands):
+        freq = float(str(this_band).split('_')[0]) * u.GHz
+
+        line_name = band_co_lines.get(this_band, "")
+        if line_name in co:
+            co_intint = co[line_name].to_value(u.Jy * u.km / u.s)
+            co_tpeak = get_Tpeak_gaussian(co[line_name], sigma=sigma).to_value(u.Jy)
+            results['co_intint'][ii] = co_intint
+            results['co_tpeak'][ii] = co_tpeak
+
+            if this_band in wsma_1kms_rms:
+                # The line rms is per 1 km/s channel
+                line_rms = wsma_1kms_rms[this_band].to_value(u.Jy * u.km / u.s)
+                results['time_line'][ii] = (line_rms * snr / co_tpeak)**2
+
+        kappa = np.array([kappa_laws[law](freq).to_value(u.cm**2 / u.g) for law in laws])[law_index]
+
+        # Unresolved dust continuum: S = M_dust kappa B_nu / D^2
+        bnu = planck_bnu(freq.to_value(u.GHz), tdust.to_value(u.K))
+        dust_flux = dust_column * kappa * bnu
+        results['dust_flux'][ii] = dust_flux
+
+        if this_band in wsma_continuum_rms:
+            cont_rms = wsma_continuum_rms[this_band].to_value(u.Jy)
+            results['time_continuum'][ii] = (cont_rms * snr / dust_flux)**2
+
+    units = dict(co_intint=u.Jy * u.km / u.s, co_tpeak=u.Jy, dust_flux=u.Jy,
+                 time_line=u.hr, time_continuum=u.hr)
+
+    rows = []
+    for name, values in results.items():
+        with np.errstate(invalid='ignore'):
+            mean = values.mean(axis=1)
+            pct = np.percentile(values, percentiles, axis=1)
+        for ii, this_band in enumerate(bands):
+            rows.append([str(this_band), name, units[name].to_string(), mean[ii]] + list(pct[:, ii]))
+
+    summary = Table(rows=rows,
+                    names=['band', 'quantity', 'unit', 'mean'] + [f'p{pp:g}' for pp in percentiles],
+                    dtype=[str, str, str] + [float] * (1 + len(percentiles)))
+    for name in summary.colnames[3:]:
+        summary[name].format = '.4g'
+    summary.meta['n_samples'] = n_samples
+    summary.meta['snr'] = snr
+
+    out = dict(summary=summary)
+
+    if int_time is not None:
+        # t_req <= int_time is the same as reaching snr in int_time
+        hours = int_time.to_value(u.hr)
+        out['detect_fraction'] = {this_band: dict(line=float(np.mean(results['time_line'][ii] <= hours)),
+                                                  continuum=float(np.mean(results['time_continuum'][ii] <= hours)))
+                                  for ii, this_band in enumerate(bands)}
+
+    if return_samples:
+        out['samples'] = samples
+        out['results'] = {name: values * units[name] for name, values in results.items()}
+
+    return out
@@ -0,0 +1,42 @@
+
+import numpy as np
+from pathlib import Path
+
+from otf_coverage_gaps import find_coverage_gaps
+from otf_mosaic_regions import read_crtf_rotboxes
+from otf_sampling_simulator import simulate_script_sampling
+
+
+repo_path = Path(__file__).resolve().parent.parent
+
+
+def _brick_a():
+    coords, _ = simulate_script_sampling(repo_path / "m31_observing_scripts/sub_Brick_A_track_1.pl")
+    maps = read_crtf_rotboxes(repo_path / "m31_sma_otf_mosaics.crtf")
+    maps = maps[np.array(["Brick-A" in str(label) for label in maps['label']])]
+
+    return coords, maps
+
+
+def test_complete_map_has_no_gaps():
+    # The shallower edges of a complete map are not gaps
+    coords, maps = _brick_a()
+
+    gaps, report = find_coverage_gaps(coords, maps)
+
+    assert len(gaps) == 0
+    assert np.all(report['frac_below_target'] == 0)
+
+
+def test_missing_dumps_are_gaps():
+    coords, maps = _brick_a()
+
+    # Drop a block of dumps from the middle of the first map
+    first = np.flatnonzero(coords['field_id'] == coords['field_id'][0])
+    drop = first[first.size // 3:first.size // 2]
+    keep = np.setdiff1d(np.arange(len(coords)), drop)
+
+    gaps, report = find_coverage_gaps(coords[keep], maps)
+
+    assert len(gaps) >= 1
+    assert np.sum(report['frac_below_target'] > 0) >= 1
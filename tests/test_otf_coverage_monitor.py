@@ -0,0 +1,76 @@
+
+import numpy as np
+import astropy.units as u
+import pytest
+
+from otf_coverage_monitor import check_otf_call, _finish_call, _segment_calls
+from otf_sampling_simulator import interleaved_dump_offsets
+
+
+records_dtype = [('rinteg', float), ('mjd', float), ('offx', float), ('offy', float)]
+
+
+@pytest.mark.parametrize("n_rows", [7, 13, 22])
+def test_check_otf_call_halves(n_rows):
+    # For odd n_rows both halves fall on the same grid, so the half must
+    # come from the call order rather than the fit.
+    params = dict(row_length=840 * u.arcsec, row_offset=27.5 * u.arcsec, n_rows=n_rows,
+                  scan_speed=11.45 * u.arcsec / u.s, pos_angle=144 * u.deg, t_dump=0.6 * u.s)
+
+    offx, offy, time, row = interleaved_dump_offsets(**params)
+    mjd = 60000. + time / 86400.
+
+    for start_row, this_half in [(0., row % 2 == 0), (0.5, row % 2 == 1)]:
+        result = check_otf_call(offx[this_half], offy[this_half], mjd[this_half],
+                                start_row=start_row, **params)
+
+        n_half = n_rows // 2 if start_row == 0 else n_rows - n_rows // 2
+        assert result['n_rows'] == n_half
+        assert result['n_rows_observed'] == n_half
+        assert result['missing_rows'].size == 0
+        assert result['ok']
+
+    # Missing the last row of the odd half is caught
+    last = this_half & (row == row[this_half].max())
+    result = check_otf_call(offx[this_half & ~last], offy[this_half & ~last],
+                            mjd[this_half & ~last], start_row=0.5, **params)
+    assert not result['ok']
+    assert np.array_equal(result['missing_rows'], [n_rows - n_rows // 2 - 1])
+
+
+@pytest.mark.parametrize("n_rows", [7, 22])
+def test_segment_calls_skipped_half(n_rows):
+    # Three visits to one field, each gain, even rows, gain, odd rows, with
+    # the even half of the second visit skipped (e.g. below the elevation
+    # limit). The order alone would call the next odd half even.
+    params = dict(row_length=840 * u.arcsec, row_offset=27.5 * u.arcsec, n_rows=n_rows,
+                  scan_speed=11.45 * u.arcsec / u.s, pos_angle=144 * u.deg, t_dump=0.6 * u.s)
+
+    offx, offy, time, row = interleaved_dump_offsets(**params)
+    halves = [row % 2 == 0, row % 2 == 1]
+
+    records = []
+    t0 = 0.
+    for visit_halves in [[0, 1], [1], [0, 1]]:
+        for half in visit_halves:
+            gain = np.zeros(1, dtype=records_dtype)
+            gain['rinteg'] = 10.
+            gain['mjd'] = 60000. + t0 / 86400.
+            records.append(gain)
+
+            this = np.zeros(halves[half].sum(), dtype=records_dtype)
+            this['rinteg'] = 0.6
+            this['offx'] = offx[halves[half]]
+            this['offy'] = offy[halves[half]]
+            this['mjd'] = 60000. + (t0 + 20. + time[halves[half]] - time[halves[half]][0]) / 86400.
+            records.append(this)
+            t0 = (this['mjd'][-1] - 60000.) * 86400. + 20.
+    records = np.concatenate(records)
+
+    state = dict(otf_params=params, gap_time=(30 * u.s).to_value(u.d),
+                 call=None, calls=[], prev_call=None)
+    _segment_calls(state, records, np.zeros(records.size, dtype=int))
+    _finish_call(state, state['call'])
+
+    assert [call['start_row'] for call in state['calls']] == [0., 0.5, 0.5, 0., 0.5]
+    assert all(call['ok'] for call in state['calls'])